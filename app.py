@@ -1,102 +1,186 @@
+import logging
 import os
 import firebase_admin
 from firebase_admin import credentials, firestore
 from fastapi import FastAPI, Request, Depends, HTTPException
-from fastapi.responses import JSONResponse
-from linebot import LineBotApi, WebhookParser
+from fastapi.responses import JSONResponse, PlainTextResponse
 from linebot.exceptions import InvalidSignatureError
 from linebot.models import MessageEvent, TextMessage
+import stripe
 import uvicorn
 from dotenv import load_dotenv
 import json
-from services.conversation_service import ConversationService
-from services.user_service import UserService
-from services.ai_service import AIService
-from handlers.line_webhook import LineWebhookHandler
-from handlers.stripe_webhook_handler import StripeWebhookHandler
+from typing import Optional, Tuple
+from google.cloud.firestore import Client
+from services import metrics
+from services.container import ServiceContainer
+from services.logging_config import bind_request_id, setup_logging
+from contextlib import asynccontextmanager
+
+logger = logging.getLogger(__name__)
 
 # 環境変数の読み込み
 load_dotenv()
+setup_logging()
+
+
+def init_firestore() -> Tuple[Client, bool]:
+    """Firebaseを初期化してFirestoreクライアントを返す（失敗時はMagicMock）"""
+    try:
+        # 環境変数から認証情報を読み込む
+        firebase_credentials = os.getenv("FIREBASE_CREDENTIALS")
+        if firebase_credentials:
+            try:
+                try:
+                    firebase_admin.get_app()
+                except ValueError:
+                    cred_dict = json.loads(firebase_credentials)
+                    cred = credentials.Certificate(cred_dict)
+                    firebase_admin.initialize_app(cred)
+                logger.info("Firebase initialized with credentials from environment variable")
+                return firestore.client(), True
+            except Exception as e:
+                logger.error("Firebase initialization error with credentials from environment: %s", e)
+    except Exception as e:
+        logger.error("Firebase initialization error: %s", e)
+
+    logger.warning("Firebase not initialized. Some features may not work properly.")
+    from unittest.mock import MagicMock
+    return MagicMock(), False
+
+
+def get_services(request: Request) -> ServiceContainer:
+    """lifespanで作成したワーカーごとのサービス"""
+    return request.app.state.services
+
+
+def create_app(db: Optional[Client] = None) -> FastAPI:
+    """FastAPIアプリを作成（ベンチマークではFirestoreの代替を渡す）
+
+    Firebaseやクライアントはimport時ではなく、各ワーカープロセスの起動時（lifespan）に作成する。
+    """
+
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        if db is None:
+            services = ServiceContainer(*init_firestore())
+        else:
+            services = ServiceContainer(db)
+        app.state.services = services
+        await services.start()
+        yield
+        # シャットダウン時は受付済みのイベントを処理しきってから停止
+        await services.stop()
+
+    app = FastAPI(lifespan=lifespan)
+
+    @app.get("/")
+    async def root(services: ServiceContainer = Depends(get_services)):
+        return {
+            "message": "恋愛相談AIサービスが稼働中です",
+            "environment": os.getenv("ENVIRONMENT", "not set"),
+            **services.get_stats()
+        }
+
+    @app.get("/healthz")
+    async def liveness(services: ServiceContainer = Depends(get_services)):
+        """プロセスが応答でき、イベント処理のワーカーが動いているか（外部サービスの障害では失敗しない）"""
+        if not services.is_alive:
+            return JSONResponse(content={"alive": False}, status_code=503)
+        return {"alive": True}
+
+    @app.get("/readyz")
+    async def readiness(services: ServiceContainer = Depends(get_services)):
+        """FirestoreとOpenRouterに接続できるか（失敗中はロードバランサーから外す）"""
+        result = await services.health.readiness()
+        return JSONResponse(content=result, status_code=200 if result['ready'] else 503)
+
+    @app.get("/metrics")
+    async def metrics_endpoint(services: ServiceContainer = Depends(get_services)):
+        return PlainTextResponse(
+            metrics.REGISTRY.render([services.collect_metrics]),
+            media_type="text/plain; version=0.0.4; charset=utf-8"
+        )
 
-# Firebaseの初期化とFirestoreクライアントの作成
-firebase_initialized = False
-db = None
+    @app.post("/webhook")
+    async def line_webhook(request: Request, services: ServiceContainer = Depends(get_services)):
+        # このリクエストから投入したジョブのログにも同じIDが付く
+        bind_request_id(request.headers.get("X-Request-Id"))
+        signature = request.headers.get("X-Line-Signature", "")
+        body = await request.body()
+        body_decode = body.decode("utf-8")
 
-try:
-    # 環境変数から認証情報を読み込む
-    firebase_credentials = os.getenv("FIREBASE_CREDENTIALS")
-    if firebase_credentials:
         try:
-            cred_dict = json.loads(firebase_credentials)
-            cred = credentials.Certificate(cred_dict)
-            firebase_admin.initialize_app(cred)
-            db = firestore.client()
-            firebase_initialized = True
-            print("Firebase initialized with credentials from environment variable")
+            with metrics.span("signature"):
+                events = services.parser.parse(body_decode, signature)
+            # 処理はワーカーに任せ、LINEには即座に200を返す
+            # ユーザーごとに順番を保ちつつ、異なるユーザーのイベントは並行に処理する
+            for event in events:
+                if isinstance(event, MessageEvent) and isinstance(event.message, TextMessage):
+                    # 再送されたイベントは重い処理の前に破棄
+                    if event.webhook_event_id and not await services.dedup_store.mark_seen(f"line:{event.webhook_event_id}"):
+                        redelivery = event.delivery_context.is_redelivery if event.delivery_context else False
+                        logger.info("Skipping duplicate LINE event %s (redelivery=%s)", event.webhook_event_id, redelivery)
+                        continue
+                    # キューが溜まっているときは処理せず、混雑中の定型文だけを返す
+                    if services.admission.should_shed() or not services.event_queue.submit(
+                        services.line_webhook_handler.handle_message, event, key=event.source.user_id
+                    ):
+                        services.notification_queue.submit(services.line_webhook_handler.reply_overloaded, event)
+            return JSONResponse(content={"message": "OK"}, status_code=200)
+        except InvalidSignatureError:
+            logger.warning("❌ 署名が一致しません")
+            raise HTTPException(status_code=400, detail="Invalid signature")
         except Exception as e:
-            print(f"Firebase initialization error with credentials from environment: {e}")
-except Exception as e:
-    print(f"Firebase initialization error: {e}")
+            logger.exception("Error in line_webhook: %s", e)
+            raise HTTPException(status_code=500, detail=str(e))
 
-if not firebase_initialized:
-    print("WARNING: Firebase not initialized. Some features may not work properly.")
-    from unittest.mock import MagicMock
-    db = MagicMock()
-
-# LINEの設定
-line_bot_api = LineBotApi(os.getenv("LINE_CHANNEL_ACCESS_TOKEN"))
-parser = WebhookParser(os.getenv("LINE_CHANNEL_SECRET"))
-
-# サービスの初期化
-conversation_service = ConversationService(db)
-ai_service = AIService(conversation_service)
-user_service = UserService(db, conversation_service)
-
-# ハンドラーの初期化（依存関係の循環を解決）
-line_webhook_handler = LineWebhookHandler(line_bot_api, user_service, ai_service)
-stripe_webhook_handler = StripeWebhookHandler(user_service, line_webhook_handler)
-
-app = FastAPI()
-
-@app.get("/")
-async def root():
-    return {
-        "message": "恋愛相談AIサービスが稼働中です", 
-        "firebase_initialized": firebase_initialized,
-        "environment": os.getenv("ENVIRONMENT", "not set")
-    }
-
-@app.post("/webhook")
-async def line_webhook(request: Request):
-    signature = request.headers.get("X-Line-Signature", "")
-    body = await request.body()
-    body_decode = body.decode("utf-8")
-    
-    try:
-        events = parser.parse(body_decode, signature)
-        for event in events:
-            if isinstance(event, MessageEvent) and isinstance(event.message, TextMessage):
-                await line_webhook_handler.handle_message(event)
-        return JSONResponse(content={"message": "OK"}, status_code=200)
-    except InvalidSignatureError:
-        print("❌ 署名が一致しません")
-        raise HTTPException(status_code=400, detail="Invalid signature")
-    except Exception as e:
-        print(f"Error in line_webhook: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
-
-@app.post("/webhook/stripe")
-async def stripe_webhook(request: Request):
-    body = await request.body()
-    signature = request.headers.get("Stripe-Signature", "")
-    
-    try:
-        await stripe_webhook_handler.handle_webhook(body, signature)
-        return JSONResponse(content={"message": "OK"})
-    except Exception as e:
-        print(f"Error in stripe_webhook: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+    @app.post("/webhook/stripe")
+    async def stripe_webhook(request: Request, services: ServiceContainer = Depends(get_services)):
+        bind_request_id(request.headers.get("X-Request-Id"))
+        body = await request.body()
+        signature = request.headers.get("Stripe-Signature", "")
 
-if __name__ == "__main__":
+        try:
+            # ユーザー情報の更新を終えてから応答する（LINEへの通知は通知キューで送る）
+            await services.stripe_webhook_handler.handle_webhook(body, signature)
+            return JSONResponse(content={"message": "OK"})
+        except (stripe.error.SignatureVerificationError, ValueError):
+            raise HTTPException(status_code=400, detail="Invalid payload or signature")
+        except Exception as e:
+            # 5xxを返すとStripeが後で再送する
+            logger.error("Error in stripe_webhook: %s", e)
+            raise HTTPException(status_code=500, detail=str(e))
+
+    return app
+
+
+app = create_app()
+
+
+def run() -> None:
+    """サーバーを起動（developmentは自動リロード、それ以外はWEB_CONCURRENCY個のワーカープロセス）"""
     port = int(os.getenv("PORT", 8000))
-    uvicorn.run("app:app", host="0.0.0.0", port=port, reload=True) 
\ No newline at end of file
+    if os.getenv("ENVIRONMENT") == "development":
+        uvicorn.run("app:app", host="0.0.0.0", port=port, reload=True)
+        return
+
+    workers = int(os.getenv("WEB_CONCURRENCY", 1))
+    if workers > 1:
+        # 重複排除と会話履歴のキャッシュはプロセス内の状態のため、ワーカー間で共有できるものに切り替える
+        if os.getenv("DEDUP_BACKEND", "memory") != "firestore":
+            raise SystemExit("WEB_CONCURRENCY > 1 requires DEDUP_BACKEND=firestore")
+        if os.getenv("HISTORY_CACHE_ENABLED", "true").lower() == "true":
+            logger.warning("Disabling the history cache because WEB_CONCURRENCY=%s", workers)
+        os.environ["HISTORY_CACHE_ENABLED"] = "false"
+    uvicorn.run(
+        "app:app",
+        host="0.0.0.0",
+        port=port,
+        workers=workers,
+        proxy_headers=True
+    )
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,77 @@
+"""期限切れの案内を作るときのStripe呼び出しの待ち時間を計測するベンチマーク
+
+擬似Stripe（またはSTRIPE_API_BASEで指定したstripe-mock）に対して、
+変更前の同期呼び出しとCheckoutLinkProviderのキャッシュ・事前作成を比較する。
+
+使い方:
+    python -m benchmarks.checkout_links_bench --users 50 --latency 0.3
+    STRIPE_API_BASE=http://localhost:12111 python -m benchmarks.checkout_links_bench --users 50
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import time
+from contextlib import nullcontext
+
+from benchmarks.fake_stripe import create_fake_stripe
+from benchmarks.local_server import LocalServer
+
+
+def report(label: str, latencies: list, elapsed: float) -> None:
+    latencies = sorted(latency * 1000 for latency in latencies)
+    print(
+        f"{label:<22} p50={statistics.median(latencies):8.2f}ms "
+        f"max={latencies[-1]:8.2f}ms total={elapsed * 1000:8.1f}ms"
+    )
+
+
+async def run(label: str, get_url, users: int) -> None:
+    """users人分の案内を同時に作成（同期呼び出しはイベントループを止めるため直列になる）"""
+    latencies = []
+
+    async def one(i: int) -> None:
+        start = time.perf_counter()
+        await get_url(f"Ubench{i:05d}")
+        latencies.append(time.perf_counter() - start)
+
+    started = time.perf_counter()
+    await asyncio.gather(*[one(i) for i in range(users)])
+    report(label, latencies, time.perf_counter() - started)
+
+
+async def main(args) -> None:
+    fake = nullcontext() if os.getenv("STRIPE_API_BASE") else LocalServer(create_fake_stripe(latency=args.latency))
+    with fake as server:
+        if server is not None:
+            os.environ["STRIPE_API_BASE"] = server.base_url
+        os.environ.setdefault("STRIPE_SECRET_KEY", "sk_test_benchmark")
+        os.environ.setdefault("STRIPE_PRICE_ID_month", "price_benchmark")
+        from services.checkout_links import CheckoutLinkProvider
+        from services.stripe_service import StripeService
+
+        stripe_service = StripeService()
+        provider = CheckoutLinkProvider(stripe_service, max_workers=args.workers)
+
+        async def blocking(user_id: str) -> None:
+            # 変更前の実装: メッセージ処理中にStripeを同期で呼ぶ
+            stripe_service.create_checkout_session(user_id, 'month')
+
+        async def cached(user_id: str) -> None:
+            provider.get_cached(user_id, 'month')
+
+        await run("sync call (before)", blocking, args.users)
+        await run("provider cold", cached, args.users)
+        # コールド時に予約された作成の完了を待つ
+        await asyncio.gather(*list(provider._pending.values()))
+        await run("provider warm", cached, args.users)
+        print(f"stats: {provider.get_stats()}")
+        await provider.aclose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--workers", type=int, default=4, help="Stripe呼び出し用のスレッド数")
+    parser.add_argument("--latency", type=float, default=0.3, help="擬似Stripeの応答遅延（秒）")
+    asyncio.run(main(parser.parse_args()))
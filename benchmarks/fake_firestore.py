@@ -0,0 +1,292 @@
+import copy
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+from google.api_core.exceptions import AlreadyExists, FailedPrecondition, NotFound
+from google.cloud.firestore import Increment
+
+_OPERATORS = {
+    '==': lambda a, b: a == b,
+    '!=': lambda a, b: a != b,
+    '<': lambda a, b: a is not None and a < b,
+    '<=': lambda a, b: a is not None and a <= b,
+    '>': lambda a, b: a is not None and a > b,
+    '>=': lambda a, b: a is not None and a >= b,
+    'in': lambda a, b: a in b,
+}
+
+
+class InMemoryFirestore:
+    """ベンチマーク用のプロセス内Firestore（アプリが使うAPIのみ）
+
+    RPCの種類ごとの呼び出し回数と読み書きしたドキュメント数をopsに記録する。
+    latencyを指定すると1回のRPCごとに待機し、ネットワーク往復を模す。
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.ops: Counter = Counter()
+        self._collections: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        # (コレクション名, ドキュメントID) -> 最終更新時刻（書き込みごとに必ず進む）
+        self._update_times: Dict[Tuple[str, str], datetime] = {}
+        self._last_update_time = datetime.now(timezone.utc)
+        self._lock = threading.RLock()
+
+    def collection(self, name: str) -> "CollectionReference":
+        return CollectionReference(self, name)
+
+    def batch(self) -> "WriteBatch":
+        return WriteBatch(self)
+
+    def write_option(self, last_update_time: datetime) -> "LastUpdateOption":
+        return LastUpdateOption(last_update_time)
+
+    def reset_ops(self) -> None:
+        with self._lock:
+            self.ops.clear()
+
+    def get_ops(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self.ops)
+
+    def _rpc(self, kind: str, reads: int = 0, writes: int = 0) -> None:
+        with self._lock:
+            self.ops[kind] += 1
+            self.ops['rpcs'] += 1
+            self.ops['doc_reads'] += reads
+            self.ops['doc_writes'] += writes
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _docs(self, collection: str) -> Dict[str, Dict[str, Any]]:
+        return self._collections.setdefault(collection, {})
+
+    def _check(self, ref: "DocumentReference", option: Optional["LastUpdateOption"]) -> None:
+        """前提条件（最終更新時刻）を満たさなければFailedPreconditionを送出"""
+        if option is not None and self._update_times.get((ref.collection_name, ref.id)) != option.last_update_time:
+            raise FailedPrecondition(f"Document was updated after the precondition time: {ref.path}")
+
+    def _write(self, ref: "DocumentReference", data: Dict[str, Any], merge: bool = False, must_exist: bool = False) -> None:
+        docs = self._docs(ref.collection_name)
+        current = docs.get(ref.id)
+        if must_exist and current is None:
+            raise NotFound(f"No document to update: {ref.path}")
+        base = dict(current) if current is not None and (merge or must_exist) else {}
+        for key, value in data.items():
+            if isinstance(value, Increment):
+                base[key] = (base.get(key) or 0) + value.value
+            else:
+                base[key] = copy.deepcopy(value)
+        docs[ref.id] = base
+        self._last_update_time = max(datetime.now(timezone.utc), self._last_update_time + timedelta(microseconds=1))
+        self._update_times[(ref.collection_name, ref.id)] = self._last_update_time
+
+    def _delete(self, ref: "DocumentReference") -> None:
+        self._docs(ref.collection_name).pop(ref.id, None)
+        self._update_times.pop((ref.collection_name, ref.id), None)
+
+
+class LastUpdateOption:
+    """write_optionで作る前提条件（ドキュメントの最終更新時刻が一致する場合のみ書き込む）"""
+
+    def __init__(self, last_update_time: datetime):
+        self.last_update_time = last_update_time
+
+
+class DocumentSnapshot:
+    def __init__(self, reference: "DocumentReference", data: Optional[Dict[str, Any]],
+                 update_time: Optional[datetime] = None):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self.update_time = update_time
+        self._data = data
+
+    def to_dict(self) -> Optional[Dict[str, Any]]:
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+    def get(self, field: str) -> Any:
+        return (self._data or {}).get(field)
+
+
+class DocumentReference:
+    def __init__(self, store: InMemoryFirestore, collection_name: str, doc_id: str):
+        self._store = store
+        self.collection_name = collection_name
+        self.id = doc_id
+        self.path = f"{collection_name}/{doc_id}"
+
+    def get(self, **kwargs: Any) -> DocumentSnapshot:
+        store = self._store
+        store._rpc('get', reads=1)
+        with store._lock:
+            data = store._docs(self.collection_name).get(self.id)
+            return DocumentSnapshot(self, copy.deepcopy(data), store._update_times.get((self.collection_name, self.id)))
+
+    def set(self, data: Dict[str, Any], merge: bool = False) -> None:
+        self._store._rpc('set', writes=1)
+        with self._store._lock:
+            self._store._write(self, data, merge=merge)
+
+    def update(self, data: Dict[str, Any], option: Optional[LastUpdateOption] = None) -> None:
+        self._store._rpc('update', writes=1)
+        with self._store._lock:
+            self._store._check(self, option)
+            self._store._write(self, data, must_exist=True)
+
+    def create(self, data: Dict[str, Any]) -> None:
+        self._store._rpc('create', writes=1)
+        with self._store._lock:
+            if self.id in self._store._docs(self.collection_name):
+                raise AlreadyExists(f"Document already exists: {self.path}")
+            self._store._write(self, data)
+
+    def delete(self) -> None:
+        self._store._rpc('delete', writes=1)
+        with self._store._lock:
+            self._store._delete(self)
+
+
+class Query:
+    ASCENDING = 'ASCENDING'
+    DESCENDING = 'DESCENDING'
+
+    def __init__(self, store: InMemoryFirestore, collection_name: str, filters: Tuple = (), orders: Tuple = (),
+                 limit_count: Optional[int] = None, cursor: Optional[Tuple[Dict[str, Any], Optional[str]]] = None):
+        self._store = store
+        self._collection_name = collection_name
+        self._filters = filters
+        self._orders = orders
+        self._limit = limit_count
+        self._cursor = cursor
+
+    def _copy(self, **changes: Any) -> "Query":
+        fields = {
+            'filters': self._filters, 'orders': self._orders,
+            'limit_count': self._limit, 'cursor': self._cursor
+        }
+        fields.update(changes)
+        return Query(self._store, self._collection_name, **fields)
+
+    def where(self, field: str, op: str, value: Any) -> "Query":
+        return self._copy(filters=self._filters + ((field, _OPERATORS[op], value),))
+
+    def order_by(self, field: str, direction: str = ASCENDING) -> "Query":
+        return self._copy(orders=self._orders + ((field, direction),))
+
+    def limit(self, count: int) -> "Query":
+        return self._copy(limit_count=count)
+
+    def start_after(self, document: Any) -> "Query":
+        # スナップショットを渡した場合はFirestoreと同じくドキュメントIDで同値を区別する
+        if isinstance(document, DocumentSnapshot):
+            return self._copy(cursor=(document.to_dict(), document.id))
+        return self._copy(cursor=(document, None))
+
+    def _matching(self) -> List[DocumentSnapshot]:
+        with self._store._lock:
+            items = [
+                (doc_id, data) for doc_id, data in self._store._docs(self._collection_name).items()
+                if all(field in data and op(data[field], value) for field, op, value in self._filters)
+            ]
+        items.sort(key=lambda item: item[0])
+        for field, direction in reversed(self._orders):
+            items = [item for item in items if item[1].get(field) is not None]
+            items.sort(key=lambda item: item[1][field], reverse=direction == self.DESCENDING)
+        if self._cursor is not None and self._orders:
+            values, cursor_id = self._cursor
+            cursor_key = tuple(values.get(field) for field, _ in self._orders)
+            items = [item for item in items if self._after(item, cursor_key, cursor_id)]
+        if self._limit is not None:
+            items = items[:self._limit]
+        return [
+            DocumentSnapshot(
+                DocumentReference(self._store, self._collection_name, doc_id), copy.deepcopy(data),
+                self._store._update_times.get((self._collection_name, doc_id))
+            )
+            for doc_id, data in items
+        ]
+
+    def _after(self, item: Tuple[str, Dict[str, Any]], cursor_key: Tuple, cursor_id: Optional[str]) -> bool:
+        doc_id, data = item
+        for (field, direction), cursor_value in zip(self._orders, cursor_key):
+            value = data.get(field)
+            if value == cursor_value:
+                continue
+            return value < cursor_value if direction == self.DESCENDING else value > cursor_value
+        return cursor_id is not None and doc_id > cursor_id
+
+    def stream(self, **kwargs: Any):
+        results = self._matching()
+        self._store._rpc('query', reads=max(len(results), 1))
+        return iter(results)
+
+    def get(self, **kwargs: Any) -> List[DocumentSnapshot]:
+        return list(self.stream())
+
+    def count(self, alias: str = 'count') -> "AggregationQuery":
+        return AggregationQuery(self, alias)
+
+
+class AggregationResult:
+    def __init__(self, alias: str, value: int):
+        self.alias = alias
+        self.value = value
+
+
+class AggregationQuery:
+    def __init__(self, query: Query, alias: str):
+        self._query = query
+        self._alias = alias
+
+    def get(self, **kwargs: Any) -> List[List[AggregationResult]]:
+        value = len(self._query._matching())
+        # 集計クエリは最大1000件ごとに1読み取りとして課金される
+        self._query._store._rpc('count', reads=max(1, -(-value // 1000)))
+        return [[AggregationResult(self._alias, value)]]
+
+
+class CollectionReference(Query):
+    def __init__(self, store: InMemoryFirestore, name: str):
+        super().__init__(store, name)
+        self.id = name
+
+    def document(self, doc_id: Optional[str] = None) -> DocumentReference:
+        return DocumentReference(self._store, self._collection_name, doc_id or uuid.uuid4().hex[:20])
+
+    def add(self, data: Dict[str, Any]) -> Tuple[None, DocumentReference]:
+        ref = self.document()
+        ref.set(data)
+        return None, ref
+
+
+class WriteBatch:
+    def __init__(self, store: InMemoryFirestore):
+        self._store = store
+        self._writes: List[Tuple[str, DocumentReference, Dict[str, Any], bool, Optional[LastUpdateOption]]] = []
+
+    def set(self, ref: DocumentReference, data: Dict[str, Any], merge: bool = False) -> None:
+        self._writes.append(('set', ref, data, merge, None))
+
+    def update(self, ref: DocumentReference, data: Dict[str, Any], option: Optional[LastUpdateOption] = None) -> None:
+        self._writes.append(('update', ref, data, False, option))
+
+    def delete(self, ref: DocumentReference) -> None:
+        self._writes.append(('delete', ref, {}, False, None))
+
+    def commit(self) -> None:
+        self._store._rpc('commit', writes=len(self._writes))
+        with self._store._lock:
+            # Firestoreと同じく、前提条件を1つでも満たさなければ何も書き込まない
+            for _, ref, _, _, option in self._writes:
+                self._store._check(ref, option)
+            for kind, ref, data, merge, _ in self._writes:
+                if kind == 'delete':
+                    self._store._delete(ref)
+                else:
+                    self._store._write(ref, data, merge=merge, must_exist=kind == 'update')
+        self._writes = []
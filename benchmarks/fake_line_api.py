@@ -0,0 +1,40 @@
+import asyncio
+import time
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+
+def create_fake_line_api(latency: float = 0.0, rate_limit_every: int = 0) -> FastAPI:
+    """LINE Messaging APIのreply/push/multicastを模したローカルサーバー
+
+    rate_limit_everyを指定するとN回に1回、Retry-After付きの429を返す。
+    requestsには(種類, ペイロード, 受信時刻のperf_counter)を記録する。
+    """
+    app = FastAPI()
+    app.state.requests = []
+    app.state.calls = 0
+
+    async def handle(kind: str, request: Request):
+        payload = await request.json()
+        app.state.calls += 1
+        if latency:
+            await asyncio.sleep(latency)
+        if rate_limit_every and app.state.calls % rate_limit_every == 0:
+            return JSONResponse({"message": "Too Many Requests"}, status_code=429, headers={"Retry-After": "0"})
+        app.state.requests.append((kind, payload, time.perf_counter()))
+        return {}
+
+    @app.post("/v2/bot/message/reply")
+    async def reply(request: Request):
+        return await handle("reply", request)
+
+    @app.post("/v2/bot/message/push")
+    async def push(request: Request):
+        return await handle("push", request)
+
+    @app.post("/v2/bot/message/multicast")
+    async def multicast(request: Request):
+        return await handle("multicast", request)
+
+    return app
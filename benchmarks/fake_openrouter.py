@@ -0,0 +1,46 @@
+import asyncio
+import json
+
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+
+DEFAULT_REPLY = "えー、それは気になるよね！何日くらい連絡ないの？最近忙しそうとか、何かきっかけはあった？大丈夫、ちゃんと一緒に考えよ！"
+
+
+def create_fake_openrouter(latency: float = 0.0, token_delay: float = 0.0, reply: str = DEFAULT_REPLY, chunk_chars: int = 4) -> FastAPI:
+    """OpenRouterのchat/completionsを模したローカルサーバー
+
+    latencyは最初の応答までの遅延、token_delayはストリーミング時のチャンクごとの遅延（秒）。
+    """
+    app = FastAPI()
+    app.state.requests = 0
+
+    async def stream_chunks(request_id: str):
+        yield ": OPENROUTER PROCESSING\n\n"
+        for i in range(0, len(reply), chunk_chars):
+            if token_delay:
+                await asyncio.sleep(token_delay)
+            chunk = {"id": request_id, "choices": [{"index": 0, "delta": {"content": reply[i:i + chunk_chars]}}]}
+            yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+        yield "data: [DONE]\n\n"
+
+    @app.get("/api/v1/key")
+    async def key():
+        return {"data": {"label": "benchmark", "usage": 0, "limit": None}}
+
+    @app.post("/api/v1/chat/completions")
+    async def chat_completions(request: Request):
+        payload = await request.json()
+        app.state.requests += 1
+        request_id = f"fake-{app.state.requests}"
+        if latency:
+            await asyncio.sleep(latency)
+        if payload.get("stream"):
+            return StreamingResponse(stream_chunks(request_id), media_type="text/event-stream")
+        return {
+            "id": request_id,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": reply}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 0, "completion_tokens": len(reply)}
+        }
+
+    return app
@@ -0,0 +1,32 @@
+import asyncio
+import time
+from urllib.parse import parse_qs
+
+from fastapi import FastAPI, Request
+
+
+def create_fake_stripe(latency: float = 0.0) -> FastAPI:
+    """StripeのCheckout Session作成APIを模したローカルサーバー（STRIPE_API_BASEに指定する）
+
+    requestsには(フォームの内容, 受信時刻のperf_counter)を記録する。
+    """
+    app = FastAPI()
+    app.state.requests = []
+
+    @app.post("/v1/checkout/sessions")
+    async def create_session(request: Request):
+        form = {key: values[0] for key, values in parse_qs((await request.body()).decode()).items()}
+        app.state.requests.append((form, time.perf_counter()))
+        if latency:
+            await asyncio.sleep(latency)
+        session_id = f"cs_test_{len(app.state.requests)}"
+        return {
+            "id": session_id,
+            "object": "checkout.session",
+            "client_reference_id": form.get("client_reference_id"),
+            "expires_at": int(form.get("expires_at", time.time() + 24 * 3600)),
+            "mode": form.get("mode"),
+            "url": f"https://checkout.stripe.com/c/pay/{session_id}"
+        }
+
+    return app
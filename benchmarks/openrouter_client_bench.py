@@ -0,0 +1,71 @@
+"""OpenRouter呼び出しの接続使い回しによるレイテンシ改善を計測するベンチマーク
+
+使い方:
+    python -m benchmarks.openrouter_client_bench --requests 200 --concurrency 10
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import time
+
+import httpx
+
+from benchmarks.fake_openrouter import create_fake_openrouter
+from benchmarks.local_server import LocalServer
+
+PAYLOAD = {
+    "model": "anthropic/claude-3-haiku",
+    "messages": [{"role": "user", "content": "こんにちは"}],
+    "temperature": 0.7,
+    "max_tokens": 1000
+}
+
+
+async def per_call_client(api_url: str, headers: dict) -> None:
+    """変更前の実装: 呼び出しごとにクライアントを作成"""
+    async with httpx.AsyncClient() as client:
+        response = await client.post(api_url, headers=headers, json=PAYLOAD)
+        response.raise_for_status()
+        response.json()
+
+
+async def run(label: str, call, requests: int, concurrency: int) -> None:
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one() -> None:
+        async with semaphore:
+            start = time.perf_counter()
+            await call()
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    started = time.perf_counter()
+    await asyncio.gather(*[one() for _ in range(requests)])
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    print(
+        f"{label:<18} p50={statistics.median(latencies):7.2f}ms "
+        f"p95={latencies[int(len(latencies) * 0.95) - 1]:7.2f}ms "
+        f"throughput={requests / elapsed:8.1f} req/s"
+    )
+
+
+async def main(args) -> None:
+    with LocalServer(create_fake_openrouter(latency=args.latency)) as server:
+        os.environ["OPENROUTER_API_URL"] = f"{server.base_url}/api/v1/chat/completions"
+        os.environ.setdefault("OPENROUTER_API_KEY", "benchmark")
+        from services.ai_service import AIService
+
+        ai_service = AIService(conversation_service=None)
+        await run("per-call client", lambda: per_call_client(ai_service.api_url, ai_service.headers), args.requests, args.concurrency)
+        await run("shared client", lambda: ai_service._post_completion(PAYLOAD), args.requests, args.concurrency)
+        await ai_service.aclose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0.0, help="擬似OpenRouterの応答遅延（秒）")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,238 @@
+"""署名付きLINE Webhookを一定RPSで送り、/webhookの処理性能を計測する負荷試験
+
+FastAPIアプリ本体を擬似OpenRouter・擬似LINE API・Firestoreの代替と組み合わせて起動し、
+Webhookの応答時間、受信から返信までのエンドツーエンドの遅延、スループット、
+メッセージあたりのFirestore操作数を出力する。
+
+使い方:
+    python -m benchmarks.webhook_load --rps 50 --duration 10 --users 200
+    python -m benchmarks.webhook_load --stream --llm-latency 0.3 --token-delay 0.02
+    RESPONSE_CACHE_ENABLED=true python -m benchmarks.webhook_load --openers --users 1000
+    FIRESTORE_EMULATOR_HOST=localhost:8080 python -m benchmarks.webhook_load --firestore emulator
+
+負荷生成・アプリ・擬似サーバーは同一プロセスで動くため、絶対値ではなく変更前後の比較に使う。
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import os
+import random
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Tuple
+
+import httpx
+
+from benchmarks.fake_firestore import InMemoryFirestore
+from benchmarks.fake_line_api import create_fake_line_api
+from benchmarks.fake_openrouter import create_fake_openrouter
+from benchmarks.local_server import LocalServer
+
+CHANNEL_SECRET = "benchmark-channel-secret"
+
+# 初回の相談でよく送られる短いメッセージ（--openers）
+OPENERS = ["こんにちは", "こんにちは！", "相談したい", "相談したいです", "彼氏が…", "はじめまして"]
+
+
+def percentile(values: List[float], p: float) -> float:
+    """昇順に並んだ値のパーセンタイル（最近傍法）"""
+    if not values:
+        return 0.0
+    index = max(0, min(len(values) - 1, int(round(p / 100 * len(values))) - 1))
+    return values[index]
+
+
+def format_latencies(label: str, latencies: List[float]) -> str:
+    values = sorted(latencies)
+    return (
+        f"{label:<10} n={len(values):<6} p50={percentile(values, 50):8.2f}ms "
+        f"p95={percentile(values, 95):8.2f}ms p99={percentile(values, 99):8.2f}ms "
+        f"max={(values[-1] if values else 0.0):8.2f}ms"
+    )
+
+
+def build_payload(user_id: str, text: str, reply_token: str) -> bytes:
+    """テキストメッセージ1件を含むWebhookのリクエストボディ"""
+    return json.dumps({
+        "destination": "Ubenchmark",
+        "events": [{
+            "type": "message",
+            "mode": "active",
+            "timestamp": int(time.time() * 1000),
+            "source": {"type": "user", "userId": user_id},
+            "webhookEventId": uuid.uuid4().hex,
+            "deliveryContext": {"isRedelivery": False},
+            "replyToken": reply_token,
+            "message": {"id": uuid.uuid4().hex[:18], "type": "text", "quoteToken": uuid.uuid4().hex, "text": text}
+        }]
+    }, ensure_ascii=False).encode("utf-8")
+
+
+def sign(body: bytes) -> str:
+    return base64.b64encode(hmac.new(CHANNEL_SECRET.encode("utf-8"), body, hashlib.sha256).digest()).decode("utf-8")
+
+
+def create_db(backend: str, latency: float):
+    """Firestoreの代替を作成（emulatorはFIRESTORE_EMULATOR_HOSTが必要）"""
+    if backend == "emulator":
+        if not os.getenv("FIRESTORE_EMULATOR_HOST"):
+            raise SystemExit("FIRESTORE_EMULATOR_HOST is not set")
+        from google.cloud import firestore
+        return firestore.Client(project=os.getenv("GOOGLE_CLOUD_PROJECT", "benchmark"))
+    return InMemoryFirestore(latency=latency)
+
+
+def seed_users(db, user_ids: List[str], paid: bool) -> None:
+    """有料会員として登録し、すべてのメッセージがAI応答まで進むようにする"""
+    from models.user import User
+
+    now = datetime.now(timezone.utc)
+    for user_id in user_ids:
+        user = User(
+            user_id=user_id,
+            is_paid=paid,
+            subscription_type="month" if paid else None,
+            subscription_end=now + timedelta(days=30) if paid else None
+        )
+        db.collection("users").document(user_id).set(user.to_dict())
+
+
+async def generate_load(base_url: str, user_ids: List[str], rps: float, duration: float, sent_at: Dict[str, float],
+                        openers: bool = False) -> List[float]:
+    """一定間隔でWebhookを送信し、各リクエストの応答時間（ms）を返す"""
+    ack_latencies: List[float] = []
+    errors = 0
+    total = int(rps * duration)
+    interval = 1.0 / rps
+
+    async def send(client: httpx.AsyncClient, index: int) -> None:
+        nonlocal errors
+        reply_token = uuid.uuid4().hex
+        text = random.choice(OPENERS) if openers else f"相談です {index}: 彼から連絡が来ないんだけどどうしたらいい？"
+        body = build_payload(random.choice(user_ids), text, reply_token)
+        start = time.perf_counter()
+        sent_at[reply_token] = start
+        try:
+            response = await client.post(
+                "/webhook", content=body,
+                headers={"X-Line-Signature": sign(body), "Content-Type": "application/json"}
+            )
+            if response.status_code != 200:
+                errors += 1
+                sent_at.pop(reply_token, None)
+                return
+        except httpx.HTTPError:
+            errors += 1
+            sent_at.pop(reply_token, None)
+            return
+        ack_latencies.append((time.perf_counter() - start) * 1000)
+
+    limits = httpx.Limits(max_connections=200, max_keepalive_connections=200)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=30) as client:
+        started = time.perf_counter()
+        tasks = []
+        # 前のリクエストの完了を待たないオープンループで送信
+        for index in range(total):
+            delay = started + index * interval - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(send(client, index)))
+        await asyncio.gather(*tasks)
+
+    if errors:
+        print(f"webhook errors: {errors}")
+    return ack_latencies
+
+
+async def wait_for_replies(line_api, sent_at: Dict[str, float], timeout: float) -> Tuple[List[float], float]:
+    """擬似LINE APIに返信が届くのを待ち、受信から返信までの時間（ms）と最後の返信時刻を返す"""
+    deadline = time.monotonic() + timeout
+    replies: Dict[str, float] = {}
+    while time.monotonic() < deadline:
+        for kind, payload, received_at in list(line_api.state.requests):
+            token = payload.get("replyToken")
+            if kind == "reply" and token in sent_at:
+                replies.setdefault(token, received_at)
+        if len(replies) >= len(sent_at):
+            break
+        await asyncio.sleep(0.05)
+    if len(replies) < len(sent_at):
+        print(f"timed out waiting for replies: {len(sent_at) - len(replies)} missing")
+    return [(replies[token] - sent_at[token]) * 1000 for token in replies], max(replies.values(), default=0.0)
+
+
+async def main(args) -> None:
+    fake_openrouter = create_fake_openrouter(latency=args.llm_latency, token_delay=args.token_delay)
+    fake_line_api = create_fake_line_api(latency=args.line_latency)
+
+    with LocalServer(fake_openrouter) as openrouter_server, LocalServer(fake_line_api) as line_server:
+        # サービスは作成時に環境変数を読むため、アプリの読み込み前に設定する
+        os.environ.update({
+            "OPENROUTER_API_URL": f"{openrouter_server.base_url}/api/v1/chat/completions",
+            "OPENROUTER_API_KEY": "benchmark",
+            "OPENROUTER_STREAMING": "true" if args.stream else "false",
+            "LINE_API_BASE_URL": line_server.base_url,
+            "LINE_CHANNEL_SECRET": CHANNEL_SECRET,
+            "LINE_CHANNEL_ACCESS_TOKEN": "benchmark",
+            "EVENT_QUEUE_WORKERS": str(args.workers),
+            "ENVIRONMENT": "benchmark",
+        })
+        os.environ.setdefault("STRIPE_SECRET_KEY", "sk_test_benchmark")
+        from app import create_app
+
+        db = create_db(args.firestore, args.firestore_latency)
+        user_ids = [f"Ubench{i:08d}" for i in range(args.users)]
+        seed_users(db, user_ids, paid=not args.free)
+        app = create_app(db)
+        if isinstance(db, InMemoryFirestore):
+            db.reset_ops()
+
+        with LocalServer(app, lifespan="on") as app_server:
+            sent_at: Dict[str, float] = {}
+            started = time.perf_counter()
+            ack_latencies = await generate_load(app_server.base_url, user_ids, args.rps, args.duration, sent_at, args.openers)
+            e2e_latencies, last_reply = await wait_for_replies(fake_line_api, sent_at, args.timeout)
+            # 返信後の会話保存・要約を待ってからFirestore操作数を集計
+            await asyncio.sleep(args.settle)
+            async with httpx.AsyncClient(base_url=app_server.base_url) as client:
+                stats = (await client.get("/")).json()
+
+    completed = len(e2e_latencies)
+    elapsed = (last_reply - started) if completed else 0.0
+    print(f"rps={args.rps} duration={args.duration}s users={args.users} workers={args.workers} "
+          f"stream={args.stream} firestore={args.firestore}")
+    print(format_latencies("ack", ack_latencies))
+    print(format_latencies("e2e", e2e_latencies))
+    print(f"throughput {completed / elapsed if elapsed else 0.0:8.1f} replies/s ({completed}/{len(sent_at)} completed)")
+    if isinstance(db, InMemoryFirestore):
+        ops = db.get_ops()
+        per_message = {key: round(value / completed, 2) for key, value in sorted(ops.items())} if completed else {}
+        print(f"firestore ops/message {per_message}")
+    else:
+        print("firestore ops/message n/a (emulator)")
+    print(f"event_queue {stats.get('event_queue')}")
+    print(f"ai {stats.get('ai')}")
+    print(f"admission {stats.get('admission')}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rps", type=float, default=20)
+    parser.add_argument("--duration", type=float, default=10, help="送信を続ける時間（秒）")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--workers", type=int, default=4, help="EVENT_QUEUE_WORKERS")
+    parser.add_argument("--free", action="store_true", help="無料会員として登録（1日1回を超えると制限メッセージになる）")
+    parser.add_argument("--openers", action="store_true", help="初回の相談でよく送られる短いメッセージを送る（応答キャッシュの計測用）")
+    parser.add_argument("--stream", action="store_true", help="OpenRouterのストリーミング応答を使う")
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="擬似OpenRouterの最初の応答までの遅延（秒）")
+    parser.add_argument("--token-delay", type=float, default=0.0, help="ストリーミング時のチャンクごとの遅延（秒）")
+    parser.add_argument("--line-latency", type=float, default=0.02, help="擬似LINE APIの応答遅延（秒）")
+    parser.add_argument("--firestore", choices=["memory", "emulator"], default="memory")
+    parser.add_argument("--firestore-latency", type=float, default=0.005, help="メモリ版Firestoreの1RPCあたりの遅延（秒）")
+    parser.add_argument("--timeout", type=float, default=60, help="返信を待つ最大時間（秒）")
+    parser.add_argument("--settle", type=float, default=0.5, help="集計前に待つ時間（秒）")
+    asyncio.run(main(parser.parse_args()))
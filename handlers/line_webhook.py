@@ -1,16 +1,46 @@
-from linebot import LineBotApi
+import asyncio
+import logging
+from contextlib import nullcontext
 from linebot.models import TextSendMessage
 from services.user_service import UserService
-from services.ai_service import AIService
+from services.admission import Admission, AdmissionController
+from services.ai_service import AIService, PromptContext
 from linebot.exceptions import LineBotApiError
-from services.stripe_service import StripeService
+from services.message_splitter import LineBubbleSplitter
+from services.summary_service import SummaryService
+from services.line_messaging_client import LineMessagingClient
+from services.metrics import MESSAGES, span
+from typing import Optional
+
+logger = logging.getLogger(__name__)
 
 class LineWebhookHandler:
-    def __init__(self, line_bot_api: LineBotApi, user_service: UserService, ai_service: AIService):
-        self.line_bot_api = line_bot_api
+    RATE_LIMITED_MESSAGE = """🤖「メッセージの送信が続いています！
+少し時間をおいてから、もう一度送ってね。⏳」"""
+    OVERLOADED_MESSAGE = """🤖「ただいま相談が混み合っています🙇
+少し時間をおいてから、もう一度送ってね。」"""
+    # このメッセージには相談の代わりに再登録用のリンクを返す
+    SUBSCRIBE_KEYWORD = "サブスク"
+    CHECKOUT_LINK_MESSAGE = """🤖「サブスクの登録はこちらからどうぞ！✨
+👉【登録はこちら】{url}」"""
+    ALREADY_SUBSCRIBED_MESSAGE = """🤖「サブスクはすでに登録済みです！
+このまま無制限で相談できます。✨」"""
+    CHECKOUT_UNAVAILABLE_MESSAGE = """🤖「登録用のリンクを用意できませんでした🙇
+少し時間をおいてから、「サブスク」と送ってね。」"""
+
+    def __init__(
+        self,
+        line_client: LineMessagingClient,
+        user_service: UserService,
+        ai_service: AIService,
+        summary_service: Optional[SummaryService] = None,
+        admission: Optional[AdmissionController] = None
+    ):
+        self.line_client = line_client
         self.user_service = user_service
         self.ai_service = ai_service
-        self.stripe_service = StripeService()
+        self.summary_service = summary_service
+        self.admission = admission  # 指定時は送信頻度とLLMの同時実行数を制限
 
     async def handle_message(self, event):
         """メッセージイベントを処理"""
@@ -20,31 +50,136 @@ class LineWebhookHandler:
         try:
             user_id = event.source.user_id
             message_text = event.message.text
-            print(f"Processing message: {message_text} from user: {user_id}")
+            logger.debug("Processing message from user: %s", user_id)
+
+            # 送りすぎのユーザーや過負荷時は、Firestore・LLMを使う前に定型文で応答
+            if self.admission:
+                admission = await self.admission.admit(user_id)
+                if admission != Admission.ADMITTED:
+                    await self._reply_rejected(event, admission)
+                    return
+
+            if message_text.strip() == self.SUBSCRIBE_KEYWORD:
+                if await self.user_service.is_subscribed(user_id):
+                    reply = TextSendMessage(text=self.ALREADY_SUBSCRIBED_MESSAGE)
+                else:
+                    reply = await self._checkout_link_message(user_id)
+                await self.line_client.reply_message(event.reply_token, reply)
+                MESSAGES.labels("checkout_link").inc()
+                return
 
-            # 通常のメッセージ処理
-            limit_message = await self.user_service.handle_message(user_id, message_text, "default")
+            # 相談可否の判定と並行して、応答に使う要約・会話履歴を先読みする
+            prefetch = asyncio.create_task(
+                self.ai_service.prefetch_context(user_id, "default", self.ai_service.DEFAULT_CHARACTER)
+            )
+            try:
+                with span("can_consult"):
+                    limit_message = await self.user_service.handle_message(user_id, message_text, "default")
+            except BaseException:
+                prefetch.cancel()
+                raise
             if limit_message:
-                self.line_bot_api.reply_message(
+                # 相談できない場合は先読みを取り消す
+                prefetch.cancel()
+                # 期限切れの案内にURLを載せられなかった場合は、返信の後に作成を待ってから送る
+                follow_up = self.user_service.needs_checkout_link_followup(limit_message)
+                await self.line_client.reply_message(
                     event.reply_token,
                     TextSendMessage(text=limit_message)
                 )
+                MESSAGES.labels("limited").inc()
+                if follow_up:
+                    await self.line_client.push_message(user_id, await self._checkout_link_message(user_id))
                 return
+            context = await prefetch
 
-            # AIレスポンスを生成（ユーザーIDを渡す）
-            response = await self.ai_service.generate_response(message_text, user_id, "default")
-            self.line_bot_api.reply_message(
-                event.reply_token,
-                TextSendMessage(text=response)
-            )
+            async with self.admission.llm_slot() if self.admission else nullcontext():
+                if self.ai_service.streaming_enabled:
+                    response = await self._reply_streaming(event, message_text, user_id, context)
+                else:
+                    # AIレスポンスを生成（ユーザーIDを渡す）
+                    response = await self.ai_service.generate_response(message_text, user_id, "default", context=context)
+                    await self.line_client.reply_message(
+                        event.reply_token,
+                        TextSendMessage(text=response)
+                    )
+
+            # 返信後にユーザーのメッセージと応答をまとめて保存
+            if response != self.ai_service.ERROR_MESSAGE:
+                with span("add_message"):
+                    await self.user_service.record_turn(user_id, "default", message_text, response)
+                MESSAGES.labels("replied").inc()
+            else:
+                MESSAGES.labels("ai_error").inc()
+
+            # 古い会話の要約は応答後にバックグラウンドで行う
+            if self.summary_service:
+                self.summary_service.schedule(user_id, "default")
 
         except Exception as e:
-            print(f"Error handling message: {e}")
-            self.line_bot_api.reply_message(
+            logger.exception("Error handling message: %s", e)
+            MESSAGES.labels("error").inc()
+            await self.line_client.reply_message(
                 event.reply_token,
                 TextSendMessage(text="申し訳ありません。エラーが発生しました。")
             )
 
+    async def _checkout_link_message(self, user_id: str) -> TextSendMessage:
+        """再登録用のURLを載せたメッセージ（作成に失敗した場合は時間をおいて送り直す案内）"""
+        url = await self.user_service.get_checkout_link(user_id)
+        text = self.CHECKOUT_LINK_MESSAGE.format(url=url) if url else self.CHECKOUT_UNAVAILABLE_MESSAGE
+        return TextSendMessage(text=text)
+
+    async def _reply_rejected(self, event, admission: str) -> None:
+        text = self.RATE_LIMITED_MESSAGE if admission == Admission.RATE_LIMITED else self.OVERLOADED_MESSAGE
+        await self.line_client.reply_message(event.reply_token, TextSendMessage(text=text))
+        MESSAGES.labels(admission).inc()
+
+    async def reply_overloaded(self, event) -> None:
+        """イベントキューが溜まっているときに、処理せず定型文で応答"""
+        if self.admission:
+            self.admission.record_shed()
+        await self._reply_rejected(event, Admission.SHED)
+
+    async def _reply_streaming(self, event, message_text: str, user_id: str, context: Optional[PromptContext] = None) -> str:
+        """ストリーミング応答を文単位で送信（1通目はreply、2通目以降はpush）"""
+        splitter = LineBubbleSplitter()
+        # 実際に送信できた吹き出し（会話履歴にはユーザーに届いた内容だけを記録する）
+        delivered = []
+        chunks = []
+
+        async def deliver(bubble: str) -> None:
+            if not delivered:
+                await self.line_client.reply_message(event.reply_token, TextSendMessage(text=bubble))
+            else:
+                await self.line_client.push_message(user_id, TextSendMessage(text=bubble))
+            delivered.append(bubble)
+
+        try:
+            async for delta in self.ai_service.stream_response(message_text, user_id, "default", context=context):
+                chunks.append(delta)
+                for bubble in splitter.feed(delta):
+                    await deliver(bubble)
+            for bubble in splitter.flush():
+                await deliver(bubble)
+            if delivered:
+                return "".join(chunks)
+        except Exception:
+            # 1通も送れていなければ呼び出し元でエラーメッセージを返信する
+            if not delivered:
+                raise
+            logger.warning("Streaming interrupted after %s messages for user: %s", len(delivered), user_id)
+            # 途中まで生成された文を最後の吹き出しとして送る（送れなければ届いた分だけを返す）
+            try:
+                for bubble in splitter.flush():
+                    await deliver(bubble)
+            except Exception as e:
+                logger.warning("Error delivering remaining text for user %s: %s", user_id, e)
+
+        if not delivered:
+            raise RuntimeError("Empty streaming response")
+        return "\n".join(delivered)
+
     async def send_subscription_success_message(self, user_id: str) -> None:
         """サブスクリプション開始時のメッセージを送信"""
         try:
@@ -56,12 +191,12 @@ class LineWebhookHandler:
 💡 サブスクリプションの有効期限が近づいた際は、
 自動的にお知らせいたします。"""
 
-            self.line_bot_api.push_message(
+            await self.line_client.push_message(
                 user_id,
                 TextSendMessage(text=message)
             )
         except Exception as e:
-            print(f"Error sending subscription success message: {e}")
+            logger.error("Error sending subscription success message: %s", e)
 
     async def send_subscription_cancelled_message(self, user_id: str) -> None:
         """サブスクリプション終了時のメッセージを送信"""
@@ -71,12 +206,12 @@ class LineWebhookHandler:
 これより無料プランとなり、
 1日1回までの相談制限が適用されます。"""
 
-            self.line_bot_api.push_message(
+            await self.line_client.push_message(
                 user_id,
                 TextSendMessage(text=message)
             )
         except Exception as e:
-            print(f"Error sending subscription cancelled message: {e}")
+            logger.error("Error sending subscription cancelled message: %s", e)
 
     async def handle_membership_event(self, user_id: str, is_active: bool) -> None:
         """メンバーシップの状態変更を処理"""
@@ -86,5 +221,5 @@ class LineWebhookHandler:
             else:
                 await self.send_subscription_cancelled_message(user_id)
         except Exception as e:
-            print(f"Error handling membership event: {e}")
+            logger.error("Error handling membership event: %s", e)
             raise 
\ No newline at end of file
@@ -1,42 +1,111 @@
+import asyncio
+import logging
+import weakref
 import stripe
 from models.user import User
-from datetime import datetime
+from datetime import datetime, timezone
 import os
 from services.user_service import UserService
 from handlers.line_webhook import LineWebhookHandler
 from linebot.models import TextSendMessage
+from services.dedup_store import DedupStore
+from services.work_queue import WorkQueue
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
 
 class StripeWebhookHandler:
-    def __init__(self, user_service: UserService, line_handler: LineWebhookHandler):
+    def __init__(
+        self,
+        user_service: UserService,
+        line_handler: LineWebhookHandler,
+        dedup_store: Optional[DedupStore] = None,
+        notification_queue: Optional[WorkQueue] = None,
+        max_attempts: int = 3,
+        retry_backoff: float = 0.5
+    ):
         self.stripe = stripe
         self.stripe.api_key = os.getenv('STRIPE_SECRET_KEY')
         self.webhook_secret = os.getenv('STRIPE_WEBHOOK_SECRET')
         self.user_service = user_service
         self.line_handler = line_handler
+        self.dedup_store = dedup_store
+        # 指定時はLINEへの通知をキューに積み、Webhookの応答を待たせない
+        self.notification_queue = notification_queue
+        self.max_attempts = max(1, max_attempts)
+        self.retry_backoff = retry_backoff
+        # 同じ顧客のイベントは1つずつ処理する（処理中のイベントがなくなればロックは消える）
+        self._customer_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
         self.PRICE_ID_TO_TYPE = {
             os.getenv('STRIPE_PRICE_ID_month'): 'monthly',
             os.getenv('STRIPE_PRICE_ID_year'): 'yearly'
         }
 
     async def handle_webhook(self, payload, sig_header):
+        """署名を検証し、ユーザー情報の更新まで終えてから返す（失敗時は例外を送出し、Stripeに再送させる）"""
         try:
             event = stripe.Webhook.construct_event(
                 payload, sig_header, self.webhook_secret
             )
 
-            # イベントタイプに応じて処理
-            if event['type'] == 'checkout.session.completed':
-                await self._handle_checkout_completed(event['data']['object'])
-            elif event['type'] == 'customer.subscription.deleted':
-                await self._handle_subscription_deleted(event['data']['object'])
-            elif event['type'] == 'customer.subscription.updated':
-                await self._handle_subscription_updated(event['data']['object'])
+            # 再送されたイベントは処理しない
+            if self.dedup_store and not await self.dedup_store.mark_seen(f"stripe:{event['id']}"):
+                logger.info("Skipping duplicate Stripe event %s", event['id'])
+                return
+
+            # 応答前にFirestoreへ書き込む（応答後に落ちても、未処理のイベントは再送される）
+            await self.process_event(event)
 
         except Exception as e:
-            print(f'Error handling webhook: {str(e)}')
+            logger.error("Error handling webhook: %s", str(e))
             raise
 
-    async def _handle_checkout_completed(self, session):
+    async def process_event(self, event) -> None:
+        """イベントを処理（一時的な失敗は数回再試行し、最後まで失敗したら再送時に処理できるよう記録を消す）
+
+        同じ顧客のイベントはプロセス内で1つずつ処理し、ユーザーには反映したイベントの作成時刻を残す。
+        Stripeは順序を保証しないため、それより古いイベントが遅れて届いても新しい状態は上書きしない。
+        """
+        customer = event['data']['object'].get('customer')
+        if not customer:
+            await self._process_event(event)
+            return
+        lock = self._customer_locks.get(customer)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._customer_locks[customer] = lock
+        async with lock:
+            await self._process_event(event)
+
+    async def _process_event(self, event) -> None:
+        created = event.get('created')
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                # イベントタイプに応じて処理
+                if event['type'] == 'checkout.session.completed':
+                    await self._handle_checkout_completed(event['data']['object'], created)
+                elif event['type'] == 'customer.subscription.deleted':
+                    await self._handle_subscription_deleted(event['data']['object'], created)
+                elif event['type'] == 'customer.subscription.updated':
+                    await self._handle_subscription_updated(event['data']['object'], created)
+                return
+            except Exception as e:
+                if attempt < self.max_attempts:
+                    logger.warning("Retrying Stripe event %s (attempt %s): %s", event['id'], attempt, e)
+                    await asyncio.sleep(self.retry_backoff * 2 ** (attempt - 1))
+                    continue
+                if self.dedup_store:
+                    await self.dedup_store.forget(f"stripe:{event['id']}")
+                raise
+
+    async def _notify(self, send, user_id: str) -> None:
+        """LINEへの通知を送る（通知キューがあればイベント処理を待たせずに送る）"""
+        if self.notification_queue is not None and self.notification_queue.submit(send, user_id, key=user_id):
+            return
+        await send(user_id)
+
+    async def _handle_checkout_completed(self, session, created: Optional[int] = None):
         try:
             # セッションからユーザーIDとサブスクリプション情報を取得
             user_id = session.get('client_reference_id')
@@ -44,46 +113,52 @@ class StripeWebhookHandler:
             price_id = session.get('line_items', {}).get('data', [{}])[0].get('price', {}).get('id')
 
             if not user_id or not subscription_id:
-                print('Missing user_id or subscription_id in session')
+                logger.warning("Missing user_id or subscription_id in session")
                 return
 
             # サブスクリプションタイプを決定
             subscription_type = self.PRICE_ID_TO_TYPE.get(price_id, 'monthly')
 
-            # ユーザーのサブスクリプション情報を更新
-            await self.user_service.update_subscription(user_id, subscription_type)
-            
+            # ユーザーのサブスクリプション情報を1回の書き込みで更新
+            applied = await self.user_service.update_subscription(
+                user_id, subscription_type, subscription_id=subscription_id, customer_id=session.get('customer'),
+                event_created=created
+            )
+            if not applied:
+                return
+
             # LINEメッセージを送信
-            await self.line_handler.send_subscription_success_message(user_id)
+            await self._notify(self.line_handler.send_subscription_success_message, user_id)
 
         except Exception as e:
-            print(f'Error handling checkout completed: {str(e)}')
+            logger.error("Error handling checkout completed: %s", str(e))
             raise
 
-    async def _handle_subscription_deleted(self, subscription):
+    async def _handle_subscription_deleted(self, subscription, created: Optional[int] = None):
         try:
             # メタデータからユーザーIDを取得
             user_id = subscription.get('metadata', {}).get('user_id')
             if not user_id:
-                print('Missing user_id in subscription metadata')
+                logger.warning("Missing user_id in subscription metadata")
                 return
 
             # サブスクリプションを無効化
-            await self.user_service.deactivate_subscription(user_id)
-            
+            if not await self.user_service.deactivate_subscription(user_id, event_created=created):
+                return
+
             # LINEメッセージを送信
-            await self.line_handler.send_subscription_cancelled_message(user_id)
+            await self._notify(self.line_handler.send_subscription_cancelled_message, user_id)
 
         except Exception as e:
-            print(f'Error handling subscription deleted: {str(e)}')
+            logger.error("Error handling subscription deleted: %s", str(e))
             raise
 
-    async def _handle_subscription_updated(self, subscription):
+    async def _handle_subscription_updated(self, subscription, created: Optional[int] = None):
         try:
             # メタデータからユーザーIDを取得
             user_id = subscription.get('metadata', {}).get('user_id')
             if not user_id:
-                print('Missing user_id in subscription metadata')
+                logger.warning("Missing user_id in subscription metadata")
                 return
 
             # サブスクリプションの状態をチェック
@@ -92,10 +167,19 @@ class StripeWebhookHandler:
             subscription_type = self.PRICE_ID_TO_TYPE.get(price_id, 'monthly')
 
             if status == 'active':
-                await self.user_service.update_subscription(user_id, subscription_type)
+                # 請求期間の終了日時と自動更新の有無はStripeの値を使う（更新のたびにこのイベントが届く）
+                period_end = subscription.get('current_period_end')
+                await self.user_service.update_subscription(
+                    user_id, subscription_type,
+                    subscription_id=subscription.get('id'),
+                    customer_id=subscription.get('customer'),
+                    current_period_end=datetime.fromtimestamp(period_end, tz=timezone.utc) if period_end else None,
+                    auto_renew=not subscription.get('cancel_at_period_end', False),
+                    event_created=created
+                )
             elif status in ['canceled', 'unpaid']:
-                await self.user_service.deactivate_subscription(user_id)
+                await self.user_service.deactivate_subscription(user_id, event_created=created)
 
         except Exception as e:
-            print(f'Error handling subscription updated: {str(e)}')
+            logger.error("Error handling subscription updated: %s", str(e))
             raise 
\ No newline at end of file
@@ -29,21 +29,24 @@ class Message:
         )
 
 class Summary:
-    def __init__(self, text: str, timestamp: datetime = None):
+    def __init__(self, text: str, timestamp: datetime = None, covered_until: datetime = None):
         self.text = text
         self.timestamp = timestamp or datetime.now()
+        self.covered_until = covered_until or self.timestamp  # 要約に含まれる最後のメッセージの日時
 
     def to_dict(self) -> Dict[str, Any]:
         return {
             'text': self.text,
-            'timestamp': self.timestamp
+            'timestamp': self.timestamp,
+            'covered_until': self.covered_until
         }
 
     @staticmethod
     def from_dict(data: Dict[str, Any]) -> 'Summary':
         return Summary(
             text=data['text'],
-            timestamp=data['timestamp']
+            timestamp=data['timestamp'],
+            covered_until=data.get('covered_until')
         )
 
 class Conversation:
@@ -0,0 +1,156 @@
+import asyncio
+import time
+from abc import ABC, abstractmethod
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+from typing import AsyncIterator, Dict, Optional, Tuple
+
+from google.cloud.firestore import Client, transactional
+from services.firestore_client import AsyncFirestore
+from services.lru_cache import TTLCache
+from services.work_queue import WorkQueue
+
+
+class RateLimitBackend(ABC):
+    """ユーザーごとのトークンバケットを保持するバックエンド"""
+
+    @abstractmethod
+    async def try_acquire(self, key: str, rate: float, burst: float) -> bool:
+        """トークンを1つ取得できればTrue（rateは1秒あたりの補充数、burstはバケットの容量）"""
+
+
+class InMemoryRateLimitBackend(RateLimitBackend):
+    """プロセス内でトークンバケットを保持（単一インスタンス向け、古いバケットはLRUで破棄）"""
+
+    def __init__(self, max_entries: int = 100000):
+        # key -> (残りのトークン数, 更新したmonotonic時刻)
+        self._buckets: TTLCache[Tuple[float, float]] = TTLCache(max_entries)
+
+    async def try_acquire(self, key: str, rate: float, burst: float) -> bool:
+        now = time.monotonic()
+        # 破棄されたバケットは満タンとして扱われる（しばらく送信のないユーザーと同じ）
+        tokens, updated = self._buckets.peek(key) or (burst, now)
+        tokens = min(burst, tokens + (now - updated) * rate)
+        allowed = tokens >= 1
+        self._buckets.set(key, (tokens - 1 if allowed else tokens, now))
+        return allowed
+
+
+class FirestoreRateLimitBackend(RateLimitBackend):
+    """Firestoreのトランザクションでトークンバケットを共有（複数インスタンス向け）
+
+    1回の判定で読み込みと書き込みが1回ずつ増える。expires_atにTTLポリシーを設定すると古いバケットが削除される。
+    """
+
+    def __init__(self, db: Client, firestore: AsyncFirestore, collection: str = 'rate_limits'):
+        self.db = db
+        self.firestore = firestore
+        self.limits_ref = db.collection(collection)
+
+    def _take(self, key: str, rate: float, burst: float) -> bool:
+        doc_ref = self.limits_ref.document(key.replace('/', '_'))
+
+        @transactional
+        def take(transaction) -> bool:
+            snapshot = doc_ref.get(transaction=transaction)
+            data = snapshot.to_dict() if snapshot.exists else {}
+            now = time.time()
+            tokens = min(burst, data.get('tokens', burst) + (now - data.get('updated', now)) * rate)
+            allowed = tokens >= 1
+            transaction.set(doc_ref, {
+                'tokens': tokens - 1 if allowed else tokens,
+                'updated': now,
+                'expires_at': datetime.now(timezone.utc) + timedelta(seconds=burst / rate if rate > 0 else 3600)
+            })
+            return allowed
+
+        return take(self.db.transaction())
+
+    async def try_acquire(self, key: str, rate: float, burst: float) -> bool:
+        return await self.firestore.run(self._take, key, rate, burst)
+
+
+class Admission:
+    """受け付け判定の結果"""
+    ADMITTED = "admitted"
+    RATE_LIMITED = "rate_limited"
+    SHED = "shed"
+
+
+class AdmissionController:
+    """LLM呼び出しの前段で、ユーザーごとの送信頻度とプロセス全体の同時実行数を制限する
+
+    - ユーザーごとのトークンバケット（1分あたりrate_per_minute通、連続burst通まで）
+    - LLM呼び出しの同時実行数（max_llm_concurrency、ワーカープロセスごと）
+      LLMはイベントキューのワーカーから呼ばれるため、ワーカー数より大きい値は意味を持たない。
+      Noneならワーカー数と同じにし、ワーカー数より小さくすると残りのワーカーはLLMの空きを待つ
+      （待ちがmax_llm_waitingに達したら新しいメッセージは定型文で応答する）。
+    - イベントキューやLLMの待ちが溜まっているときは処理せず定型文で応答する（ロードシェディング）
+    """
+
+    def __init__(
+        self,
+        backend: RateLimitBackend,
+        rate_per_minute: float = 10,
+        burst: float = 5,
+        max_llm_concurrency: Optional[int] = None,
+        max_llm_waiting: int = 32,
+        event_queue: Optional[WorkQueue] = None,
+        shed_queue_depth: Optional[int] = None
+    ):
+        self.backend = backend
+        self.rate = rate_per_minute / 60
+        self.burst = burst
+        if event_queue is not None:
+            max_llm_concurrency = min(max_llm_concurrency or event_queue.worker_count, event_queue.worker_count)
+        self.max_llm_concurrency = max(1, max_llm_concurrency or 16)
+        self.max_llm_waiting = max_llm_waiting
+        self.event_queue = event_queue
+        self.shed_queue_depth = shed_queue_depth
+        self._llm_semaphore = asyncio.Semaphore(self.max_llm_concurrency)
+        self._llm_in_flight = 0
+        self._llm_waiting = 0
+        self.stats: Dict[str, int] = {Admission.ADMITTED: 0, Admission.RATE_LIMITED: 0, Admission.SHED: 0}
+
+    def should_shed(self) -> bool:
+        """イベントキューが溜まりすぎていれば、新しいイベントを処理せずに定型文で応答する"""
+        if self.event_queue is None or self.shed_queue_depth is None:
+            return False
+        return self.event_queue.depth >= self.shed_queue_depth
+
+    def record_shed(self) -> None:
+        self.stats[Admission.SHED] += 1
+
+    async def admit(self, user_id: str) -> str:
+        """ユーザーの送信頻度とLLMの待ち行列を確認（Firestoreの読み書きより前に呼ぶ）"""
+        if self._llm_in_flight >= self.max_llm_concurrency and self._llm_waiting >= self.max_llm_waiting:
+            result = Admission.SHED
+        elif not await self.backend.try_acquire(f"user:{user_id}", self.rate, self.burst):
+            result = Admission.RATE_LIMITED
+        else:
+            result = Admission.ADMITTED
+        self.stats[result] += 1
+        return result
+
+    @asynccontextmanager
+    async def llm_slot(self) -> AsyncIterator[None]:
+        """LLM呼び出しの同時実行数を制限（空きが出るまで待つ）"""
+        self._llm_waiting += 1
+        try:
+            await self._llm_semaphore.acquire()
+        finally:
+            self._llm_waiting -= 1
+        self._llm_in_flight += 1
+        try:
+            yield
+        finally:
+            self._llm_in_flight -= 1
+            self._llm_semaphore.release()
+
+    def get_stats(self) -> Dict[str, int]:
+        return {
+            **self.stats,
+            'llm_in_flight': self._llm_in_flight,
+            'llm_waiting': self._llm_waiting,
+            'max_llm_concurrency': self.max_llm_concurrency
+        }
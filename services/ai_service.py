@@ -1,21 +1,45 @@
+import logging
 import os
 import json
+import asyncio
+import time
 import httpx
-from typing import List, Optional, Dict, Any, TYPE_CHECKING
-from models.conversation import Message
+from typing import AsyncIterator, List, Optional, Dict, Any, Tuple, TYPE_CHECKING
+from models.conversation import Message, Summary
 import re
 from services.conversation_service import ConversationService
-from services.prompt_service import PromptService
+from services.prompt_service import CharacterPrefix, PromptService
+from services.prompt_builder import BuiltPrompt, PromptBuilder, estimate_message_tokens, estimate_tokens, get_token_budget
+from services.response_cache import CacheKey, ResponseCache
+from services.http_client import PooledHttpClient
+from services.metrics import LLM_TOKENS, STAGE_SECONDS, span
+
+logger = logging.getLogger(__name__)
 
 # 型チェック時のみインポートする（実行時には評価されない）
 if TYPE_CHECKING:
     from services.conversation_service import ConversationService
 
-class AIService:
-    def __init__(self, conversation_service: ConversationService):
+class PromptContext:
+    """プロンプトの組み立てに使う、会話ごとに取得するデータ"""
+
+    def __init__(self, prefix: Optional[CharacterPrefix], summaries: List[Summary], history: List[Message]):
+        self.prefix = prefix
+        self.summaries = summaries
+        self.history = history
+
+
+class AIService(PooledHttpClient):
+    ERROR_MESSAGE = "申し訳ありません。エラーが発生しました。"
+    DEFAULT_CHARACTER = "ojou"
+
+    def __init__(self, conversation_service: ConversationService, response_cache: Optional[ResponseCache] = None):
         self.conversation_service = conversation_service
+        self.response_cache = response_cache  # 指定時は会話の始めの短いメッセージへの応答を使い回す
         self.prompt_service = PromptService()
-        self.api_url = "https://openrouter.ai/api/v1/chat/completions"
+        self.api_url = os.getenv("OPENROUTER_API_URL", "https://openrouter.ai/api/v1/chat/completions")
+        # readinessチェックで呼ぶAPIキー情報のエンドポイント
+        self.health_url = os.getenv("OPENROUTER_HEALTH_URL", self.api_url.rsplit("/chat/completions", 1)[0] + "/key")
         self.api_key = os.getenv("OPENROUTER_API_KEY")
         self.headers = {
             "Authorization": f"Bearer {self.api_key}",
@@ -23,6 +47,69 @@ class AIService:
             "Content-Type": "application/json"
         }
         self.user_names = {}  # ユーザーの名前を保存する辞書
+        self.model = os.getenv("OPENROUTER_MODEL", "anthropic/claude-3-haiku")
+        self.prompt_builder = PromptBuilder(get_token_budget(self.model))
+        # Anthropicのモデルでは固定プレフィックスにcache_controlを付けてプロンプトキャッシュを使う
+        self.prompt_cache_control = os.getenv(
+            "PROMPT_CACHE_CONTROL", "true" if self.model.startswith("anthropic/") else "false"
+        ).lower() == "true"
+        self.prompt_stats: Dict[str, Any] = {'count': 0, 'total_tokens': 0, 'last_tokens': 0, 'max_tokens': 0, 'dropped_messages': 0, 'over_budget': 0}
+
+        # OpenRouter接続の設定（接続はプロセス内で使い回す）
+        super().__init__(
+            max_retries=int(os.getenv("OPENROUTER_MAX_RETRIES", 3)),
+            retry_base_delay=float(os.getenv("OPENROUTER_RETRY_BASE_DELAY", 0.5)),
+            retry_max_delay=float(os.getenv("OPENROUTER_RETRY_MAX_DELAY", 8.0))
+        )
+
+        # ストリーミング応答の設定とTTFB（最初のトークンまでの時間）の統計
+        self.streaming_enabled = os.getenv("OPENROUTER_STREAMING", "false").lower() == "true"
+        self.ttfb_stats: Dict[str, Any] = {'count': 0, 'total_seconds': 0.0, 'last_seconds': 0.0, 'max_seconds': 0.0}
+
+    def _create_client(self) -> httpx.AsyncClient:
+        """接続プール付きのHTTPクライアントを作成"""
+        limits = httpx.Limits(
+            max_connections=int(os.getenv("OPENROUTER_MAX_CONNECTIONS", 100)),
+            max_keepalive_connections=int(os.getenv("OPENROUTER_MAX_KEEPALIVE_CONNECTIONS", 20)),
+            keepalive_expiry=float(os.getenv("OPENROUTER_KEEPALIVE_EXPIRY", 60))
+        )
+        timeout = httpx.Timeout(
+            connect=float(os.getenv("OPENROUTER_CONNECT_TIMEOUT", 5)),
+            read=float(os.getenv("OPENROUTER_READ_TIMEOUT", 60)),
+            write=10.0,
+            pool=10.0
+        )
+        return httpx.AsyncClient(
+            http2=os.getenv("OPENROUTER_HTTP2", "true").lower() == "true",
+            limits=limits,
+            timeout=timeout,
+            headers=self.headers
+        )
+
+    async def check_health(self) -> None:
+        """OpenRouterへの接続とAPIキーを確認（失敗時は例外）"""
+        response = await self.client.get(self.health_url)
+        response.raise_for_status()
+
+    async def _post_completion(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        """OpenRouterにリクエストを送信（429/5xxと接続エラーはリトライ）"""
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = await self.client.post(self.api_url, json=payload)
+            except (httpx.ConnectError, httpx.ConnectTimeout, httpx.RemoteProtocolError) as e:
+                if attempt >= self.max_retries:
+                    raise
+                logger.warning("OpenRouter connection error, retrying (%s/%s): %s", attempt + 1, self.max_retries, e)
+                await asyncio.sleep(self._retry_delay(attempt))
+                continue
+
+            if (response.status_code == 429 or response.status_code >= 500) and attempt < self.max_retries:
+                logger.warning("OpenRouter returned %s, retrying (%s/%s)", response.status_code, attempt + 1, self.max_retries)
+                await asyncio.sleep(self._retry_delay(attempt, response))
+                continue
+
+            response.raise_for_status()
+            return response.json()
 
     def _extract_name(self, message: str) -> Optional[str]:
         """メッセージから名前を抽出する試み"""
@@ -42,66 +129,211 @@ class AIService:
                     return name
         return None
 
-    async def generate_response(self, message_text: str, user_id: str, conversation_id: str, character: str = "ojou") -> str:
+    async def prefetch_context(self, user_id: str, conversation_id: str, character: str) -> PromptContext:
+        """最新の要約・直近の会話履歴・固定プレフィックスを並行して取得
+
+        相談可否の判定と同時に開始でき、判定で弾かれた場合はタスクをキャンセルすればよい。
+        """
+        summaries, history = await asyncio.gather(
+            self.conversation_service.get_summaries(user_id, conversation_id, limit=1),
+            self.conversation_service.get_messages(user_id, conversation_id)
+        )
+        return PromptContext(self.prompt_service.get_prefix(character), summaries, history)
+
+    async def _build_prompt(self, message_text: str, user_id: str, conversation_id: str, character: str,
+                            context: Optional[PromptContext] = None) -> BuiltPrompt:
+        """トークン予算内でモデルに送るメッセージ列を組み立てる（contextは先読み済みのデータ）"""
+        if context is None:
+            context = await self.prefetch_context(user_id, conversation_id, character)
+
+        # 固定部分（システムメッセージ、指示メッセージ、会話例）は読み込み時に組み立て済み
+        prefix = context.prefix
+        head = list(prefix.get_messages(cache_control=self.prompt_cache_control)) if prefix else []
+        head_tokens = prefix.token_count if prefix else 0
+
+        summaries = context.summaries
+        if summaries:
+            summary_message = {
+                "role": "system",
+                "content": f"これまでの相談内容の要約:\n{summaries[0].text}"
+            }
+            head.append(summary_message)
+            head_tokens += estimate_message_tokens(summary_message)
+
+        history_messages = [
+            {"role": msg.role, "content": msg.content or msg.text}
+            for msg in context.history
+        ]
+        
+        # ユーザー名情報と新しいメッセージは必ず含める
+        tail = []
+        if user_id in self.user_names:
+            tail.append({
+                "role": "system",
+                "content": f"相談者の名前は「{self.user_names[user_id]}」です。親しみを込めて呼びかけてください。"
+            })
+        tail.append({
+            "role": "user",
+            "content": message_text
+        })
+
+        prompt = self.prompt_builder.build(head, history_messages, tail, head_tokens=head_tokens)
+        self._record_prompt(prompt)
+        return prompt
+
+    def _remember_name(self, message_text: str, user_id: str) -> None:
+        """メッセージから名前を抽出して保存（キャッシュキーとプロンプトの両方で使う）"""
+        extracted_name = self._extract_name(message_text)
+        if extracted_name:
+            self.user_names[user_id] = extracted_name
+
+    def _cached_response(self, message_text: str, user_id: str, character: str,
+                         context: PromptContext) -> Tuple[Optional[CacheKey], Optional[str]]:
+        """応答を使い回せる場合のキャッシュキーとキャッシュ済みの応答（要約がある会話には使わない）"""
+        if self.response_cache is None or context.summaries:
+            return None, None
+        cache_key = self.response_cache.key(character, message_text, context.history, self.user_names.get(user_id))
+        if cache_key is None:
+            return None, None
+        return cache_key, self.response_cache.get(cache_key)
+
+    def _record_prompt(self, prompt: BuiltPrompt) -> None:
+        """プロンプトのトークン数を記録"""
+        stats = self.prompt_stats
+        stats['count'] += 1
+        stats['total_tokens'] += prompt.token_count
+        stats['last_tokens'] = prompt.token_count
+        stats['max_tokens'] = max(stats['max_tokens'], prompt.token_count)
+        stats['dropped_messages'] += prompt.dropped_messages
+        if prompt.over_budget:
+            stats['over_budget'] += 1
+        logger.debug("Prompt tokens: %s/%s (dropped %s history messages)", prompt.token_count, prompt.budget, prompt.dropped_messages)
+
+    async def generate_response(self, message_text: str, user_id: str, conversation_id: str, character: str = DEFAULT_CHARACTER,
+                                context: Optional[PromptContext] = None) -> str:
         """応答を生成"""
         try:
-            # 名前の抽出と保存
-            extracted_name = self._extract_name(message_text)
-            if extracted_name:
-                self.user_names[user_id] = extracted_name
-                
-            # プロンプトを準備
-            messages = []
-            
-            # システムメッセージを追加
-            messages.append(self.prompt_service.get_system_message(character))
-            
-            # 指示メッセージを追加
-            messages.append(self.prompt_service.get_instruction_message(character))
-            
-            # 会話例を追加
-            messages.extend(self.prompt_service.get_example_conversation(character))
-            
-            # 過去の会話履歴を取得
-            history = await self.conversation_service.get_messages(user_id, conversation_id)
-            for msg in history:
-                messages.append({
-                    "role": msg.role,
-                    "content": msg.content or msg.text
-                })
-            
-            # ユーザー名情報を追加（存在する場合）
-            if user_id in self.user_names:
-                messages.append({
-                    "role": "system",
-                    "content": f"相談者の名前は「{self.user_names[user_id]}」です。親しみを込めて呼びかけてください。"
-                })
-            
-            # 新しいメッセージを追加
-            messages.append({
-                "role": "user",
-                "content": message_text
-            })
+            if context is None:
+                context = await self.prefetch_context(user_id, conversation_id, character)
+            self._remember_name(message_text, user_id)
+            # キャッシュにある応答はプロンプトを組み立てずに返す
+            cache_key, cached = self._cached_response(message_text, user_id, character, context)
+            if cached is not None:
+                return cached
+            prompt = await self._build_prompt(message_text, user_id, conversation_id, character, context)
 
             # OpenRouter APIを呼び出し
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    self.api_url,
-                    headers=self.headers,
-                    json={
-                        "model": "anthropic/claude-3-haiku",
-                        "messages": messages,
-                        "temperature": 0.7,
-                        "max_tokens": 1000
-                    }
-                )
-                response.raise_for_status()
-                result = response.json()
-                return result["choices"][0]["message"]["content"]
+            with span("llm"):
+                result = await self._post_completion({
+                    "model": self.model,
+                    "messages": prompt.messages,
+                    "temperature": 0.7,
+                    "max_tokens": 1000
+                })
+            content = result["choices"][0]["message"]["content"]
+            logger.debug("OpenRouter completion %s for user: %s", result.get("id"), user_id)
+            self._record_tokens(prompt, content, result.get("usage"))
+            if cache_key is not None and content:
+                self.response_cache.put(cache_key, content)
+            return content
 
         except Exception as e:
-            print(f"Error generating response: {e}")
-            return "申し訳ありません。エラーが発生しました。"
+            logger.exception("Error generating response: %s", e)
+            return self.ERROR_MESSAGE
+
+    async def stream_response(self, message_text: str, user_id: str, conversation_id: str, character: str = DEFAULT_CHARACTER,
+                              context: Optional[PromptContext] = None) -> AsyncIterator[str]:
+        """応答をストリーミングで生成し、テキストの差分を順次返す"""
+        if context is None:
+            context = await self.prefetch_context(user_id, conversation_id, character)
+        self._remember_name(message_text, user_id)
+        # キャッシュにある応答はプロンプトを組み立てずに1回でまとめて返す
+        cache_key, cached = self._cached_response(message_text, user_id, character, context)
+        if cached is not None:
+            yield cached
+            return
+        prompt = await self._build_prompt(message_text, user_id, conversation_id, character, context)
+
+        payload = {
+            "model": self.model,
+            "messages": prompt.messages,
+            "temperature": 0.7,
+            "max_tokens": 1000,
+            "stream": True
+        }
+
+        started = time.perf_counter()
+        first_chunk = True
+        chunks = []
+        async for delta in self._stream_completion(payload):
+            if first_chunk:
+                self._record_ttfb(time.perf_counter() - started)
+                first_chunk = False
+            chunks.append(delta)
+            yield delta
+        content = "".join(chunks)
+        self._record_tokens(prompt, content)
+        if cache_key is not None and content:
+            self.response_cache.put(cache_key, content)
+
+    async def _stream_completion(self, payload: Dict[str, Any]) -> AsyncIterator[str]:
+        """OpenRouterのSSEストリームを読み、contentの差分を返す（最初の応答前のみリトライ）"""
+        for attempt in range(self.max_retries + 1):
+            async with self.client.stream("POST", self.api_url, json=payload) as response:
+                if (response.status_code == 429 or response.status_code >= 500) and attempt < self.max_retries:
+                    logger.warning("OpenRouter returned %s, retrying (%s/%s)", response.status_code, attempt + 1, self.max_retries)
+                    await asyncio.sleep(self._retry_delay(attempt, response))
+                    continue
+                response.raise_for_status()
+
+                async for line in response.aiter_lines():
+                    # ": OPENROUTER PROCESSING" などのコメント行は無視
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[len("data:"):].strip()
+                    if data == "[DONE]":
+                        return
+                    chunk = json.loads(data)
+                    if "error" in chunk:
+                        raise RuntimeError(f"OpenRouter stream error: {chunk['error']}")
+                    choices = chunk.get("choices") or [{}]
+                    delta = choices[0].get("delta", {}).get("content")
+                    if delta:
+                        yield delta
+                return
+
+    def _record_tokens(self, prompt: BuiltPrompt, content: str, usage: Optional[Dict[str, Any]] = None) -> None:
+        """入出力のトークン数を記録（OpenRouterのusageがなければ概算）"""
+        usage = usage or {}
+        LLM_TOKENS.labels("in").inc(usage.get("prompt_tokens") or prompt.token_count)
+        LLM_TOKENS.labels("out").inc(usage.get("completion_tokens") or estimate_tokens(content))
+
+    def _record_ttfb(self, seconds: float) -> None:
+        """ストリーミングの最初のトークンまでの時間を記録"""
+        STAGE_SECONDS.labels("llm_first_token").observe(seconds)
+        stats = self.ttfb_stats
+        stats['count'] += 1
+        stats['total_seconds'] += seconds
+        stats['last_seconds'] = seconds
+        stats['max_seconds'] = max(stats['max_seconds'], seconds)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """ストリーミングのTTFBとプロンプトのトークン数の統計"""
+        count = self.ttfb_stats['count']
+        prompt_count = self.prompt_stats['count']
+        return {
+            'streaming': self.streaming_enabled,
+            'response_cache': self.response_cache.get_stats() if self.response_cache else None,
+            'ttfb': {
+                **self.ttfb_stats,
+                'avg_seconds': self.ttfb_stats['total_seconds'] / count if count else 0.0
+            },
+            'prompt': {
+                **self.prompt_stats,
+                'budget': self.prompt_builder.budget,
+                'avg_tokens': self.prompt_stats['total_tokens'] / prompt_count if prompt_count else 0.0
+            }
+        }
 
     async def generate_summary(self, messages: List[Message]) -> str:
         """会話の要約を生成"""
@@ -112,23 +344,16 @@ class AIService:
 
             {conversation_text}"""
 
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    self.api_url,
-                    headers=self.headers,
-                    json={
-                        "model": "anthropic/claude-3-haiku",
-                        "messages": [{"role": "user", "content": prompt}],
-                        "temperature": 0.3,
-                        "max_tokens": 500
-                    }
-                )
-                response.raise_for_status()
-                result = response.json()
-                return result["choices"][0]["message"]["content"]
+            result = await self._post_completion({
+                "model": self.model,
+                "messages": [{"role": "user", "content": prompt}],
+                "temperature": 0.3,
+                "max_tokens": 500
+            })
+            return result["choices"][0]["message"]["content"]
 
         except Exception as e:
-            print(f"Error generating summary: {e}")
+            logger.error("Error generating summary: %s", e)
             raise
 
     async def combine_summaries(self, summaries: List[str]) -> str:
@@ -140,21 +365,14 @@ class AIService:
 
             {summaries_text}"""
 
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    self.api_url,
-                    headers=self.headers,
-                    json={
-                        "model": "anthropic/claude-3-haiku",
-                        "messages": [{"role": "user", "content": prompt}],
-                        "temperature": 0.3,
-                        "max_tokens": 500
-                    }
-                )
-                response.raise_for_status()
-                result = response.json()
-                return result["choices"][0]["message"]["content"]
+            result = await self._post_completion({
+                "model": self.model,
+                "messages": [{"role": "user", "content": prompt}],
+                "temperature": 0.3,
+                "max_tokens": 500
+            })
+            return result["choices"][0]["message"]["content"]
 
         except Exception as e:
-            print(f"Error combining summaries: {e}")
+            logger.error("Error combining summaries: %s", e)
             raise 
\ No newline at end of file
@@ -0,0 +1,121 @@
+import asyncio
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Dict, Optional, Tuple
+
+from services import metrics
+from services.lru_cache import TTLCache
+from services.stripe_service import StripeService
+
+logger = logging.getLogger(__name__)
+
+
+class CheckoutLinkProvider:
+    """ユーザー・プランごとのチェックアウトURLを事前に作成して保持する
+
+    Stripeの呼び出しは専用スレッドプールで行い、応答の作成中には待たない。
+    キャッシュにないときはバックグラウンドで作成を始め、Payment Link（設定時）を返す。
+    """
+
+    def __init__(
+        self,
+        stripe_service: StripeService,
+        session_ttl: int = 23 * 3600,
+        refresh_margin: float = 3600,
+        max_entries: int = 10000,
+        max_workers: int = 4
+    ):
+        self.stripe_service = stripe_service
+        self.session_ttl = session_ttl
+        self.refresh_margin = refresh_margin
+        # 再利用できるPayment Link（client_reference_idでユーザーを識別）
+        self.PAYMENT_LINKS = {
+            'month': os.getenv('STRIPE_PAYMENT_LINK_month'),
+            'year': os.getenv('STRIPE_PAYMENT_LINK_year')
+        }
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="stripe")
+        # (user_id, plan_type) -> URL（セッションの期限のrefresh_margin秒前に失効）
+        self._urls: TTLCache[str] = TTLCache(max_entries)
+        self._pending: Dict[Tuple[str, str], asyncio.Task] = {}
+        self.stats: Dict[str, int] = {'created': 0, 'errors': 0, 'fallbacks': 0}
+
+    def get_cached(self, user_id: str, plan_type: str = 'month') -> Optional[str]:
+        """すぐに使えるURLを返す（なければ作成を予約し、Payment LinkかNoneを返す）"""
+        url = self._urls.get((user_id, plan_type))
+        if url is not None:
+            return url
+
+        self.prewarm(user_id, plan_type)
+        payment_link = self.PAYMENT_LINKS.get(plan_type)
+        if payment_link:
+            self.stats['fallbacks'] += 1
+            return f"{payment_link}?client_reference_id={user_id}"
+        return None
+
+    def prewarm(self, user_id: str, plan_type: str = 'month') -> None:
+        """有効なURLがなければバックグラウンドで作成（同じキーの作成は1つにまとめる）"""
+        key = (user_id, plan_type)
+        if self._urls.peek(key) is not None or key in self._pending:
+            return
+        task = asyncio.get_running_loop().create_task(self._create(user_id, plan_type))
+        self._pending[key] = task
+        task.add_done_callback(lambda _: self._pending.pop(key, None))
+
+    def prewarm_if_expiring(self, user_id: str, subscription_end: Optional[datetime], window: float) -> None:
+        """サブスクの終了がwindow秒以内なら再登録用のURLを用意しておく"""
+        if subscription_end is None:
+            return
+        if subscription_end.tzinfo is None:
+            subscription_end = subscription_end.replace(tzinfo=timezone.utc)
+        if (subscription_end - datetime.now(timezone.utc)).total_seconds() <= window:
+            self.prewarm(user_id)
+
+    async def get(self, user_id: str, plan_type: str = 'month') -> Optional[str]:
+        """URLを取得（キャッシュになければStripeで作成するまで待つ）"""
+        key = (user_id, plan_type)
+        url = self._urls.get(key)
+        if url is not None:
+            return url
+        pending = self._pending.get(key)
+        if pending is not None:
+            return await asyncio.shield(pending)
+        return await self._create(user_id, plan_type)
+
+    async def _create(self, user_id: str, plan_type: str) -> Optional[str]:
+        loop = asyncio.get_running_loop()
+        try:
+            with metrics.span("stripe_checkout"):
+                result = await loop.run_in_executor(
+                    self._executor,
+                    self.stripe_service.create_checkout_session_with_expiry,
+                    user_id, plan_type, self.session_ttl
+                )
+        except Exception as e:
+            logger.error("Error prewarming checkout link: %s", e)
+            result = None
+        if result is None:
+            self.stats['errors'] += 1
+            return None
+
+        url, expires_at = result
+        self.stats['created'] += 1
+        # Stripeの期限は壁時計の時刻なので、残り時間に直して保存する
+        self._urls.set((user_id, plan_type), url, ttl=expires_at - self.refresh_margin - time.time())
+        return url
+
+    def invalidate(self, user_id: str) -> None:
+        """決済済み・再登録済みのユーザーのURLを破棄"""
+        for plan_type in list(self.PAYMENT_LINKS):
+            self._urls.pop((user_id, plan_type))
+
+    async def aclose(self) -> None:
+        """作成中のURLを待たずにスレッドプールを停止"""
+        for task in list(self._pending.values()):
+            task.cancel()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def get_stats(self) -> Dict[str, float]:
+        return {**self._urls.get_stats(), **self.stats, 'pending': len(self._pending)}
@@ -0,0 +1,245 @@
+import os
+from typing import Any, Dict, Iterable
+
+from google.cloud.firestore import Client
+from linebot import WebhookParser
+
+from handlers.line_webhook import LineWebhookHandler
+from handlers.stripe_webhook_handler import StripeWebhookHandler
+from services import metrics
+from services.admission import AdmissionController, FirestoreRateLimitBackend, InMemoryRateLimitBackend
+from services.ai_service import AIService
+from services.checkout_links import CheckoutLinkProvider
+from services.conversation_service import ConversationService
+from services.dedup_store import FirestoreDedupStore, InMemoryDedupStore
+from services.entitlement_cache import EntitlementCache
+from services.firestore_client import AsyncFirestore
+from services.health import HealthChecker
+from services.history_cache import HistoryCache
+from services.line_messaging_client import LineMessagingClient
+from services.response_cache import ResponseCache
+from services.stripe_service import StripeService
+from services.summary_service import SummaryService
+from services.user_service import UserService
+from services.work_queue import WorkQueue
+from services.write_buffer import WriteBehindBuffer
+
+
+class ServiceContainer:
+    """ワーカープロセスごとに1つ作成するクライアント・プール・サービス
+
+    FastAPIのlifespanで作成し、ルートにはDependsで渡す。
+    """
+
+    def __init__(self, db: Client, firebase_initialized: bool = True):
+        self.db = db
+        self.firebase_initialized = firebase_initialized
+
+        # LINEの設定
+        self.line_client = LineMessagingClient(os.getenv("LINE_CHANNEL_ACCESS_TOKEN"))
+        self.parser = WebhookParser(os.getenv("LINE_CHANNEL_SECRET"))
+
+        # サービスの初期化
+        self.firestore = AsyncFirestore(max_workers=int(os.getenv("FIRESTORE_MAX_WORKERS", 16)))
+        # 会話の書き込みをまとめる遅延書き込みバッファ（任意）
+        self.write_buffer = None
+        if os.getenv("CONVERSATION_WRITE_BEHIND", "false").lower() == "true":
+            self.write_buffer = WriteBehindBuffer(
+                db, self.firestore,
+                flush_interval=float(os.getenv("CONVERSATION_WRITE_BEHIND_INTERVAL", 0.2)),
+                max_attempts=int(os.getenv("CONVERSATION_WRITE_BEHIND_MAX_ATTEMPTS", 5))
+            )
+        # 直近の会話履歴のプロセス内キャッシュ
+        self.history_cache = None
+        if os.getenv("HISTORY_CACHE_ENABLED", "true").lower() == "true":
+            self.history_cache = HistoryCache(
+                max_messages=int(os.getenv("CONVERSATION_RECENT_WINDOW", 20)),
+                max_entries=int(os.getenv("HISTORY_CACHE_MAX_ENTRIES", 5000)),
+                ttl=float(os.getenv("HISTORY_CACHE_TTL", 300)),
+                max_bytes=int(os.getenv("HISTORY_CACHE_MAX_BYTES", 32 * 1024 * 1024))
+            )
+        self.conversation_service = ConversationService(db, self.firestore, self.write_buffer, self.history_cache)
+        # 会話の始めの短いメッセージ（「こんにちは」など）への応答のキャッシュ（任意）
+        self.response_cache = None
+        if os.getenv("RESPONSE_CACHE_ENABLED", "false").lower() == "true":
+            self.response_cache = ResponseCache(
+                max_entries=int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", 2000)),
+                ttl=float(os.getenv("RESPONSE_CACHE_TTL", 3600)),
+                max_bytes=int(os.getenv("RESPONSE_CACHE_MAX_BYTES", 8 * 1024 * 1024)),
+                max_history=int(os.getenv("RESPONSE_CACHE_MAX_HISTORY", 2)),
+                max_message_chars=int(os.getenv("RESPONSE_CACHE_MAX_MESSAGE_CHARS", 30))
+            )
+        self.ai_service = AIService(self.conversation_service, self.response_cache)
+        self.stripe_service = StripeService()
+        # 期限切れの案内に使うチェックアウトURLの事前作成・キャッシュ
+        self.checkout_links = CheckoutLinkProvider(
+            self.stripe_service,
+            session_ttl=int(os.getenv("CHECKOUT_SESSION_TTL", 23 * 3600)),
+            refresh_margin=float(os.getenv("CHECKOUT_LINK_REFRESH_MARGIN", 3600)),
+            max_entries=int(os.getenv("CHECKOUT_LINK_MAX_ENTRIES", 10000)),
+            max_workers=int(os.getenv("STRIPE_MAX_WORKERS", 4))
+        )
+        # 相談可否の判定結果のキャッシュ（Stripe Webhookで無効化）
+        self.entitlement_cache = EntitlementCache(
+            ttl=float(os.getenv("ENTITLEMENT_CACHE_TTL", 60)),
+            max_entries=int(os.getenv("ENTITLEMENT_CACHE_MAX_ENTRIES", 10000))
+        )
+        self.user_service = UserService(
+            db, self.conversation_service, self.firestore, self.entitlement_cache, self.checkout_links
+        )
+
+        # 会話要約はメッセージ処理とは別のキューで実行
+        self.summary_queue = WorkQueue(
+            "summaries",
+            maxsize=int(os.getenv("SUMMARY_QUEUE_MAXSIZE", 500)),
+            workers=int(os.getenv("SUMMARY_QUEUE_WORKERS", 1))
+        )
+        self.summary_service = SummaryService(
+            self.conversation_service, self.ai_service, self.summary_queue,
+            check_interval=int(os.getenv("SUMMARY_CHECK_INTERVAL", 10)),
+            keep_recent=int(os.getenv("SUMMARY_KEEP_RECENT")) if os.getenv("SUMMARY_KEEP_RECENT") else None,
+            max_entries=int(os.getenv("SUMMARY_MAX_ENTRIES", 10000))
+        )
+
+        # 再送されたWebhookイベントの重複排除（複数インスタンス構成ではfirestoreを指定）
+        dedup_ttl = float(os.getenv("DEDUP_TTL", 3 * 24 * 3600))
+        if os.getenv("DEDUP_BACKEND", "memory") == "firestore":
+            self.dedup_store = FirestoreDedupStore(db, self.firestore, ttl=dedup_ttl)
+        else:
+            self.dedup_store = InMemoryDedupStore(ttl=dedup_ttl, max_entries=int(os.getenv("DEDUP_MAX_ENTRIES", 100000)))
+
+        # Webhookイベントを応答後に処理するワークキュー（ワーカー数が同時処理数の上限）
+        self.event_queue = WorkQueue(
+            "line_events",
+            maxsize=int(os.getenv("EVENT_QUEUE_MAXSIZE", 1000)),
+            workers=int(os.getenv("EVENT_QUEUE_WORKERS", 4)),
+            drain_timeout=float(os.getenv("EVENT_QUEUE_DRAIN_TIMEOUT", 30))
+        )
+
+        # LLM呼び出しの前段の受け付け制御（複数インスタンス構成ではRATE_LIMIT_BACKEND=firestore）
+        if os.getenv("RATE_LIMIT_BACKEND", "memory") == "firestore":
+            rate_limit_backend = FirestoreRateLimitBackend(db, self.firestore)
+        else:
+            rate_limit_backend = InMemoryRateLimitBackend(max_entries=int(os.getenv("RATE_LIMIT_MAX_ENTRIES", 100000)))
+        shed_queue_depth = int(os.getenv("ADMISSION_SHED_QUEUE_DEPTH", 0))
+        self.admission = AdmissionController(
+            rate_limit_backend,
+            rate_per_minute=float(os.getenv("RATE_LIMIT_PER_MINUTE", 10)),
+            burst=float(os.getenv("RATE_LIMIT_BURST", 5)),
+            max_llm_concurrency=int(os.getenv("LLM_MAX_CONCURRENCY", 0)) or None,
+            max_llm_waiting=int(os.getenv("LLM_MAX_WAITING", 32)),
+            event_queue=self.event_queue,
+            shed_queue_depth=shed_queue_depth or int(self.event_queue.maxsize * 0.8)
+        )
+
+        # ハンドラーの初期化（依存関係の循環を解決）
+        self.line_webhook_handler = LineWebhookHandler(
+            self.line_client, self.user_service, self.ai_service, self.summary_service, self.admission
+        )
+        # 決済完了などのLINE通知はイベント処理とは別に送る
+        self.notification_queue = WorkQueue(
+            "notifications",
+            maxsize=int(os.getenv("NOTIFICATION_QUEUE_MAXSIZE", 1000)),
+            workers=int(os.getenv("NOTIFICATION_QUEUE_WORKERS", 4))
+        )
+        self.stripe_webhook_handler = StripeWebhookHandler(
+            self.user_service, self.line_webhook_handler, self.dedup_store, self.notification_queue,
+            max_attempts=int(os.getenv("STRIPE_EVENT_MAX_ATTEMPTS", 3))
+        )
+
+        self.health = HealthChecker(
+            db, self.firestore, self.ai_service, firebase_initialized,
+            timeout=float(os.getenv("HEALTH_CHECK_TIMEOUT", 2)),
+            cache_ttl=float(os.getenv("HEALTH_CHECK_CACHE_TTL", 5))
+        )
+
+    async def start(self) -> None:
+        await self.event_queue.start()
+        await self.summary_queue.start()
+        await self.notification_queue.start()
+        if self.write_buffer:
+            await self.write_buffer.start()
+
+    async def stop(self) -> None:
+        # 受付済みのイベントを処理しきってから接続を閉じる
+        await self.event_queue.stop()
+        await self.summary_queue.stop()
+        await self.notification_queue.stop()
+        if self.write_buffer:
+            await self.write_buffer.stop()
+        await self.ai_service.aclose()
+        await self.line_client.aclose()
+        await self.checkout_links.aclose()
+        self.firestore.shutdown()
+
+    @property
+    def is_alive(self) -> bool:
+        """イベント処理のワーカーが動いているか（livenessプローブ用）"""
+        queues = (self.event_queue, self.summary_queue, self.notification_queue)
+        return all(queue.is_running for queue in queues)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "firebase_initialized": self.firebase_initialized,
+            "event_queue": self.event_queue.get_stats(),
+            "summary_queue": self.summary_queue.get_stats(),
+            "notification_queue": self.notification_queue.get_stats(),
+            "write_buffer": self.write_buffer.get_stats() if self.write_buffer else None,
+            "history_cache": self.history_cache.get_stats() if self.history_cache else None,
+            "entitlement_cache": self.entitlement_cache.get_stats(),
+            "checkout_links": self.checkout_links.get_stats(),
+            "dedup": self.dedup_store.get_stats(),
+            "admission": self.admission.get_stats(),
+            "ai": self.ai_service.get_stats()
+        }
+
+    def collect_metrics(self) -> Iterable[metrics.Metric]:
+        """キューの深さやキャッシュのヒット数を出力時に各get_stats()から集める"""
+        queues = {
+            'line_events': self.event_queue.get_stats(),
+            'summaries': self.summary_queue.get_stats(),
+            'notifications': self.notification_queue.get_stats()
+        }
+        caches = {'entitlement': self.entitlement_cache.get_stats(), 'checkout_links': self.checkout_links.get_stats()}
+        if self.history_cache:
+            caches['history'] = self.history_cache.get_stats()
+        if self.response_cache:
+            caches['response'] = self.response_cache.get_stats()
+        dedup = self.dedup_store.get_stats()
+        yield metrics.from_stats(
+            metrics.Gauge, "line_bot_queue_depth", "Jobs waiting in each work queue", ["queue"],
+            {(name,): stats['depth'] for name, stats in queues.items()}
+        )
+        yield metrics.from_stats(
+            metrics.Gauge, "line_bot_queue_in_flight", "Jobs currently running in each work queue", ["queue"],
+            {(name,): stats['in_flight'] for name, stats in queues.items()}
+        )
+        yield metrics.from_stats(
+            metrics.Counter, "line_bot_queue_jobs_total", "Work queue jobs by result", ["queue", "result"],
+            {(name, result): stats[result] for name, stats in queues.items() for result in ('processed', 'failed', 'rejected')}
+        )
+        yield metrics.from_stats(
+            metrics.Counter, "line_bot_cache_requests_total", "Cache lookups by result", ["cache", "result"],
+            {
+                **{(name, 'hit'): stats['hits'] for name, stats in caches.items()},
+                **{(name, 'miss'): stats['misses'] for name, stats in caches.items()}
+            }
+        )
+        yield metrics.from_stats(
+            metrics.Counter, "line_bot_webhook_events_total", "Webhook events checked for redelivery", ["result"],
+            {('accepted',): dedup['checked'] - dedup['skipped'], ('duplicate',): dedup['skipped']}
+        )
+        admission = self.admission.get_stats()
+        yield metrics.from_stats(
+            metrics.Counter, "line_bot_admission_total", "Admission decisions ahead of the LLM call", ["result"],
+            {(result,): admission[result] for result in ('admitted', 'rate_limited', 'shed')}
+        )
+        yield metrics.from_stats(
+            metrics.Gauge, "line_bot_llm_slots", "LLM calls running and waiting for a concurrency slot", ["state"],
+            {('in_flight',): admission['llm_in_flight'], ('waiting',): admission['llm_waiting']}
+        )
+        if self.write_buffer:
+            yield metrics.from_stats(
+                metrics.Gauge, "line_bot_write_buffer_pending", "Writes waiting in the write-behind buffer", [],
+                {(): self.write_buffer.get_stats()['pending']}
+            )
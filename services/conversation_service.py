@@ -1,83 +1,158 @@
-from typing import List, Dict, Optional, Any, TYPE_CHECKING
+import logging
+from typing import List, Dict, Optional, Any, Tuple, TYPE_CHECKING
 from models.conversation import Message, Summary
 from google.cloud.firestore import Client
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
+from services.firestore_client import AsyncFirestore
+from services.write_buffer import WriteBehindBuffer
+from services.history_cache import HistoryCache
+from services.metrics import span
+import os
 import uuid
 
+logger = logging.getLogger(__name__)
+
 class ConversationService:
-    def __init__(self, db: Client):
+    def __init__(
+        self,
+        db: Client,
+        firestore: Optional[AsyncFirestore] = None,
+        write_buffer: Optional[WriteBehindBuffer] = None,
+        history_cache: Optional[HistoryCache] = None
+    ):
         self.db = db
+        self.firestore = firestore or AsyncFirestore()
+        self.write_buffer = write_buffer  # 指定時はメッセージの書き込みをまとめて遅延コミット
+        if write_buffer:
+            write_buffer.on_drop = self._on_writes_dropped
+        self.history_cache = history_cache  # 指定時は直近の履歴をプロセス内に保持
         self.messages_ref = db.collection('messages')
         self.summaries_ref = db.collection('summaries')
-        self.MAX_MESSAGES_PER_SUMMARY = 50
+        self.RECENT_WINDOW = int(os.getenv("CONVERSATION_RECENT_WINDOW", 20))  # 要約せずにプロンプトへ含める直近の件数
+        # 要約以降のメッセージがこの件数を超えたら要約する（RECENT_WINDOWを超えるとプロンプトに含まれない会話が出るため上限とする）
+        self.MAX_MESSAGES_PER_SUMMARY = min(
+            int(os.getenv("MAX_MESSAGES_PER_SUMMARY", self.RECENT_WINDOW)), self.RECENT_WINDOW
+        )
+
+    def _on_writes_dropped(self, writes: List[Tuple[Any, Dict[str, Any]]]) -> None:
+        """書き込めなかったメッセージをキャッシュから外す（キャッシュとFirestoreの内容を揃える）"""
+        if not self.history_cache:
+            return
+        for user_id, conversation_id in {(data.get('user_id'), data.get('conversation_id')) for _, data in writes}:
+            self.history_cache.invalidate(user_id, conversation_id)
+
+    @staticmethod
+    def _to_message(data: Dict[str, Any]) -> Message:
+        """保存データからMessageを作成"""
+        return Message(
+            sender=data.get('sender'),
+            text=data.get('text'),
+            content=data.get('content'),
+            role=data.get('role', 'user'),
+            timestamp=data.get('created_at')
+        )
+
+    def _build_message_data(self, user_id: str, conversation_id: str, message: Message, created_at: datetime) -> Dict[str, Any]:
+        """保存用のメッセージデータを作成"""
+        return {
+            'user_id': user_id,
+            'conversation_id': conversation_id,
+            'role': message.role,
+            'content': message.content or message.text,  # contentがない場合はtextを使用
+            'text': message.text,
+            'sender': message.sender,
+            'created_at': created_at,
+            'message_id': str(uuid.uuid4())
+        }
 
     async def add_message(self, user_id: str, conversation_id: str, message: Message) -> str:
         """メッセージを追加"""
         try:
-            message_id = str(uuid.uuid4())
-            message_data = {
-                'user_id': user_id,
-                'conversation_id': conversation_id,
-                'role': message.role,
-                'content': message.content or message.text,  # contentがない場合はtextを使用
-                'text': message.text,
-                'sender': message.sender,
-                'created_at': datetime.now(timezone.utc),
-                'message_id': message_id
-            }
-            
-            self.messages_ref.document(message_id).set(message_data)
-            return message_id
+            message_data = self._build_message_data(user_id, conversation_id, message, datetime.now(timezone.utc))
+            await self.firestore.set(self.messages_ref.document(message_data['message_id']), message_data)
+            if self.history_cache:
+                self.history_cache.append(user_id, conversation_id, [self._to_message(message_data)])
+            return message_data['message_id']
         except Exception as e:
-            print(f"Error adding message: {e}")
+            logger.error("Error adding message: %s", e)
             raise
 
-    async def get_messages(self, user_id: str, conversation_id: str, limit: int = 20) -> List[Message]:
-        """会話履歴を取得"""
+    async def add_messages(self, user_id: str, conversation_id: str, messages: List[Message]) -> List[str]:
+        """複数のメッセージを1回のバッチ書き込みで追加（並び順はリストの順）"""
         try:
-            messages = []
-            query = (self.messages_ref
-                    .where('user_id', '==', user_id)
-                    .where('conversation_id', '==', conversation_id)
-                    .order_by('created_at', direction='DESCENDING')
-                    .limit(limit))
-            
-            docs = query.stream()
-            
-            for doc in docs:
-                data = doc.to_dict()
-                message = Message(
-                    sender=data.get('sender'),
-                    text=data.get('text'),
-                    content=data.get('content'),
-                    role=data.get('role', 'user'),
-                    timestamp=data.get('created_at')
-                )
-                messages.append(message)
-            
-            # 古い順に並べ替え
-            messages.reverse()
-            return messages
+            now = datetime.now(timezone.utc)
+            # 同じ時刻にならないよう1マイクロ秒ずつずらして順序を保つ
+            records = [
+                self._build_message_data(user_id, conversation_id, message, now + timedelta(microseconds=i))
+                for i, message in enumerate(messages)
+            ]
+
+            if self.write_buffer:
+                for data in records:
+                    self.write_buffer.add(self.messages_ref.document(data['message_id']), data)
+            else:
+                batch = self.db.batch()
+                for data in records:
+                    batch.set(self.messages_ref.document(data['message_id']), data)
+                await self.firestore.commit(batch)
+
+            # 書き込んだ内容をキャッシュにも反映（ライトスルー）
+            if self.history_cache:
+                self.history_cache.append(user_id, conversation_id, [self._to_message(data) for data in records])
+            return [data['message_id'] for data in records]
         except Exception as e:
-            print(f"Error getting messages: {e}")
-            return []
+            logger.error("Error adding messages: %s", e)
+            raise
+
+    async def get_messages(self, user_id: str, conversation_id: str, limit: Optional[int] = None) -> List[Message]:
+        """会話履歴を取得"""
+        with span("get_messages"):
+            try:
+                limit = limit or self.RECENT_WINDOW
+                if self.history_cache:
+                    cached = self.history_cache.get(user_id, conversation_id, limit)
+                    if cached is not None:
+                        return cached
 
-    async def add_summary(self, user_id: str, conversation_id: str, content: str) -> str:
-        """要約を追加"""
+                messages = []
+                query = (self.messages_ref
+                        .where('user_id', '==', user_id)
+                        .where('conversation_id', '==', conversation_id)
+                        .order_by('created_at', direction='DESCENDING')
+                        .limit(limit))
+            
+                docs = await self.firestore.stream(query)
+            
+                for doc in docs:
+                    messages.append(self._to_message(doc.to_dict()))
+            
+                # 古い順に並べ替え
+                messages.reverse()
+                if self.history_cache:
+                    self.history_cache.put(user_id, conversation_id, messages, limit)
+                return messages
+            except Exception as e:
+                logger.error("Error getting messages: %s", e)
+                return []
+
+    async def add_summary(self, user_id: str, conversation_id: str, content: str, covered_until: Optional[datetime] = None) -> str:
+        """要約を追加（covered_untilは要約に含めた最後のメッセージの日時）"""
         try:
             summary_id = str(uuid.uuid4())
+            created_at = datetime.now(timezone.utc)
             summary_data = {
                 'user_id': user_id,
                 'conversation_id': conversation_id,
                 'content': content,
-                'created_at': datetime.now(timezone.utc),
+                'created_at': created_at,
+                'covered_until': covered_until or created_at,
                 'summary_id': summary_id
             }
             
-            self.summaries_ref.document(summary_id).set(summary_data)
+            await self.firestore.set(self.summaries_ref.document(summary_id), summary_data)
             return summary_id
         except Exception as e:
-            print(f"Error adding summary: {e}")
+            logger.error("Error adding summary: %s", e)
             raise
 
     async def get_summaries(self, user_id: str, conversation_id: str, limit: int = 5) -> List[Summary]:
@@ -90,89 +165,87 @@ class ConversationService:
                     .order_by('created_at', direction='DESCENDING')
                     .limit(limit))
             
-            docs = query.stream()
+            docs = await self.firestore.stream(query)
             
             for doc in docs:
                 data = doc.to_dict()
                 summary = Summary(
-                    content=data.get('content'),
-                    created_at=data.get('created_at')
+                    text=data.get('content'),
+                    timestamp=data.get('created_at'),
+                    covered_until=data.get('covered_until')
                 )
                 summaries.append(summary)
             
             return summaries
         except Exception as e:
-            print(f"Error getting summaries: {e}")
+            logger.error("Error getting summaries: %s", e)
             return []
 
     async def should_create_summary(self, user_id: str, conversation_id: str) -> bool:
         """要約を作成すべきかどうかを判断"""
         try:
-            # 最新の要約を取得
             latest_summaries = await self.get_summaries(user_id, conversation_id, limit=1)
-            
-            if not latest_summaries:
-                # 要約がまだない場合、メッセージ数が閾値を超えたら要約を作成
-                message_count = await self._count_messages(user_id, conversation_id)
-                return message_count >= self.MAX_MESSAGES_PER_SUMMARY
-            
-            # 最新の要約以降のメッセージ数を取得
-            latest_summary = latest_summaries[0]
-            message_count = await self._count_messages_since(user_id, conversation_id, latest_summary.created_at)
-            
-            return message_count >= self.MAX_MESSAGES_PER_SUMMARY
+            latest_summary = latest_summaries[0] if latest_summaries else None
+            message_count = await self.count_messages_after(user_id, conversation_id, latest_summary)
+            return message_count > self.MAX_MESSAGES_PER_SUMMARY
         except Exception as e:
-            print(f"Error checking if summary should be created: {e}")
+            logger.error("Error checking if summary should be created: %s", e)
             return False
 
+    async def count_messages_after(self, user_id: str, conversation_id: str, summary: Optional[Summary]) -> int:
+        """要約に含まれていないメッセージ数（要約がまだない場合は全件）"""
+        if summary is None:
+            return await self._count_messages(user_id, conversation_id)
+        return await self._count_messages_since(user_id, conversation_id, summary.covered_until)
+
     async def _count_messages(self, user_id: str, conversation_id: str) -> int:
-        """メッセージ数をカウント"""
+        """メッセージ数をカウント（count()集計クエリを使用）"""
         try:
             query = (self.messages_ref
                     .where('user_id', '==', user_id)
                     .where('conversation_id', '==', conversation_id))
             
-            docs = query.stream()
-            return len(list(docs))
+            return await self.firestore.count(query)
         except Exception as e:
-            print(f"Error counting messages: {e}")
+            logger.error("Error counting messages: %s", e)
             return 0
 
     async def _count_messages_since(self, user_id: str, conversation_id: str, since_time) -> int:
-        """特定の時間以降のメッセージ数をカウント"""
+        """特定の時間以降のメッセージ数をカウント（count()集計クエリを使用）"""
         try:
             query = (self.messages_ref
                     .where('user_id', '==', user_id)
                     .where('conversation_id', '==', conversation_id)
                     .where('created_at', '>', since_time))
             
-            docs = query.stream()
-            return len(list(docs))
+            return await self.firestore.count(query)
         except Exception as e:
-            print(f"Error counting messages since time: {e}")
+            logger.error("Error counting messages since time: %s", e)
             return 0
 
-    async def get_messages_since(self, user_id: str, conversation_id: str, since_time) -> List[Message]:
-        """特定の時間以降のメッセージを取得"""
+    async def get_messages_since(self, user_id: str, conversation_id: str, since_time=None) -> List[Message]:
+        """特定の時間以降のメッセージを取得（since_timeがNoneの場合は全件）"""
         try:
             messages = []
             query = (self.messages_ref
                     .where('user_id', '==', user_id)
-                    .where('conversation_id', '==', conversation_id)
-                    .where('created_at', '>', since_time)
-                    .order_by('created_at'))
+                    .where('conversation_id', '==', conversation_id))
+            if since_time is not None:
+                query = query.where('created_at', '>', since_time)
+            query = query.order_by('created_at')
             
-            docs = query.stream()
+            docs = await self.firestore.stream(query)
             
             for doc in docs:
                 data = doc.to_dict()
                 message = Message(
                     role=data.get('role'),
-                    content=data.get('content')
+                    content=data.get('content'),
+                    timestamp=data.get('created_at')
                 )
                 messages.append(message)
             
             return messages
         except Exception as e:
-            print(f"Error getting messages since time: {e}")
+            logger.error("Error getting messages since time: %s", e)
             return [] 
\ No newline at end of file
@@ -0,0 +1,85 @@
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta, timezone
+from typing import Dict
+from google.api_core.exceptions import AlreadyExists
+from google.cloud.firestore import Client
+from services.firestore_client import AsyncFirestore
+from services.lru_cache import TTLCache
+
+
+class DedupStore(ABC):
+    """処理済みイベントIDを記録し、再送されたイベントを検出するストア"""
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.stats: Dict[str, int] = {'checked': 0, 'skipped': 0}
+
+    async def mark_seen(self, key: str) -> bool:
+        """初めてのイベントなら記録してTrue、処理済みならFalseを返す"""
+        self.stats['checked'] += 1
+        first = await self._mark(key)
+        if not first:
+            self.stats['skipped'] += 1
+        return first
+
+    @abstractmethod
+    async def _mark(self, key: str) -> bool:
+        """キーを記録し、初めてならTrueを返す"""
+
+    @abstractmethod
+    async def forget(self, key: str) -> None:
+        """処理に失敗したイベントの記録を消し、再送時に処理できるようにする"""
+
+    def get_stats(self) -> Dict[str, int]:
+        return dict(self.stats)
+
+
+class InMemoryDedupStore(DedupStore):
+    """プロセス内のLRUで処理済みイベントIDを保持（単一インスタンス向け）"""
+
+    def __init__(self, ttl: float = 3 * 24 * 3600, max_entries: int = 100000):
+        super().__init__(ttl)
+        self._seen: TTLCache[bool] = TTLCache(max_entries, ttl=ttl)
+
+    async def _mark(self, key: str) -> bool:
+        if self._seen.peek(key) is not None:
+            return False
+        self._seen.set(key, True)
+        return True
+
+    async def forget(self, key: str) -> None:
+        self._seen.pop(key)
+
+
+class FirestoreDedupStore(DedupStore):
+    """Firestoreで処理済みイベントIDを共有（複数インスタンス向け）
+
+    expires_atフィールドにFirestoreのTTLポリシーを設定すると期限切れの記録が自動で削除される。
+    """
+
+    def __init__(self, db: Client, firestore: AsyncFirestore, ttl: float = 3 * 24 * 3600, collection: str = 'processed_events'):
+        super().__init__(ttl)
+        self.firestore = firestore
+        self.events_ref = db.collection(collection)
+
+    @staticmethod
+    def _doc_id(key: str) -> str:
+        # ドキュメントIDに使えない"/"を置き換える
+        return key.replace('/', '_')
+
+    async def _mark(self, key: str) -> bool:
+        now = datetime.now(timezone.utc)
+        doc_ref = self.events_ref.document(self._doc_id(key))
+        try:
+            # createは既に存在する場合に失敗するため、インスタンス間でも1回だけ成功する
+            await self.firestore.run(doc_ref.create, {
+                'key': key,
+                'created_at': now,
+                'expires_at': now + timedelta(seconds=self.ttl)
+            })
+            return True
+        except AlreadyExists:
+            return False
+
+    async def forget(self, key: str) -> None:
+        await self.firestore.run(self.events_ref.document(self._doc_id(key)).delete)
@@ -0,0 +1,39 @@
+from datetime import datetime, timezone
+from typing import Dict, Optional
+from services.lru_cache import TTLCache
+
+
+class Entitlement:
+    """キャッシュする相談可否の状態"""
+    PAID = "paid"
+    LIMIT_EXCEEDED = "limit_exceeded"
+
+
+class EntitlementCache:
+    """LINEユーザーIDごとの相談可否をTTL付きで保持するキャッシュ
+
+    状態ごとの有効期限（サブスクの終了日時、翌日0:00）とTTLの早い方で失効する。
+    """
+
+    def __init__(self, ttl: float = 60, max_entries: int = 10000):
+        self.ttl = ttl
+        self._cache: TTLCache[str] = TTLCache(max_entries, ttl=ttl)
+        self.invalidations = 0
+
+    def get(self, user_id: str) -> Optional[str]:
+        """有効な状態があれば返す"""
+        return self._cache.get(user_id)
+
+    def set(self, user_id: str, state: str, valid_until: Optional[datetime] = None) -> None:
+        """状態を保存（valid_untilを過ぎた状態はキャッシュしない）"""
+        ttl = self.ttl
+        if valid_until is not None:
+            ttl = min(ttl, (valid_until - datetime.now(timezone.utc)).total_seconds())
+        self._cache.set(user_id, state, ttl=ttl)
+
+    def invalidate(self, user_id: str) -> None:
+        if self._cache.pop(user_id) is not None:
+            self.invalidations += 1
+
+    def get_stats(self) -> Dict[str, float]:
+        return {**self._cache.get_stats(), 'invalidations': self.invalidations}
@@ -0,0 +1,261 @@
+"""サブスクの期限切れをまとめて処理するスイーパー
+
+期限切れのユーザーをバッチ書き込みで無料プランに戻し、再登録用のURLを付けた案内をプッシュで送る。
+自動更新を停止したユーザーには、期限間近の通知をmulticastで送る。
+
+使い方:
+    python -m services.expiry_sweeper              # 1回実行（cronやCloud Schedulerから）
+    python -m services.expiry_sweeper --interval 600
+"""
+import argparse
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+from dotenv import load_dotenv
+from google.api_core.exceptions import FailedPrecondition
+from google.cloud.firestore import Client
+from linebot.models import TextSendMessage
+from services.checkout_links import CheckoutLinkProvider
+from services.entitlement_cache import EntitlementCache
+from services.firestore_client import AsyncFirestore
+from services.line_messaging_client import LineMessagingClient
+from services.stripe_service import StripeService
+from services.write_buffer import MAX_BATCH_OPERATIONS
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+EXPIRING_SOON_MESSAGE = """🤖「サブスクの自動更新が停止されているため、有効期限がまもなく切れます。⏳
+期限が切れると、1日1回までの無料プランに戻ります。
+期限が切れた後も、「サブスク」と送るといつでも再登録できます！✨」"""
+
+EXPIRED_MESSAGE = """🤖「サブスクの有効期限が切れました。
+引き続き無制限で相談するには、「サブスク」と送信して再登録をお願いします！✨」"""
+
+EXPIRED_WITH_LINK_MESSAGE = """🤖「サブスクの有効期限が切れました。引き続き無制限で相談するには、再登録をお願いします！✨
+👉【再登録はこちら】{url}」"""
+
+
+class ExpirySweeper:
+    """subscription_endの範囲クエリで期限切れ・期限間近のユーザーをページ単位で処理する
+
+    期限切れの案内はcheckout_links指定時にユーザーごとのURLを付けてプッシュで送り、
+    URLを作れなかったユーザーには「サブスク」と送るよう案内するmulticastを送る。
+    期限間近の通知は自動更新を停止したユーザー（auto_renewがFalse）だけに送り、
+    通知済みのsubscription_endをexpiry_notice_forに記録して再送しない。
+    """
+
+    def __init__(
+        self,
+        db: Client,
+        firestore: AsyncFirestore,
+        line_client: LineMessagingClient,
+        notice_window: float = 3 * 24 * 3600,
+        page_size: int = MAX_BATCH_OPERATIONS,
+        entitlement_cache: Optional[EntitlementCache] = None,
+        checkout_links: Optional[CheckoutLinkProvider] = None
+    ):
+        self.db = db
+        self.firestore = firestore
+        self.line_client = line_client
+        self.notice_window = notice_window
+        # 1ページ分の更新を1回のバッチ書き込みで行う
+        self.page_size = min(page_size, MAX_BATCH_OPERATIONS)
+        self.entitlement_cache = entitlement_cache
+        self.checkout_links = checkout_links
+        self.users_ref = db.collection('users')
+
+    async def _pages(self, query) -> AsyncIterator[List[Any]]:
+        """start_afterでpage_size件ずつ取得"""
+        last = None
+        while True:
+            page = query.limit(self.page_size)
+            if last is not None:
+                page = page.start_after(last)
+            docs = await self.firestore.stream(page)
+            if not docs:
+                return
+            yield docs
+            if len(docs) < self.page_size:
+                return
+            last = docs[-1]
+
+    async def _multicast(self, user_ids: List[str], text: str, stats: Dict[str, Any], key: str) -> bool:
+        try:
+            await self.line_client.multicast(user_ids, TextSendMessage(text=text))
+            stats[key] += len(user_ids)
+            return True
+        except Exception as e:
+            stats['failed_notifications'] += len(user_ids)
+            logger.error("Error sending expiry notices to %s users: %s", len(user_ids), e)
+            return False
+
+    async def _sweep_expired(self, now: datetime, stats: Dict[str, Any]) -> None:
+        query = (self.users_ref
+                 .where('is_paid', '==', True)
+                 .where('subscription_end', '<', now)
+                 .order_by('subscription_end'))
+        update_data = {
+            'is_paid': False,
+            'subscription_type': None,
+            'subscription_end': None,
+            'updated_at': now
+        }
+        async for docs in self._pages(query):
+            stats['scanned'] += len(docs)
+            # 読み込んだ後に更新（Webhookでの更新など）されたユーザーは無効化しない
+            batch = self.db.batch()
+            for doc in docs:
+                batch.update(doc.reference, update_data, option=self.db.write_option(last_update_time=doc.update_time))
+            try:
+                await self.firestore.commit(batch)
+                user_ids = [doc.id for doc in docs]
+            except FailedPrecondition:
+                # バッチは1件でも前提条件を満たさないと全体が失敗するので、1件ずつ書き直す
+                user_ids = await self._deactivate_each(docs, update_data, stats)
+            except Exception as e:
+                stats['failed_writes'] += len(docs)
+                logger.error("Error deactivating %s expired subscriptions: %s", len(docs), e)
+                continue
+            if not user_ids:
+                continue
+
+            stats['deactivated'] += len(user_ids)
+            if self.entitlement_cache:
+                for user_id in user_ids:
+                    self.entitlement_cache.invalidate(user_id)
+            await self._notify_expired(user_ids, stats)
+
+    async def _deactivate_each(self, docs: List[Any], update_data: Dict[str, Any], stats: Dict[str, Any]) -> List[str]:
+        """前提条件付きで1件ずつ無効化し、無効化できたユーザーIDを返す"""
+        results = await asyncio.gather(*[
+            self.firestore.update(doc.reference, update_data, option=self.db.write_option(last_update_time=doc.update_time))
+            for doc in docs
+        ], return_exceptions=True)
+        user_ids = []
+        for doc, result in zip(docs, results):
+            if isinstance(result, FailedPrecondition):
+                stats['skipped'] += 1
+                logger.info("Skipping %s: updated after the expiry sweep read it", doc.id)
+            elif isinstance(result, Exception):
+                stats['failed_writes'] += 1
+                logger.error("Error deactivating expired subscription for %s: %s", doc.id, result)
+            else:
+                user_ids.append(doc.id)
+        return user_ids
+
+    async def _notify_expired(self, user_ids: List[str], stats: Dict[str, Any]) -> None:
+        """再登録用のURLを付けて1人ずつ送る（URLを作れなかったユーザーにはまとめて案内を送る）"""
+        without_link = user_ids
+        if self.checkout_links:
+            # URLの作成はCheckoutLinkProviderのスレッドプールで並行して行う
+            urls = await asyncio.gather(
+                *[self.checkout_links.get(user_id) for user_id in user_ids], return_exceptions=True
+            )
+            pushes = {user_id: url for user_id, url in zip(user_ids, urls) if isinstance(url, str)}
+            results = await asyncio.gather(*[
+                self.line_client.push_message(user_id, TextSendMessage(text=EXPIRED_WITH_LINK_MESSAGE.format(url=url)))
+                for user_id, url in pushes.items()
+            ], return_exceptions=True)
+            for user_id, result in zip(pushes, results):
+                if isinstance(result, Exception):
+                    stats['failed_notifications'] += 1
+                    logger.error("Error sending expiry notice to %s: %s", user_id, result)
+                else:
+                    stats['expired_notified'] += 1
+            without_link = [user_id for user_id in user_ids if user_id not in pushes]
+        if without_link:
+            await self._multicast(without_link, EXPIRED_MESSAGE, stats, 'expired_notified')
+
+    async def _notify_expiring(self, now: datetime, stats: Dict[str, Any]) -> None:
+        query = (self.users_ref
+                 .where('is_paid', '==', True)
+                 .where('subscription_end', '>=', now)
+                 .where('subscription_end', '<', now + timedelta(seconds=self.notice_window))
+                 .order_by('subscription_end'))
+        async for docs in self._pages(query):
+            stats['scanned'] += len(docs)
+            # 自動更新のユーザーは期限前に更新されるので通知しない（auto_renewがない古いデータも自動更新として扱う）
+            due = [
+                doc for doc in docs
+                if not doc.to_dict().get('auto_renew', True)
+                and doc.to_dict().get('expiry_notice_for') != doc.to_dict().get('subscription_end')
+            ]
+            if not due or not await self._multicast([doc.id for doc in due], EXPIRING_SOON_MESSAGE, stats, 'expiring_notified'):
+                continue
+
+            # 送信後に記録する（記録に失敗した場合は次回もう一度通知される）
+            batch = self.db.batch()
+            for doc in due:
+                batch.update(doc.reference, {'expiry_notice_for': doc.to_dict().get('subscription_end')})
+            try:
+                await self.firestore.commit(batch)
+            except Exception as e:
+                stats['failed_writes'] += len(due)
+                logger.error("Error recording expiry notices for %s users: %s", len(due), e)
+
+    async def sweep(self) -> Dict[str, Any]:
+        """1回分の処理を行い、件数と処理速度を返す"""
+        started = time.perf_counter()
+        now = datetime.now(timezone.utc)
+        stats: Dict[str, Any] = {
+            'scanned': 0, 'deactivated': 0, 'expired_notified': 0, 'expiring_notified': 0,
+            'skipped': 0, 'failed_writes': 0, 'failed_notifications': 0
+        }
+        await self._sweep_expired(now, stats)
+        if self.notice_window > 0:
+            await self._notify_expiring(now, stats)
+
+        elapsed = time.perf_counter() - started
+        stats['elapsed_seconds'] = round(elapsed, 3)
+        stats['docs_per_second'] = round(stats['scanned'] / elapsed, 1) if elapsed > 0 else 0.0
+        logger.info("Expiry sweep finished: %s", stats, extra={'sweep': stats})
+        return stats
+
+
+async def main(args) -> None:
+    from app import init_firestore
+
+    db, firebase_initialized = init_firestore()
+    if not firebase_initialized:
+        raise SystemExit("Firebase is not initialized")
+
+    firestore = AsyncFirestore(max_workers=int(os.getenv("FIRESTORE_MAX_WORKERS", 16)))
+    line_client = LineMessagingClient(os.getenv("LINE_CHANNEL_ACCESS_TOKEN"))
+    checkout_links = CheckoutLinkProvider(
+        StripeService(),
+        session_ttl=int(os.getenv("CHECKOUT_SESSION_TTL", 23 * 3600)),
+        max_workers=int(os.getenv("STRIPE_MAX_WORKERS", 4))
+    )
+    sweeper = ExpirySweeper(
+        db, firestore, line_client, notice_window=args.notice_window, page_size=args.page_size,
+        checkout_links=checkout_links
+    )
+    try:
+        while True:
+            try:
+                await sweeper.sweep()
+            except Exception as e:
+                logger.exception("Expiry sweep failed: %s", e)
+            if args.interval <= 0:
+                break
+            await asyncio.sleep(args.interval)
+    finally:
+        await checkout_links.aclose()
+        await line_client.aclose()
+        firestore.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--interval", type=float, default=float(os.getenv("EXPIRY_SWEEP_INTERVAL", 0)),
+                        help="実行間隔（秒）。0なら1回だけ実行")
+    parser.add_argument("--notice-window", type=float, default=float(os.getenv("EXPIRY_NOTICE_WINDOW", 3 * 24 * 3600)),
+                        help="期限の何秒前から期限間近の通知を送るか（0で送らない）")
+    parser.add_argument("--page-size", type=int, default=int(os.getenv("EXPIRY_SWEEP_PAGE_SIZE", MAX_BATCH_OPERATIONS)))
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,46 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, Callable, Dict, List
+
+
+class AsyncFirestore:
+    """同期Firestoreクライアントの呼び出しを専用スレッドプールで実行するアクセス層"""
+
+    def __init__(self, max_workers: int = 16):
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="firestore")
+
+    async def run(self, func: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        """ブロッキングなFirestore呼び出しをイベントループ外で実行"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, partial(func, *args, **kwargs))
+
+    async def get(self, doc_ref, **kwargs: Any):
+        """ドキュメントを取得"""
+        return await self.run(doc_ref.get, **kwargs)
+
+    async def set(self, doc_ref, data: Dict[str, Any], merge: bool = False) -> Any:
+        """ドキュメントを書き込み"""
+        return await self.run(doc_ref.set, data, merge=merge)
+
+    async def update(self, doc_ref, data: Dict[str, Any], option: Any = None) -> Any:
+        """ドキュメントを部分更新（optionはClient.write_optionで作る前提条件）"""
+        return await self.run(doc_ref.update, data, option=option)
+
+    async def stream(self, query) -> List[Any]:
+        """クエリ結果をすべて取得"""
+        return await self.run(lambda: list(query.stream()))
+
+    async def count(self, query) -> int:
+        """集計クエリで件数を取得（ドキュメント本体は読み込まない）"""
+        result = await self.run(query.count(alias="count").get)
+        return int(result[0][0].value)
+
+    async def commit(self, batch) -> Any:
+        """バッチ書き込みをコミット"""
+        return await self.run(batch.commit)
+
+    def shutdown(self, wait: bool = True) -> None:
+        """スレッドプールを停止"""
+        self._executor.shutdown(wait=wait)
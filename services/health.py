@@ -0,0 +1,68 @@
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from google.cloud.firestore import Client
+from services.ai_service import AIService
+from services.firestore_client import AsyncFirestore
+
+logger = logging.getLogger(__name__)
+
+
+class HealthChecker:
+    """FirestoreとOpenRouterへの疎通を確認するreadinessチェック
+
+    プローブが頻繁に来ても外部サービスに負荷をかけないよう、結果をcache_ttl秒保持する。
+    """
+
+    def __init__(
+        self,
+        db: Client,
+        firestore: AsyncFirestore,
+        ai_service: AIService,
+        firebase_initialized: bool = True,
+        timeout: float = 2.0,
+        cache_ttl: float = 5.0
+    ):
+        self.db = db
+        self.firestore = firestore
+        self.ai_service = ai_service
+        self.firebase_initialized = firebase_initialized
+        self.timeout = timeout
+        self.cache_ttl = cache_ttl
+        self._result: Optional[Dict[str, Any]] = None
+        self._checked_at = 0.0
+        self._lock = asyncio.Lock()
+
+    async def check_firestore(self) -> None:
+        """存在しなくてもよいドキュメントを1件読んで接続を確認"""
+        if not self.firebase_initialized:
+            raise RuntimeError("Firebase is not initialized")
+        await self.firestore.get(self.db.collection('_health').document('ping'))
+
+    async def _run(self, check: Callable[[], Awaitable[None]]) -> Dict[str, Any]:
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(check(), timeout=self.timeout)
+            return {'ok': True, 'latency_ms': round((time.perf_counter() - started) * 1000, 1)}
+        except Exception as e:
+            return {'ok': False, 'error': f"{type(e).__name__}: {e}"}
+
+    async def readiness(self) -> Dict[str, Any]:
+        """各依存サービスの状態（同時に来たプローブは1回の確認結果を共有）"""
+        async with self._lock:
+            if self._result is not None and time.monotonic() - self._checked_at < self.cache_ttl:
+                return self._result
+
+            firestore_result, openrouter_result = await asyncio.gather(
+                self._run(self.check_firestore),
+                self._run(self.ai_service.check_health)
+            )
+            checks = {'firestore': firestore_result, 'openrouter': openrouter_result}
+            ready = all(result['ok'] for result in checks.values())
+            if not ready:
+                logger.warning("Readiness check failed: %s", {name: r.get('error') for name, r in checks.items() if not r['ok']})
+            self._result = {'ready': ready, 'checks': checks}
+            self._checked_at = time.monotonic()
+            return self._result
@@ -0,0 +1,52 @@
+from typing import Dict, List, Optional
+from models.conversation import Message
+from services.lru_cache import TTLCache, estimate_text_bytes
+
+# メッセージ1件あたりの概算オーバーヘッド（バイト）
+MESSAGE_OVERHEAD_BYTES = 200
+
+
+class _Entry:
+    def __init__(self, messages: List[Message], complete: bool):
+        self.messages = messages
+        self.complete = complete  # 会話の全メッセージを保持しているか
+
+    def size(self) -> int:
+        return sum(estimate_text_bytes(m.content or m.text) + MESSAGE_OVERHEAD_BYTES for m in self.messages)
+
+
+class HistoryCache:
+    """ユーザーごとの直近の会話履歴を保持するLRUキャッシュ（TTLとメモリ上限付き）"""
+
+    def __init__(self, max_messages: int = 20, max_entries: int = 5000, ttl: float = 300, max_bytes: int = 32 * 1024 * 1024):
+        self.max_messages = max_messages
+        self._cache: TTLCache[_Entry] = TTLCache(max_entries, ttl=ttl, max_bytes=max_bytes, size_of=_Entry.size)
+
+    def get(self, user_id: str, conversation_id: str, limit: int) -> Optional[List[Message]]:
+        """キャッシュから直近limit件を取得。足りない・期限切れの場合はNone"""
+        entry = self._cache.get(
+            (user_id, conversation_id), usable=lambda entry: entry.complete or len(entry.messages) >= limit
+        )
+        return entry.messages[-limit:] if entry is not None else None
+
+    def put(self, user_id: str, conversation_id: str, messages: List[Message], limit: int) -> None:
+        """Firestoreから読み込んだ履歴（古い順）を保存"""
+        complete = len(messages) < limit and len(messages) <= self.max_messages
+        self._cache.set((user_id, conversation_id), _Entry(list(messages[-self.max_messages:]), complete))
+
+    def append(self, user_id: str, conversation_id: str, messages: List[Message]) -> None:
+        """書き込んだメッセージを反映（キャッシュ済みの会話のみ、読み込み時からのTTLは延ばさない）"""
+        key = (user_id, conversation_id)
+        entry = self._cache.peek(key)
+        if entry is None:
+            return
+
+        combined = entry.messages + messages
+        complete = entry.complete and len(combined) <= self.max_messages
+        self._cache.update(key, _Entry(combined[-self.max_messages:], complete))
+
+    def invalidate(self, user_id: str, conversation_id: str) -> None:
+        self._cache.pop((user_id, conversation_id))
+
+    def get_stats(self) -> Dict[str, float]:
+        return self._cache.get_stats()
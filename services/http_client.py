@@ -0,0 +1,40 @@
+import random
+from abc import ABC, abstractmethod
+from typing import Optional
+
+import httpx
+
+
+class PooledHttpClient(ABC):
+    """接続プールを使い回すHTTPクライアントの共通部分（遅延作成、クローズ、リトライ間隔）"""
+
+    def __init__(self, max_retries: int, retry_base_delay: float, retry_max_delay: float):
+        self.max_retries = max_retries
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self._client: Optional[httpx.AsyncClient] = None
+
+    @abstractmethod
+    def _create_client(self) -> httpx.AsyncClient:
+        """接続プール付きのHTTPクライアントを作成"""
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """共有HTTPクライアント（初回アクセス時に作成）"""
+        if self._client is None or self._client.is_closed:
+            self._client = self._create_client()
+        return self._client
+
+    async def aclose(self) -> None:
+        """共有HTTPクライアントを閉じる"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def _retry_delay(self, attempt: int, response: Optional[httpx.Response] = None) -> float:
+        """リトライまでの待機時間（Retry-Afterを優先し、なければジッター付き指数バックオフ）"""
+        if response is not None:
+            retry_after = response.headers.get("Retry-After")
+            if retry_after and retry_after.isdigit():
+                return min(float(retry_after), self.retry_max_delay)
+        return random.uniform(0, min(self.retry_max_delay, self.retry_base_delay * (2 ** attempt)))
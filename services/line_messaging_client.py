@@ -0,0 +1,127 @@
+import asyncio
+import logging
+import os
+import uuid
+from typing import Any, Dict, List, Optional, Union
+
+import httpx
+from linebot.exceptions import LineBotApiError
+from linebot.models import Error, SendMessage
+from services.http_client import PooledHttpClient
+from services.metrics import span
+
+logger = logging.getLogger(__name__)
+
+Messages = Union[SendMessage, List[SendMessage]]
+
+# multicastで1回に送れる宛先の上限
+MAX_MULTICAST_RECIPIENTS = 500
+
+
+class LineMessagingClient(PooledHttpClient):
+    """LINE Messaging APIの非同期クライアント（接続を使い回し、429はRetry-Afterに従ってリトライ）"""
+
+    def __init__(self, channel_access_token: str, base_url: Optional[str] = None):
+        super().__init__(
+            max_retries=int(os.getenv("LINE_API_MAX_RETRIES", 3)),
+            retry_base_delay=float(os.getenv("LINE_API_RETRY_BASE_DELAY", 0.5)),
+            retry_max_delay=float(os.getenv("LINE_API_RETRY_MAX_DELAY", 10.0))
+        )
+        self.channel_access_token = channel_access_token
+        self.base_url = base_url or os.getenv("LINE_API_BASE_URL", "https://api.line.me")
+
+    def _create_client(self) -> httpx.AsyncClient:
+        """接続プール付きのHTTPクライアントを作成"""
+        return httpx.AsyncClient(
+            base_url=self.base_url,
+            headers={
+                "Authorization": f"Bearer {self.channel_access_token}",
+                "Content-Type": "application/json"
+            },
+            limits=httpx.Limits(
+                max_connections=int(os.getenv("LINE_API_MAX_CONNECTIONS", 50)),
+                max_keepalive_connections=int(os.getenv("LINE_API_MAX_KEEPALIVE_CONNECTIONS", 20))
+            ),
+            timeout=httpx.Timeout(
+                connect=float(os.getenv("LINE_API_CONNECT_TIMEOUT", 3)),
+                read=float(os.getenv("LINE_API_READ_TIMEOUT", 10)),
+                write=10.0,
+                pool=10.0
+            )
+        )
+
+    @staticmethod
+    def _to_payload(messages: Messages) -> List[Dict[str, Any]]:
+        if not isinstance(messages, (list, tuple)):
+            messages = [messages]
+        return [message.as_json_dict() for message in messages]
+
+    async def reply_message(self, reply_token: str, messages: Messages) -> None:
+        """応答メッセージを送信"""
+        with span("line_reply"):
+            await self._post("/v2/bot/message/reply", {
+                "replyToken": reply_token,
+                "messages": self._to_payload(messages)
+            })
+
+    async def push_message(self, to: str, messages: Messages) -> None:
+        """プッシュメッセージを送信"""
+        with span("line_push"):
+            await self._post("/v2/bot/message/push", {
+                "to": to,
+                "messages": self._to_payload(messages)
+            }, idempotent=True)
+
+    async def multicast(self, to: List[str], messages: Messages) -> None:
+        """複数のユーザーに同じメッセージを送信（500人ずつに分けて送る）"""
+        payload = self._to_payload(messages)
+        with span("line_multicast"):
+            for i in range(0, len(to), MAX_MULTICAST_RECIPIENTS):
+                await self._post("/v2/bot/message/multicast", {
+                    "to": to[i:i + MAX_MULTICAST_RECIPIENTS],
+                    "messages": payload
+                }, idempotent=True)
+
+    async def _post(self, path: str, payload: Dict[str, Any], idempotent: bool = False) -> None:
+        """APIを呼び出す。429と5xxはリトライし、失敗時はLineBotApiErrorを送出"""
+        headers = {}
+        if idempotent:
+            # 同じキーでの再送はLINE側で重複配信されない
+            headers["X-Line-Retry-Key"] = str(uuid.uuid4())
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = await self.client.post(path, json=payload, headers=headers)
+            except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+                if attempt >= self.max_retries:
+                    raise
+                logger.warning("LINE API connection error, retrying (%s/%s): %s", attempt + 1, self.max_retries, e)
+                await asyncio.sleep(self._retry_delay(attempt))
+                continue
+
+            if response.status_code < 400:
+                return
+
+            # 429はRetry-Afterがある場合のみ（月間上限の超過はリトライしても成功しない）
+            retryable = response.status_code >= 500 or (
+                response.status_code == 429 and "Retry-After" in response.headers
+            )
+            if retryable and attempt < self.max_retries:
+                logger.warning("LINE API returned %s, retrying (%s/%s)", response.status_code, attempt + 1, self.max_retries)
+                await asyncio.sleep(self._retry_delay(attempt, response))
+                continue
+
+            raise self._to_error(response)
+
+    @staticmethod
+    def _to_error(response: httpx.Response) -> LineBotApiError:
+        try:
+            error = Error.new_from_json_dict(response.json())
+        except ValueError:
+            error = Error(message=response.text)
+        return LineBotApiError(
+            status_code=response.status_code,
+            headers=dict(response.headers),
+            request_id=response.headers.get("x-line-request-id"),
+            error=error
+        )
@@ -0,0 +1,113 @@
+import atexit
+import copy
+import json
+import logging
+import os
+import queue
+import random
+import sys
+import uuid
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional
+
+# Webhookの受信からサービス・LLM呼び出しまでのログを結び付けるID
+request_id_var: ContextVar[str] = ContextVar("request_id", default="-")
+
+# LogRecordが標準で持つ属性（それ以外はextraとしてJSONに含める）
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "request_id"}
+
+_listener: Optional[QueueListener] = None
+
+
+def bind_request_id(request_id: Optional[str] = None) -> str:
+    """現在のコンテキストにリクエストIDを設定（未指定なら生成）"""
+    request_id = request_id or uuid.uuid4().hex[:16]
+    request_id_var.set(request_id)
+    return request_id
+
+
+class RequestIdFilter(logging.Filter):
+    """ログを出したコンテキストのリクエストIDをレコードに付与"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id_var.get()
+        return True
+
+
+class DebugSamplingFilter(logging.Filter):
+    """DEBUGレベルのログを指定した割合だけ通す（INFO以上はすべて通す）"""
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno > logging.DEBUG or self.rate >= 1.0 or random.random() < self.rate
+
+
+class JsonFormatter(logging.Formatter):
+    """1行1レコードのJSON形式で出力"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "request_id": getattr(record, "request_id", "-"),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class RecordQueueHandler(QueueHandler):
+    """例外情報を残したままレコードをキューに積む（整形はリスナーのスレッドで行う）
+
+    標準のQueueHandler.prepareは例外をメッセージに埋め込んでexc_infoを消すため、JSONの別項目にできない。
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        # 引数はログを出した時点の値で文字列にしておく
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+def setup_logging() -> None:
+    """ルートロガーをキュー経由の非同期出力に設定（複数回呼んでも1回だけ設定）
+
+    リクエスト処理中はレコードをキューに積むだけで、整形と書き込みは別スレッドで行う。
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    if os.getenv("LOG_FORMAT", "json").lower() == "json":
+        stream_handler.setFormatter(JsonFormatter())
+    else:
+        stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s"))
+
+    log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    queue_handler = RecordQueueHandler(log_queue)
+    # フィルタはログを出したスレッドで動くため、ここでリクエストIDを取得する
+    queue_handler.addFilter(DebugSamplingFilter(float(os.getenv("LOG_DEBUG_SAMPLE_RATE", 1.0))))
+    queue_handler.addFilter(RequestIdFilter())
+
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+    # HTTPクライアントはリクエストごとにログを出すため、既定では警告以上のみ
+    for name in ("httpx", "httpcore", "hpack"):
+        logging.getLogger(name).setLevel(os.getenv("LOG_LIBRARY_LEVEL", "WARNING").upper())
+
+    _listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
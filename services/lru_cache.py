@@ -0,0 +1,119 @@
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Generic, Hashable, Optional, Tuple, TypeVar
+
+V = TypeVar("V")
+
+
+def estimate_text_bytes(text: Optional[str]) -> int:
+    """キャッシュ上のおおよそのメモリ使用量（日本語1文字を3バイトとして概算）"""
+    return len(text or "") * 3
+
+
+class TTLCache(Generic[V]):
+    """件数・メモリの上限とTTL付きのLRUキャッシュ
+
+    - max_entriesを超えると最も長く使われていないエントリから削除する
+    - max_bytes指定時はsize_ofで見積もった合計サイズも上限にする
+    - ttlがNoneならエントリは期限切れにならない（setのttlでエントリごとに上書きできる）
+    """
+
+    def __init__(
+        self,
+        max_entries: int,
+        ttl: Optional[float] = None,
+        max_bytes: Optional[int] = None,
+        size_of: Optional[Callable[[V], int]] = None
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.size_of = size_of
+        # key -> (値, 失効するmonotonic時刻, サイズ)
+        self._entries: "OrderedDict[Hashable, Tuple[V, float, int]]" = OrderedDict()
+        self._total_bytes = 0
+        self.stats: Dict[str, int] = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def total_bytes(self) -> int:
+        return self._total_bytes
+
+    def _fresh(self, key: Hashable) -> Optional[Tuple[V, float, int]]:
+        """期限内のエントリを返す（期限切れなら削除）"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if time.monotonic() >= entry[1]:
+            self._remove(key)
+            self.stats['expirations'] += 1
+            return None
+        return entry
+
+    def get(self, key: Hashable, usable: Optional[Callable[[V], bool]] = None) -> Optional[V]:
+        """期限内の値を返してLRUの末尾に移す（usableがFalseを返す値はミスとして扱う）"""
+        entry = self._fresh(key)
+        if entry is None or (usable is not None and not usable(entry[0])):
+            self.stats['misses'] += 1
+            return None
+        self._entries.move_to_end(key)
+        self.stats['hits'] += 1
+        return entry[0]
+
+    def peek(self, key: Hashable) -> Optional[V]:
+        """期限内の値を返す（ヒット数やLRUの順序は変えない）"""
+        entry = self._fresh(key)
+        return entry[0] if entry is not None else None
+
+    def set(self, key: Hashable, value: V, ttl: Optional[float] = None) -> None:
+        """値を保存（ttlを省略した場合はキャッシュのttl、0以下なら保存せずに削除）"""
+        ttl = self.ttl if ttl is None else ttl
+        if ttl is not None and ttl <= 0:
+            self._remove(key)
+            return
+        deadline = time.monotonic() + ttl if ttl is not None else float("inf")
+        self._store(key, value, deadline)
+
+    def update(self, key: Hashable, value: V) -> bool:
+        """期限を変えずに値を置き換える（エントリがなければFalse）"""
+        entry = self._fresh(key)
+        if entry is None:
+            return False
+        self._store(key, value, entry[1])
+        return True
+
+    def pop(self, key: Hashable) -> Optional[V]:
+        entry = self._remove(key)
+        return entry[0] if entry is not None else None
+
+    def _store(self, key: Hashable, value: V, deadline: float) -> None:
+        self._remove(key)
+        size = self.size_of(value) if self.size_of else 0
+        self._entries[key] = (value, deadline, size)
+        self._total_bytes += size
+        while self._entries and (
+            len(self._entries) > self.max_entries
+            or (self.max_bytes is not None and self._total_bytes > self.max_bytes)
+        ):
+            _, (_, _, evicted_size) = self._entries.popitem(last=False)
+            self._total_bytes -= evicted_size
+            self.stats['evictions'] += 1
+
+    def _remove(self, key: Hashable) -> Optional[Tuple[V, float, int]]:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._total_bytes -= entry[2]
+        return entry
+
+    def get_stats(self) -> Dict[str, Any]:
+        lookups = self.stats['hits'] + self.stats['misses']
+        stats: Dict[str, Any] = {
+            **self.stats,
+            'entries': len(self._entries),
+            'hit_ratio': self.stats['hits'] / lookups if lookups else 0.0
+        }
+        if self.max_bytes is not None:
+            stats['bytes'] = self._total_bytes
+        return stats
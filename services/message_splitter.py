@@ -0,0 +1,54 @@
+import re
+from typing import List
+
+# LINEで一度に送れるメッセージの上限
+LINE_MAX_MESSAGES = 5
+
+
+class LineBubbleSplitter:
+    """ストリーミング応答を文末で区切り、LINEの吹き出し単位に分割する"""
+
+    SENTENCE_END = re.compile(r"[。！？!?…\n]+[」』）)]*")
+
+    def __init__(self, max_bubbles: int = LINE_MAX_MESSAGES, min_chars: int = 60, first_min_chars: int = 20):
+        self.max_bubbles = max_bubbles
+        self.min_chars = min_chars
+        self.first_min_chars = first_min_chars
+        self.emitted = 0
+        self._buffer = ""
+
+    def feed(self, text: str) -> List[str]:
+        """テキストの差分を追加し、確定した吹き出しを返す"""
+        self._buffer += text
+        bubbles = []
+        # 最後の1通は残りのテキストをまとめるために取っておく
+        while self.emitted < self.max_bubbles - 1:
+            threshold = self.first_min_chars if self.emitted == 0 else self.min_chars
+            cut = self._find_cut(threshold)
+            if cut is None:
+                break
+            bubble = self._buffer[:cut].strip()
+            self._buffer = self._buffer[cut:]
+            if bubble:
+                bubbles.append(bubble)
+                self.emitted += 1
+        return bubbles
+
+    def flush(self) -> List[str]:
+        """ストリーム終了時に残りのテキストを最後の吹き出しとして返す"""
+        bubble = self._buffer.strip()
+        self._buffer = ""
+        if not bubble:
+            return []
+        self.emitted += 1
+        return [bubble]
+
+    def _find_cut(self, threshold: int):
+        """閾値以上の長さで区切れる文末の位置を探す"""
+        for match in self.SENTENCE_END.finditer(self._buffer):
+            # 直後の文字が届くまでは文末記号や閉じ括弧が続く可能性があるため確定しない
+            if match.end() >= len(self._buffer):
+                return None
+            if match.end() >= threshold:
+                return match.end()
+        return None
@@ -0,0 +1,225 @@
+import time
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple, Type
+
+# 処理段階ごとのレイテンシ用のバケット（秒）
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: Sequence[Tuple[str, str]]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+class _Timer:
+    """withブロックの経過時間をヒストグラムに記録する"""
+    __slots__ = ("_child", "_started")
+
+    def __init__(self, child: "_HistogramChild"):
+        self._child = child
+
+    def __enter__(self) -> "_Timer":
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._child.observe(time.perf_counter() - self._started)
+
+
+class _CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0) -> None:
+        self.value += amount
+
+
+class _GaugeChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+
+class _HistogramChild:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self) -> _Timer:
+        return _Timer(self)
+
+
+class Metric(ABC):
+    """ラベルの値ごとに子メトリクスを持つPrometheus形式のメトリクス
+
+    更新はイベントループ上で行う前提でロックを取らない。
+    よく使うラベルはlabels()の戻り値を保持しておくと辞書の参照も省ける。
+    """
+    metric_type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], object] = {}
+
+    @abstractmethod
+    def _new_child(self):
+        """ラベルの値の組ごとの子メトリクスを作成"""
+
+    def labels(self, *values: str):
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}")
+            child = self._children[values] = self._new_child()
+        return child
+
+    def _samples(self) -> Iterable[Tuple[str, List[Tuple[str, str]], float]]:
+        for values, child in self._children.items():
+            yield "", list(zip(self.labelnames, values)), child.value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}"]
+        for suffix, labels, value in self._samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(labels)} {_format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    metric_type = "counter"
+
+    def _new_child(self) -> _CounterChild:
+        return _CounterChild()
+
+    def inc(self, amount: float = 1.0) -> None:
+        self.labels().inc(amount)
+
+
+class Gauge(Metric):
+    metric_type = "gauge"
+
+    def _new_child(self) -> _GaugeChild:
+        return _GaugeChild()
+
+    def set(self, value: float) -> None:
+        self.labels().set(value)
+
+
+class Histogram(Metric):
+    metric_type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self) -> _HistogramChild:
+        return _HistogramChild(self.buckets)
+
+    def _samples(self):
+        for values, child in self._children.items():
+            labels = list(zip(self.labelnames, values))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), child.counts):
+                cumulative += count
+                yield "_bucket", labels + [("le", _format_value(bound))], cumulative
+            yield "_sum", labels, child.sum
+            yield "_count", labels, child.count
+
+
+class MetricsRegistry:
+    """メトリクスを保持し、Prometheusのテキスト形式で出力するレジストリ"""
+
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+
+    def _register(self, metric: Metric) -> Metric:
+        existing = self._metrics.get(metric.name)
+        if existing is not None:
+            return existing
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self, collectors: Iterable[Callable[[], Iterable[Metric]]] = ()) -> str:
+        """登録済みのメトリクスと、collectorsが出力時に作るメトリクスをテキスト形式にする"""
+        lines: List[str] = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        for collector in collectors:
+            for metric in collector():
+                lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    "line_bot_stage_duration_seconds",
+    "Time spent in each stage of handling a LINE message",
+    ["stage"]
+)
+MESSAGES = REGISTRY.counter(
+    "line_bot_messages_total",
+    "LINE text messages handled, by outcome",
+    ["outcome"]
+)
+LLM_TOKENS = REGISTRY.counter(
+    "line_bot_llm_tokens_total",
+    "LLM tokens sent and received (provider usage when available, otherwise estimated)",
+    ["direction"]
+)
+
+
+def span(stage: str) -> _Timer:
+    """処理段階の所要時間を計測するコンテキストマネージャ
+
+    with span("llm"):
+        ...
+    """
+    return STAGE_SECONDS.labels(stage).time()
+
+
+def from_stats(metric_class: Type[Metric], name: str, documentation: str, labelnames: Sequence[str],
+               values: Dict[Tuple[str, ...], Optional[float]]) -> Metric:
+    """get_stats()の値から出力時に使うメトリクスを作成（値がNoneのものは省略）"""
+    metric = metric_class(name, documentation, labelnames)
+    for labels, value in values.items():
+        if value is not None:
+            metric.labels(*labels).value = float(value)
+    return metric
@@ -0,0 +1,98 @@
+import os
+import re
+from typing import Any, Dict, List, Optional
+
+# モデルごとの入力トークン予算（出力分のmax_tokensは含まない）
+MODEL_TOKEN_BUDGETS = {
+    "anthropic/claude-3-haiku": 8000,
+}
+DEFAULT_TOKEN_BUDGET = 4000
+
+# メッセージ1件ごとにロール等で加算される概算トークン数
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# ひらがな・カタカナ・漢字・全角記号（おおよそ1文字1トークン）
+_CJK_PATTERN = re.compile(r"[\u3000-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff00-\uffef]")
+# ASCIIの単語や記号（おおよそ4文字1トークン）
+_ASCII_PATTERN = re.compile(r"[\x00-\x7f]")
+
+
+def estimate_tokens(text: str) -> int:
+    """日本語を考慮してテキストのトークン数を概算"""
+    if not text:
+        return 0
+    cjk = len(_CJK_PATTERN.findall(text))
+    ascii_chars = len(_ASCII_PATTERN.findall(text))
+    # 絵文字などその他の文字は1文字あたり2トークンとみなす
+    other = len(text) - cjk - ascii_chars
+    return cjk + (ascii_chars + 3) // 4 + other * 2
+
+
+def estimate_message_tokens(message: Dict[str, Any]) -> int:
+    """チャットメッセージ1件のトークン数を概算"""
+    content = message.get("content", "")
+    if isinstance(content, list):
+        content = "".join(part.get("text", "") for part in content)
+    return estimate_tokens(content) + MESSAGE_OVERHEAD_TOKENS
+
+
+def get_token_budget(model: str) -> int:
+    """モデルの入力トークン予算（PROMPT_TOKEN_BUDGETで上書き可能）"""
+    override = os.getenv("PROMPT_TOKEN_BUDGET")
+    if override:
+        return int(override)
+    return MODEL_TOKEN_BUDGETS.get(model, DEFAULT_TOKEN_BUDGET)
+
+
+class BuiltPrompt:
+    """組み立て済みのプロンプトとそのトークン数"""
+
+    def __init__(self, messages: List[Dict[str, Any]], token_count: int, budget: int, dropped_messages: int):
+        self.messages = messages
+        self.token_count = token_count
+        self.budget = budget
+        self.dropped_messages = dropped_messages
+
+    @property
+    def over_budget(self) -> bool:
+        return self.token_count > self.budget
+
+
+class PromptBuilder:
+    """トークン予算内に収まるようにプロンプトを組み立てる"""
+
+    def __init__(self, budget: int):
+        self.budget = budget
+
+    def build(
+        self,
+        head: List[Dict[str, Any]],
+        history: List[Dict[str, Any]],
+        tail: List[Dict[str, Any]],
+        head_tokens: Optional[int] = None
+    ) -> BuiltPrompt:
+        """head（固定プレフィックス等）とtail（新しいメッセージ等）は必ず含め、履歴は古い順に削る
+
+        head_tokensを渡すとheadのトークン数の再計算を省略する。
+        """
+        fixed_tokens = (head_tokens if head_tokens is not None else sum(estimate_message_tokens(m) for m in head))
+        fixed_tokens += sum(estimate_message_tokens(m) for m in tail)
+
+        # 新しい履歴から順に予算の残りに収まるだけ採用
+        remaining = self.budget - fixed_tokens
+        kept: List[Dict[str, Any]] = []
+        history_tokens = 0
+        for message in reversed(history):
+            tokens = estimate_message_tokens(message)
+            if history_tokens + tokens > remaining:
+                break
+            kept.append(message)
+            history_tokens += tokens
+        kept.reverse()
+
+        return BuiltPrompt(
+            messages=[*head, *kept, *tail],
+            token_count=fixed_tokens + history_tokens,
+            budget=self.budget,
+            dropped_messages=len(history) - len(kept)
+        )
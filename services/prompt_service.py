@@ -1,22 +1,98 @@
 import json
+import logging
 import os
-from typing import Dict, List, Optional
+import time
+from typing import Dict, List, Optional, Tuple
 from pathlib import Path
+from services.prompt_builder import estimate_message_tokens
+
+logger = logging.getLogger(__name__)
+
+class CharacterPrefix:
+    """キャラクターごとの固定プレフィックス（読み込み時に一度だけ組み立てる）
+
+    messagesは全ユーザーで共有するため、呼び出し側で変更しないこと。
+    """
+
+    def __init__(self, character: str, messages: Tuple[Dict, ...], cached_messages: Tuple[Dict, ...], token_count: int):
+        self.character = character
+        self.messages = messages
+        self.cached_messages = cached_messages  # 末尾にcache_controlを付けたもの
+        self.token_count = token_count
+
+    def get_messages(self, cache_control: bool = False) -> Tuple[Dict, ...]:
+        """プロンプトキャッシュ対応のプロバイダ向けにはcache_control付きを返す"""
+        return self.cached_messages if cache_control else self.messages
+
 
 class PromptService:
-    def __init__(self):
+    def __init__(self, prompt_file: Optional[Path] = None, reload_interval: Optional[float] = None):
         self.prompts: Dict = {}
+        self.prefixes: Dict[str, CharacterPrefix] = {}
+        self.prompt_file = prompt_file or Path(__file__).parent.parent / 'prompts' / 'characters.json'
+        # ファイル変更の確認間隔（秒）。0以下で自動再読み込みを無効化
+        self.reload_interval = reload_interval if reload_interval is not None else float(os.getenv("PROMPT_RELOAD_INTERVAL", 2))
+        self._mtime: Optional[float] = None
+        self._last_checked = 0.0
         self.load_prompts()
 
     def load_prompts(self) -> None:
         """プロンプトファイルを読み込む"""
         try:
-            prompt_file = Path(__file__).parent.parent / 'prompts' / 'characters.json'
-            with open(prompt_file, 'r', encoding='utf-8') as f:
-                self.prompts = json.load(f)
+            mtime = os.stat(self.prompt_file).st_mtime
+            with open(self.prompt_file, 'r', encoding='utf-8') as f:
+                prompts = json.load(f)
+            self.prefixes = {character: self._build_prefix(character, prompt) for character, prompt in prompts.items()}
+            self.prompts = prompts
+            self._mtime = mtime
+            logger.info("Loaded prompts for characters: %s", ', '.join(self.prompts))
         except Exception as e:
-            print(f"Error loading prompts: {e}")
-            self.prompts = {}
+            logger.error("Error loading prompts: %s", e)
+            # 再読み込みに失敗した場合は直前の内容を使い続ける
+            if not self.prompts:
+                self.prompts = {}
+                self.prefixes = {}
+
+    def _build_prefix(self, character: str, prompt: Dict) -> CharacterPrefix:
+        """システムメッセージ・指示メッセージ・会話例から固定プレフィックスを作成"""
+        messages = (
+            {"role": "system", "content": prompt.get("system", "")},
+            {"role": "user", "content": prompt.get("user_instruction", "")},
+            *({"role": m["role"], "content": m["content"]} for m in prompt.get("example_conversation", []))
+        )
+
+        # 最後のメッセージにキャッシュの区切りを付けると、それ以前すべてがキャッシュ対象になる
+        last = messages[-1]
+        cached_last = {
+            "role": last["role"],
+            "content": [{"type": "text", "text": last["content"], "cache_control": {"type": "ephemeral"}}]
+        }
+        cached_messages = (*messages[:-1], cached_last)
+
+        token_count = sum(estimate_message_tokens(m) for m in messages)
+        return CharacterPrefix(character, messages, cached_messages, token_count)
+
+    def _reload_if_changed(self) -> None:
+        """一定間隔でファイルの更新日時を確認し、変更されていれば再読み込み"""
+        if self.reload_interval <= 0:
+            return
+        now = time.monotonic()
+        if now - self._last_checked < self.reload_interval:
+            return
+        self._last_checked = now
+        try:
+            mtime = os.stat(self.prompt_file).st_mtime
+        except OSError as e:
+            logger.error("Error checking prompt file: %s", e)
+            return
+        if mtime != self._mtime:
+            logger.info("Prompt file changed, reloading")
+            self.load_prompts()
+
+    def get_prefix(self, character: str = "ojou") -> Optional[CharacterPrefix]:
+        """指定されたキャラクターの固定プレフィックスを取得"""
+        self._reload_if_changed()
+        return self.prefixes.get(character, self.prefixes.get("ojou"))
 
     def get_character_prompt(self, character: str = "ojou") -> Dict:
         """指定されたキャラクターのプロンプトを取得"""
@@ -35,4 +111,4 @@ class PromptService:
     def get_example_conversation(self, character: str = "ojou") -> List[Dict]:
         """会話例を取得"""
         prompt = self.get_character_prompt(character)
-        return prompt.get("example_conversation", []) 
\ No newline at end of file
+        return prompt.get("example_conversation", [])
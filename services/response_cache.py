@@ -0,0 +1,68 @@
+import hashlib
+import re
+import unicodedata
+from typing import Dict, List, Optional, Tuple
+
+from models.conversation import Message
+from services.lru_cache import TTLCache, estimate_text_bytes
+
+# 正規化で取り除く末尾の記号（NFKC後の半角を含む）
+_TRAILING_PUNCTUATION = "!?。、.,…~〜♪"
+_WHITESPACE = re.compile(r"\s+")
+
+CacheKey = Tuple[str, str, str, str]
+
+
+def normalize_message(text: str) -> str:
+    """全角・半角、大文字・小文字、空白、末尾の記号の違いを無視した比較用の文字列"""
+    text = unicodedata.normalize("NFKC", text).lower()
+    return _WHITESPACE.sub("", text).rstrip(_TRAILING_PUNCTUATION)
+
+
+def history_fingerprint(history: List[Message], max_chars: int = 200) -> str:
+    """会話履歴の各メッセージの先頭max_chars文字から作るハッシュ"""
+    digest = hashlib.sha1()
+    for message in history:
+        digest.update(message.role.encode())
+        digest.update(b"\0")
+        digest.update(normalize_message((message.content or message.text or "")[:max_chars]).encode())
+        digest.update(b"\0")
+    return digest.hexdigest()[:16]
+
+
+class ResponseCache:
+    """短い定型的なメッセージへの応答を保持するLRUキャッシュ（TTLとメモリ上限付き）
+
+    (キャラクター, 正規化したメッセージ, 会話履歴のハッシュ, 呼びかける名前)をキーにする。
+    会話履歴がmax_history件以下、メッセージがmax_message_chars文字以下のときだけ使う。
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 2000,
+        ttl: float = 3600,
+        max_bytes: int = 8 * 1024 * 1024,
+        max_history: int = 2,
+        max_message_chars: int = 30
+    ):
+        self.max_history = max_history
+        self.max_message_chars = max_message_chars
+        self._cache: TTLCache[str] = TTLCache(max_entries, ttl=ttl, max_bytes=max_bytes, size_of=estimate_text_bytes)
+        self.bypassed = 0
+
+    def key(self, character: str, message_text: str, history: List[Message], user_name: Optional[str] = None) -> Optional[CacheKey]:
+        """キャッシュに使えるメッセージならキーを返す（履歴が長い・メッセージが長い場合はNone）"""
+        normalized = normalize_message(message_text)
+        if not normalized or len(normalized) > self.max_message_chars or len(history) > self.max_history:
+            self.bypassed += 1
+            return None
+        return (character, normalized, history_fingerprint(history), user_name or "")
+
+    def get(self, key: CacheKey) -> Optional[str]:
+        return self._cache.get(key)
+
+    def put(self, key: CacheKey, response: str) -> None:
+        self._cache.set(key, response)
+
+    def get_stats(self) -> Dict[str, float]:
+        return {**self._cache.get_stats(), 'bypassed': self.bypassed}
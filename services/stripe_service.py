@@ -1,9 +1,13 @@
+import logging
 import stripe
+import time
 from datetime import datetime
 from models.user import User
 import os
 from dotenv import load_dotenv
-from typing import Optional
+from typing import Optional, Tuple
+
+logger = logging.getLogger(__name__)
 
 # 明示的に.envを読み込む
 load_dotenv()
@@ -12,22 +16,39 @@ class StripeService:
     def __init__(self):
         self.stripe = stripe
         self.stripe.api_key = os.getenv('STRIPE_SECRET_KEY')
+        # stripe-mockやローカルの代替サーバーに向ける場合に指定
+        if os.getenv('STRIPE_API_BASE'):
+            self.stripe.api_base = os.getenv('STRIPE_API_BASE')
         self.PRICE_IDS = {
             'month': os.getenv('STRIPE_PRICE_ID_month'),
             'year': os.getenv('STRIPE_PRICE_ID_year')
         }
         self.SUCCESS_URL = os.getenv('SUCCESS_URL', 'http://localhost:8000/success')
         self.CANCEL_URL = os.getenv('CANCEL_URL', 'http://localhost:8000/cancel')
-        print(f"Stripe API Key loaded: {stripe.api_key[:10]}...")  # デバッグ用（最初の10文字のみ表示）
 
     def create_checkout_session(self, user_id: Optional[str], plan_type: str = 'month') -> Optional[str]:
         """Stripeのチェックアウトセッションを作成"""
+        result = self.create_checkout_session_with_expiry(user_id, plan_type)
+        return result[0] if result else None
+
+    def create_checkout_session_with_expiry(
+        self,
+        user_id: Optional[str],
+        plan_type: str = 'month',
+        ttl: Optional[int] = None
+    ) -> Optional[Tuple[str, float]]:
+        """チェックアウトセッションを作成し、URLと有効期限（UNIX時刻）を返す
+
+        ttlは30分〜24時間（秒）。未指定ならStripeの既定（24時間）。ブロッキングな呼び出し。
+        stripe-mockは固定の有効期限を返すため、有効期限はリクエストで指定した値を返す。
+        """
         try:
             price_id = self.PRICE_IDS.get(plan_type)
             if not price_id:
-                print(f"Invalid plan type: {plan_type}")
+                logger.warning("Invalid plan type: %s", plan_type)
                 return None
 
+            expires_at = int(time.time()) + (ttl or 24 * 3600)
             session = self.stripe.checkout.Session.create(
                 payment_method_types=['card'],
                 line_items=[{
@@ -41,11 +62,12 @@ class StripeService:
                 metadata={
                     'user_id': user_id,
                     'plan_type': plan_type
-                } if user_id else None
+                } if user_id else None,
+                expires_at=expires_at
             )
-            
-            return session.url
+
+            return session.url, expires_at
 
         except Exception as e:
-            print(f"Error creating checkout session: {e}")
-            return None 
\ No newline at end of file
+            logger.error("Error creating checkout session: %s", e)
+            return None
@@ -0,0 +1,96 @@
+import logging
+from typing import Optional, Set, Tuple
+from services.conversation_service import ConversationService
+from services.ai_service import AIService
+from services.lru_cache import TTLCache
+from services.work_queue import WorkQueue
+
+logger = logging.getLogger(__name__)
+
+# 1回の応答で増えるメッセージ数（ユーザーのメッセージと応答）
+MESSAGES_PER_TURN = 2
+
+
+class SummaryService:
+    """古い会話を要約に圧縮するバックグラウンド処理
+
+    プロンプトには最新の要約と直近RECENT_WINDOW件だけを含めるため、要約以降のメッセージが
+    MAX_MESSAGES_PER_SUMMARY件（RECENT_WINDOW以下）を超えた時点で要約し、直近keep_recent件だけを残す。
+    要約以降のメッセージ数はプロセス内で数え、check_interval回ごとにFirestoreの件数で確かめる。
+    """
+
+    def __init__(
+        self,
+        conversation_service: ConversationService,
+        ai_service: AIService,
+        queue: WorkQueue,
+        check_interval: int = 10,
+        keep_recent: Optional[int] = None,
+        max_entries: int = 10000
+    ):
+        self.conversation_service = conversation_service
+        self.ai_service = ai_service
+        self.queue = queue
+        self.check_interval = check_interval  # Firestoreの件数で確かめる応答の間隔
+        self.threshold = conversation_service.MAX_MESSAGES_PER_SUMMARY
+        # 要約後に残す件数（少ないほど要約の頻度が下がる）
+        self.keep_recent = min(keep_recent if keep_recent is not None else self.threshold // 2, self.threshold)
+        # (user_id, conversation_id) -> (要約以降のメッセージ数の見込み, 前回確かめてからの応答数)
+        self._message_counts: TTLCache[Tuple[int, int]] = TTLCache(max_entries)
+        self._in_progress: Set[Tuple[str, str]] = set()
+
+    def _set_count(self, key: Tuple[str, str], count: int, turns: int = 0) -> None:
+        self._message_counts.set(key, (count, turns))
+
+    def schedule(self, user_id: str, conversation_id: str) -> None:
+        """応答後に呼び出し、要約以降のメッセージが閾値を超えたら要約処理をキューに投入"""
+        key = (user_id, conversation_id)
+        entry = self._message_counts.peek(key)
+        # このプロセスで初めて見る会話はすぐに確認する
+        if entry is not None:
+            count, turns = entry[0] + MESSAGES_PER_TURN, entry[1] + 1
+            self._set_count(key, count, turns)
+            if key in self._in_progress or (count <= self.threshold and turns < self.check_interval):
+                return
+        elif key in self._in_progress:
+            return
+
+        if self.queue.submit(self.summarize_if_needed, user_id, conversation_id):
+            self._in_progress.add(key)
+
+    async def summarize_if_needed(self, user_id: str, conversation_id: str) -> None:
+        """要約以降のメッセージが閾値を超えていれば、直近の会話を残して要約に圧縮"""
+        key = (user_id, conversation_id)
+        try:
+            latest_summaries = await self.conversation_service.get_summaries(user_id, conversation_id, limit=1)
+            latest = latest_summaries[0] if latest_summaries else None
+            # 確認中に増えたメッセージは_message_countsに加算される
+            self._set_count(key, 0)
+            count = await self.conversation_service.count_messages_after(user_id, conversation_id, latest)
+            if count <= self.threshold:
+                self._set_count(key, (self._message_counts.peek(key) or (0, 0))[0] + count)
+                return
+
+            messages = await self.conversation_service.get_messages_since(
+                user_id, conversation_id, latest.covered_until if latest else None
+            )
+            # 直近のメッセージはそのままプロンプトに含めるので要約対象外
+            to_compact = messages[:-self.keep_recent] if self.keep_recent else messages
+            if not to_compact:
+                return
+
+            summary = await self.ai_service.generate_summary(to_compact)
+            if latest:
+                summary = await self.ai_service.combine_summaries([latest.text, summary])
+
+            await self.conversation_service.add_summary(
+                user_id, conversation_id, summary, covered_until=to_compact[-1].timestamp
+            )
+            self._set_count(key, (self._message_counts.peek(key) or (0, 0))[0] + len(messages) - len(to_compact))
+            logger.info("Created summary of %s messages for user: %s", len(to_compact), user_id)
+        except Exception:
+            # 次の応答で確認し直す
+            self._message_counts.pop(key)
+            raise
+        finally:
+            self._in_progress.discard(key)
@@ -1,26 +1,50 @@
+import logging
 from datetime import datetime, date, timedelta, timezone
 from typing import Optional, Tuple
 from models.user import User
 from models.conversation import Message
 from services.conversation_service import ConversationService
+from services.checkout_links import CheckoutLinkProvider
 from services.stripe_service import StripeService
+from services.firestore_client import AsyncFirestore
+from services.entitlement_cache import Entitlement, EntitlementCache
 import os
-from google.cloud.firestore import Client
+from google.cloud.firestore import Client, Increment
 from firebase_admin.exceptions import FirebaseError
 
+logger = logging.getLogger(__name__)
+
 class UserService:
-    def __init__(self, db: Client, conversation_service: ConversationService):
+    # 期限切れの案内にURLを載せられなかった場合の文面（URLは返信の後に送る）
+    SUBSCRIPTION_END_PENDING_LINK_MESSAGE = """🤖「サブスクの有効期限が切れました。
+引き続き無制限で相談するには、再登録をお願いします！✨
+再登録のリンクはこのあとお送りします。」"""
+
+    def __init__(
+        self,
+        db: Client,
+        conversation_service: ConversationService,
+        firestore: Optional[AsyncFirestore] = None,
+        entitlement_cache: Optional[EntitlementCache] = None,
+        checkout_links: Optional[CheckoutLinkProvider] = None
+    ):
         try:
             self.db = db
             self.conversation_service = conversation_service
+            self.firestore = firestore or AsyncFirestore()
+            self.entitlement_cache = entitlement_cache  # 指定時は相談可否の判定結果をキャッシュ
             self.users_ref = db.collection('users')
             self.MONTHLY_SUBSCRIPTION_DAYS = 30
             self.YEARLY_SUBSCRIPTION_DAYS = 365
-            self.stripe_service = StripeService()
-            print("Database connection initialized successfully")
+            # 再登録用のチェックアウトURLはStripeを待たずにキャッシュから取得する
+            self.checkout_links = checkout_links or CheckoutLinkProvider(StripeService())
+            self.CHECKOUT_PREWARM_WINDOW = float(os.getenv('CHECKOUT_PREWARM_WINDOW', 6 * 3600))
+            # 自動更新のサブスクは、更新のWebhookが届くまで期間の終了後もこの秒数だけ有効にしておく
+            self.EXPIRY_GRACE_PERIOD = float(os.getenv('EXPIRY_GRACE_PERIOD', 3 * 24 * 3600))
+            logger.info("Database connection initialized successfully")
             self.initialize_collections()
         except Exception as e:
-            print(f"Error initializing database connection: {e}")
+            logger.error("Error initializing database connection: %s", e)
             raise
 
     def get_now_utc(self) -> datetime:
@@ -32,15 +56,49 @@ class UserService:
         now = self.get_now_utc()
         return datetime(now.year, now.month, now.day, tzinfo=timezone.utc)
 
-    def get_subscription_end_message(self) -> str:
+    def get_tomorrow_utc(self) -> datetime:
+        """UTCのタイムゾーン情報付きの翌日の日付（00:00）を取得"""
+        return self.get_today_utc() + timedelta(days=1)
+
+    def _cache_entitlement(self, user_id: str, state: str, valid_until: Optional[datetime] = None) -> None:
+        if self.entitlement_cache:
+            self.entitlement_cache.set(user_id, state, valid_until)
+
+    def _invalidate_entitlement(self, user_id: str) -> None:
+        if self.entitlement_cache:
+            self.entitlement_cache.invalidate(user_id)
+
+    def get_subscription_end_message(self, user_id: str) -> str:
+        """期限切れの案内（URLが用意できていなければ作成を予約し、URLは後から送る旨の案内を返す）"""
         try:
-            checkout_url = self.stripe_service.create_checkout_session(None, 'month')
-            return f"""🤖「サブスクの有効期限が切れました。引き続き無制限で相談するには、再登録をお願いします！✨
+            checkout_url = self.checkout_links.get_cached(user_id, 'month')
+            if checkout_url:
+                return f"""🤖「サブスクの有効期限が切れました。引き続き無制限で相談するには、再登録をお願いします！✨
 👉【再登録はこちら】{checkout_url}」"""
         except Exception as e:
-            print(f"Error creating checkout URL: {e}")
-            return """🤖「サブスクの有効期限が切れました。
-引き続き無制限で相談するには、「サブスク」と送信して再登録をお願いします！✨」"""
+            logger.error("Error getting checkout URL: %s", e)
+        return self.SUBSCRIPTION_END_PENDING_LINK_MESSAGE
+
+    async def is_subscribed(self, user_id: str) -> bool:
+        """有効なサブスクに登録済みか"""
+        if self.entitlement_cache and self.entitlement_cache.get(user_id) == Entitlement.PAID:
+            return True
+        user = await self.get_user(user_id)
+        if not user or not user.is_paid:
+            return False
+        return user.subscription_end is None or self.get_now_utc() <= user.subscription_end
+
+    def needs_checkout_link_followup(self, message: Optional[str]) -> bool:
+        """URLを載せられなかった期限切れの案内か（この場合は返信の後にURLを送る）"""
+        return message == self.SUBSCRIPTION_END_PENDING_LINK_MESSAGE
+
+    async def get_checkout_link(self, user_id: str) -> Optional[str]:
+        """再登録用のURLを取得（キャッシュになければStripeで作成するまで待つ、失敗時はNone）"""
+        try:
+            return await self.checkout_links.get(user_id, 'month')
+        except Exception as e:
+            logger.error("Error getting checkout URL: %s", e)
+            return None
 
     def get_limit_exceeded_message(self, user_id: str) -> str:
         return """🤖「本日の無料相談回数を超えました！
@@ -56,42 +114,54 @@ class UserService:
         now_utc = self.get_now_utc()
         if user.subscription_end and now_utc > user.subscription_end:
             await self.deactivate_subscription(user.user_id)
-            return False, self.get_subscription_end_message()
+            return False, self.get_subscription_end_message(user.user_id)
 
         return True, None
 
-    def get_user(self, user_id: str) -> Optional[User]:
+    async def get_user(self, user_id: str) -> Optional[User]:
         try:
-            print(f"Getting user data for: {user_id}")
-            doc = self.users_ref.document(user_id).get()
+            logger.debug("Getting user data for: %s", user_id)
+            doc = await self.firestore.get(self.users_ref.document(user_id))
             if doc.exists:
-                print(f"User data found: {doc.to_dict()}")
+                logger.debug("User data found for: %s", user_id)
                 return User.from_dict(doc.to_dict())
-            print("User not found")
+            logger.debug("User not found")
             return None
         except FirebaseError as e:
-            print(f"Firebase error in get_user: {e}")
+            logger.error("Firebase error in get_user: %s", e)
             raise
         except Exception as e:
-            print(f"Unexpected error in get_user: {e}")
+            logger.error("Unexpected error in get_user: %s", e)
             raise
 
-    async def can_consult(self, user_id: str) -> Tuple[bool, str]:
+    async def create_user(self, user_id: str, consume_consultation: bool = False) -> User:
+        """ユーザーを新規作成（初回相談分のカウントも同じ書き込みで記録できる）"""
+        logger.debug("Creating new user: %s", user_id)
+        user = User(user_id)
+        if consume_consultation:
+            user.consultation_count = 1
+            user.last_consultation_date = self.get_today_utc()
         try:
-            user = self.get_user(user_id)
-            
+            await self.firestore.set(self.users_ref.document(user_id), user.to_dict())
+            logger.debug("New user created successfully: %s", user_id)
+        except Exception as e:
+            logger.error("Error creating new user: %s", e)
+            raise
+        if consume_consultation:
+            self._cache_entitlement(user_id, Entitlement.LIMIT_EXCEEDED, self.get_tomorrow_utc())
+        return user
+
+    async def can_consult(self, user_id: str, user: Optional[User] = None) -> Tuple[bool, str]:
+        """相談可否を判定（取得済みのユーザー情報を渡すと再読み込みしない）"""
+        try:
+            if user is None:
+                user = await self.get_user(user_id)
+
             if not user:
-                print(f"Creating new user: {user_id}")
-                user = User(user_id)
-                try:
-                    self.users_ref.document(user_id).set(user.to_dict())
-                    print(f"New user created successfully: {user_id}")
-                except Exception as e:
-                    print(f"Error creating new user: {e}")
-                    raise
+                await self.create_user(user_id)
                 return True, "新規ユーザー"
 
-            print(f"Checking consultation status for user: {user_id}")
+            logger.debug("Checking consultation status for user: %s", user_id)
             
             # サブスクリプションのチェック
             is_active, message = await self.check_subscription_status(user)
@@ -99,6 +169,9 @@ class UserService:
                 return False, message
             
             if is_active:
+                self._cache_entitlement(user_id, Entitlement.PAID, user.subscription_end)
+                # 期限が近ければ、期限切れの案内に使うURLを先に作成しておく
+                self.checkout_links.prewarm_if_expiring(user_id, user.subscription_end, self.CHECKOUT_PREWARM_WINDOW)
                 return True, "メンバー"
 
             today_utc = self.get_today_utc()
@@ -114,32 +187,53 @@ class UserService:
             if last_date.date() != today_utc.date():
                 return True, "無料相談可能"
                 
+            self._cache_entitlement(user_id, Entitlement.LIMIT_EXCEEDED, self.get_tomorrow_utc())
             return False, self.get_limit_exceeded_message(user_id)
             
         except Exception as e:
-            print(f"Error in can_consult: {e}")
+            logger.error("Error in can_consult: %s", e)
             raise
 
     async def handle_message(self, user_id: str, message_text: str, conversation_id: str) -> Optional[str]:
         """メッセージを処理し、必要に応じて制限メッセージを返す"""
         try:
-            can_send, status = await self.can_consult(user_id)
-            if not can_send:
-                return status
+            # 判定結果がキャッシュにあればFirestoreにアクセスしない
+            if self.entitlement_cache:
+                state = self.entitlement_cache.get(user_id)
+                if state == Entitlement.LIMIT_EXCEEDED:
+                    return self.get_limit_exceeded_message(user_id)
+                if state == Entitlement.PAID:
+                    return None
+
+            # ユーザー情報の読み込みはこの1回だけ
+            user = await self.get_user(user_id)
+            if not user:
+                # 新規ユーザーは作成と初回の相談カウントを1回の書き込みで行う
+                await self.create_user(user_id, consume_consultation=True)
+            else:
+                can_send, status = await self.can_consult(user_id, user)
+                if not can_send:
+                    return status
 
-            # メッセージを保存
-            message = Message("USER", message_text)
-            await self.conversation_service.add_message(user_id, conversation_id, message)
-            
             # 無料ユーザーの場合、相談回数を更新
-            user = self.get_user(user_id)
-            if not user.is_paid:
+            if user and not user.is_paid:
                 await self.update_consultation(user_id)
 
             return None
 
         except Exception as e:
-            print(f"Error handling message: {e}")
+            logger.error("Error handling message: %s", e)
+            raise
+
+    async def record_turn(self, user_id: str, conversation_id: str, message_text: str, reply_text: str) -> None:
+        """ユーザーのメッセージとアシスタントの応答を1回のバッチ書き込みで保存"""
+        try:
+            await self.conversation_service.add_messages(user_id, conversation_id, [
+                Message("USER", message_text),
+                Message("ASSISTANT", reply_text, role="assistant")
+            ])
+        except Exception as e:
+            logger.error("Error recording conversation turn: %s", e)
             raise
 
     @staticmethod
@@ -147,29 +241,28 @@ class UserService:
         transaction.update(user_ref, user_data)
 
     async def update_consultation(self, user_id: str) -> None:
+        """相談回数を加算（読み込みなしのアトミックなIncrementで更新）"""
         try:
-            user_ref = self.users_ref.document(user_id)
-            user = self.get_user(user_id)
-            
-            if user:
-                today_utc = self.get_today_utc()
-                update_data = {
-                    'consultation_count': user.consultation_count + 1,
-                    'last_consultation_date': today_utc,
-                    'updated_at': self.get_now_utc()
-                }
-                user_ref.update(update_data)
-                print(f"Updated consultation count for user: {user_id}")
+            update_data = {
+                'consultation_count': Increment(1),
+                'last_consultation_date': self.get_today_utc(),
+                'updated_at': self.get_now_utc()
+            }
+            await self.firestore.update(self.users_ref.document(user_id), update_data)
+            # 無料プランは1日1回のため、翌日0:00までは上限到達として扱う
+            self._cache_entitlement(user_id, Entitlement.LIMIT_EXCEEDED, self.get_tomorrow_utc())
+            logger.debug("Updated consultation count for user: %s", user_id)
         except Exception as e:
-            print(f"Error updating consultation: {e}")
+            logger.error("Error updating consultation: %s", e)
             raise
 
     async def update_membership_status(self, user_id: str, is_paid: bool) -> None:
-        user = self.get_user(user_id)
+        user = await self.get_user(user_id)
         if user:
             user.is_paid = is_paid
             user.updated_at = self.get_now_utc()
-            self.users_ref.document(user_id).update(user.to_dict())
+            await self.firestore.update(self.users_ref.document(user_id), user.to_dict())
+            self._invalidate_entitlement(user_id)
 
     async def update_subscription_status(self, user_id: str, is_active: bool, subscription_id: str = None):
         try:
@@ -179,24 +272,39 @@ class UserService:
                 'subscription_id': subscription_id,
                 'updated_at': self.get_now_utc()
             }
-            user_ref.update(update_data)
-            print(f"Updated subscription status for user {user_id}: {is_active}")
+            await self.firestore.update(user_ref, update_data)
+            self._invalidate_entitlement(user_id)
+            logger.info("Updated subscription status for user %s: %s", user_id, is_active)
         except Exception as e:
-            print(f"Error updating subscription status: {e}")
+            logger.error("Error updating subscription status: %s", e)
             raise
 
-    async def update_subscription(self, user_id: str, subscription_type: str) -> None:
-        """サブスクリプションを更新または開始"""
-        try:
-            user = self.get_user(user_id)
-            if not user:
-                # ユーザーが存在しない場合は新規作成
-                user = User(user_id=user_id)
-                self.users_ref.document(user_id).set(user.to_dict())
+    async def update_subscription(
+        self,
+        user_id: str,
+        subscription_type: str,
+        subscription_id: Optional[str] = None,
+        customer_id: Optional[str] = None,
+        current_period_end: Optional[datetime] = None,
+        auto_renew: bool = True,
+        event_created: Optional[int] = None
+    ) -> bool:
+        """サブスクリプションを更新または開始（マージ書き込み1回、ユーザーがいなければ作成）
 
-            days = self.YEARLY_SUBSCRIPTION_DAYS if subscription_type == "yearly" else self.MONTHLY_SUBSCRIPTION_DAYS
+        current_period_endはStripeの請求期間の終了日時（不明な場合はプランの日数から計算）。
+        自動更新の場合は、更新の反映が遅れても期限切れにしないようEXPIRY_GRACE_PERIODを加える。
+        event_createdを指定した場合は、反映済みのイベントより古ければ書き込まずにFalseを返す。
+        """
+        try:
+            if await self._is_stale_stripe_event(user_id, event_created):
+                return False
             now_utc = self.get_now_utc()
-            subscription_end = now_utc + timedelta(days=days)
+            if current_period_end is None:
+                days = self.YEARLY_SUBSCRIPTION_DAYS if subscription_type == "yearly" else self.MONTHLY_SUBSCRIPTION_DAYS
+                current_period_end = now_utc + timedelta(days=days)
+            subscription_end = current_period_end
+            if auto_renew:
+                subscription_end += timedelta(seconds=self.EXPIRY_GRACE_PERIOD)
 
             update_data = {
                 'user_id': user_id,
@@ -204,32 +312,59 @@ class UserService:
                 'is_paid': True,
                 'subscription_type': subscription_type,
                 'subscription_end': subscription_end,
+                'auto_renew': auto_renew,
                 'updated_at': now_utc
             }
-            
-            self.users_ref.document(user_id).update(update_data)
-            print(f"Updated subscription for user {user_id}: {subscription_type}")
+            if subscription_id:
+                update_data['subscription_id'] = subscription_id
+            if customer_id:
+                update_data['stripe_customer_id'] = customer_id
+            if event_created is not None:
+                update_data['stripe_event_created'] = event_created
+
+            await self.firestore.set(self.users_ref.document(user_id), update_data, merge=True)
+            self._cache_entitlement(user_id, Entitlement.PAID, subscription_end)
+            self.checkout_links.invalidate(user_id)
+            logger.info("Updated subscription for user %s: %s", user_id, subscription_type)
+            return True
         except Exception as e:
-            print(f"Error updating subscription: {e}")
+            logger.error("Error updating subscription: %s", e)
             raise
 
-    async def deactivate_subscription(self, user_id: str) -> None:
-        """サブスクリプションを無効化"""
+    async def deactivate_subscription(self, user_id: str, event_created: Optional[int] = None) -> bool:
+        """サブスクリプションを無効化（event_createdが反映済みのイベントより古ければ書き込まずにFalseを返す）"""
         try:
+            if await self._is_stale_stripe_event(user_id, event_created):
+                return False
             update_data = {
                 'is_paid': False,
                 'subscription_type': None,
                 'subscription_end': None,
                 'updated_at': self.get_now_utc()
             }
-            self.users_ref.document(user_id).update(update_data)
-            print(f"Deactivated subscription for user: {user_id}")
+            if event_created is not None:
+                update_data['stripe_event_created'] = event_created
+            await self.firestore.update(self.users_ref.document(user_id), update_data)
+            self._invalidate_entitlement(user_id)
+            logger.info("Deactivated subscription for user: %s", user_id)
+            return True
         except Exception as e:
-            print(f"Error deactivating subscription: {e}")
+            logger.error("Error deactivating subscription: %s", e)
             raise
 
+    async def _is_stale_stripe_event(self, user_id: str, event_created: Optional[int]) -> bool:
+        """反映済みのStripeイベントより前に作られたイベントか（遅れて届いたイベントで新しい状態を上書きしない）"""
+        if event_created is None:
+            return False
+        doc = await self.firestore.get(self.users_ref.document(user_id))
+        applied = doc.to_dict().get('stripe_event_created') if doc.exists else None
+        if applied is not None and applied > event_created:
+            logger.info("Skipping stale Stripe event for user %s (created %s < %s)", user_id, event_created, applied)
+            return True
+        return False
+
     def initialize_collections(self):
-        print("Initializing Firestore collections...")
+        logger.info("Initializing Firestore collections...")
         try:
             # usersコレクションが存在することを確認
             users_ref = self.db.collection('users')
@@ -238,9 +373,9 @@ class UserService:
             if os.getenv('ENVIRONMENT') == 'development':
                 test_user = User('test_user_id')
                 users_ref.document('test_user_id').set(test_user.to_dict())
-                print("Test user created successfully")
+                logger.info("Test user created successfully")
                 
-            print("Collections initialized successfully")
+            logger.info("Collections initialized successfully")
         except Exception as e:
-            print(f"Error initializing collections: {e}")
+            logger.error("Error initializing collections: %s", e)
             raise 
\ No newline at end of file
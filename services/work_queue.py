@@ -0,0 +1,149 @@
+import asyncio
+import contextvars
+import logging
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Hashable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+Job = Tuple[Callable[..., Awaitable[Any]], Tuple[Any, ...], float, contextvars.Context]
+
+
+class WorkQueue:
+    """上限付きのインプロセス非同期ワークキュー
+
+    同じkeyで投入したジョブは投入順に1つずつ処理し、異なるkeyのジョブはワーカー数まで並行に処理する。
+    ジョブは投入時のコンテキスト（リクエストIDなど）で実行される。
+    """
+
+    def __init__(self, name: str, maxsize: int = 1000, workers: int = 4, drain_timeout: float = 30.0):
+        self.name = name
+        self.maxsize = maxsize
+        self.worker_count = max(1, workers)
+        self.drain_timeout = drain_timeout
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers: List[asyncio.Task] = []
+        self._accepting = False
+        self._in_flight = 0
+        # 実行中のkeyごとの後続ジョブ（keyが登録されていれば、そのkeyのジョブを処理中）
+        self._keyed: Dict[Hashable, Deque[Job]] = {}
+        self._deferred = 0
+        self.stats: Dict[str, Any] = {
+            'enqueued': 0,
+            'processed': 0,
+            'failed': 0,
+            'rejected': 0,
+            'max_depth': 0,
+            'total_wait_seconds': 0.0,
+        }
+
+    @property
+    def depth(self) -> int:
+        """キューに積まれているジョブ数（同じkeyの順番待ちを含む）"""
+        return (self._queue.qsize() if self._queue else 0) + self._deferred
+
+    @property
+    def in_flight(self) -> int:
+        """処理中のジョブ数"""
+        return self._in_flight
+
+    @property
+    def is_running(self) -> bool:
+        """ワーカーが起動していて、異常終了していないか"""
+        return bool(self._workers) and not any(worker.done() for worker in self._workers)
+
+    async def start(self) -> None:
+        """ワーカーを起動"""
+        if self._workers:
+            return
+        self._queue = asyncio.Queue()
+        self._accepting = True
+        self._workers = [
+            asyncio.create_task(self._worker(i), name=f"{self.name}-worker-{i}")
+            for i in range(self.worker_count)
+        ]
+        logger.info("WorkQueue '%s' started with %s workers (maxsize=%s)", self.name, self.worker_count, self.maxsize)
+
+    def submit(self, func: Callable[..., Awaitable[Any]], *args: Any, key: Optional[Hashable] = None) -> bool:
+        """ジョブを投入する。キューが満杯または停止中の場合はFalseを返す
+
+        keyを指定すると、同じkeyのジョブは前のジョブが終わってから投入順に処理される。
+        """
+        if not self._accepting or self._queue is None:
+            self.stats['rejected'] += 1
+            return False
+        if self.depth >= self.maxsize:
+            self.stats['rejected'] += 1
+            logger.warning("WorkQueue '%s' is full (%s), job rejected", self.name, self.maxsize)
+            return False
+
+        job = (func, args, time.monotonic(), contextvars.copy_context())
+        if key is not None and key in self._keyed:
+            # 同じkeyのジョブが処理中なので、そのワーカーが続けて処理する
+            self._keyed[key].append(job)
+            self._deferred += 1
+        else:
+            if key is not None:
+                self._keyed[key] = deque()
+            self._queue.put_nowait((key, job))
+
+        self.stats['enqueued'] += 1
+        self.stats['max_depth'] = max(self.stats['max_depth'], self.depth)
+        return True
+
+    async def _worker(self, index: int) -> None:
+        while True:
+            key, job = await self._queue.get()
+            try:
+                await self._run(job, index)
+                if key is not None:
+                    pending = self._keyed[key]
+                    while pending:
+                        self._deferred -= 1
+                        await self._run(pending.popleft(), index)
+                    del self._keyed[key]
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job: Job, index: int) -> None:
+        func, args, enqueued_at, context = job
+        self._in_flight += 1
+        self.stats['total_wait_seconds'] += time.monotonic() - enqueued_at
+        try:
+            await asyncio.create_task(func(*args), context=context)
+            self.stats['processed'] += 1
+        except Exception as e:
+            self.stats['failed'] += 1
+            logger.exception("Error in WorkQueue '%s' worker %s: %s", self.name, index, e)
+        finally:
+            self._in_flight -= 1
+
+    async def stop(self) -> None:
+        """新規受付を止め、残りのジョブを処理してからワーカーを停止"""
+        if not self._workers:
+            return
+        self._accepting = False
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout=self.drain_timeout)
+        except asyncio.TimeoutError:
+            logger.warning("WorkQueue '%s' drain timed out with %s jobs pending", self.name, self.depth)
+
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        logger.info("WorkQueue '%s' stopped", self.name)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """バックプレッシャー監視用の統計情報"""
+        processed = self.stats['processed'] + self.stats['failed']
+        return {
+            **self.stats,
+            'depth': self.depth,
+            'in_flight': self._in_flight,
+            'active_keys': len(self._keyed),
+            'workers': self.worker_count,
+            'maxsize': self.maxsize,
+            'avg_wait_seconds': self.stats['total_wait_seconds'] / processed if processed else 0.0,
+        }
@@ -0,0 +1,113 @@
+import asyncio
+import logging
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from google.cloud.firestore import Client
+from services.firestore_client import AsyncFirestore
+
+logger = logging.getLogger(__name__)
+
+# Firestoreのバッチ書き込みの上限
+MAX_BATCH_OPERATIONS = 500
+
+
+class WriteBehindBuffer:
+    """Firestoreへの書き込みをまとめて一定間隔でバッチコミットするバッファ
+
+    コミットに失敗した書き込みはバッファの先頭に戻し、間隔を空けて再試行する。
+    max_attempts回続けて失敗した書き込みは破棄し、on_dropに渡す。
+    """
+
+    def __init__(
+        self,
+        db: Client,
+        firestore: AsyncFirestore,
+        flush_interval: float = 0.2,
+        max_batch: int = MAX_BATCH_OPERATIONS,
+        max_attempts: int = 5,
+        retry_backoff: float = 0.5,
+        on_drop: Optional[Callable[[List[Tuple[Any, Dict[str, Any]]]], None]] = None
+    ):
+        self.db = db
+        self.firestore = firestore
+        self.flush_interval = flush_interval
+        self.max_batch = min(max_batch, MAX_BATCH_OPERATIONS)
+        self.max_attempts = max(1, max_attempts)
+        self.retry_backoff = retry_backoff
+        self.on_drop = on_drop
+        self._pending: List[Tuple[Any, Dict[str, Any]]] = []
+        self._failures = 0  # 先頭の書き込みが続けて失敗した回数
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+        self.stats: Dict[str, int] = {'buffered': 0, 'flushed': 0, 'commits': 0, 'retries': 0, 'failed': 0}
+
+    async def start(self) -> None:
+        """定期フラッシュを開始"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name="write-behind-buffer")
+
+    def add(self, doc_ref, data: Dict[str, Any]) -> None:
+        """書き込みをバッファに追加"""
+        self._pending.append((doc_ref, data))
+        self.stats['buffered'] += 1
+        if len(self._pending) >= self.max_batch:
+            self._wakeup.set()
+
+    async def _run(self) -> None:
+        while not self._stopping:
+            if self._failures:
+                # 失敗が続いている間はバッファが溜まっても再試行の間隔を空ける
+                await asyncio.sleep(self._retry_delay())
+            else:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+            self._wakeup.clear()
+            await self.flush()
+
+    def _retry_delay(self) -> float:
+        return self.retry_backoff * 2 ** (self._failures - 1)
+
+    async def flush(self) -> None:
+        """バッファの内容を最大500件ずつバッチでコミット（失敗した場合は先頭に戻して終了）"""
+        while self._pending:
+            chunk = self._pending[:self.max_batch]
+            del self._pending[:self.max_batch]
+            batch = self.db.batch()
+            for doc_ref, data in chunk:
+                batch.set(doc_ref, data)
+            try:
+                await self.firestore.commit(batch)
+                self._failures = 0
+                self.stats['flushed'] += len(chunk)
+                self.stats['commits'] += 1
+            except Exception as e:
+                self._failures += 1
+                if self._failures < self.max_attempts:
+                    self._pending[:0] = chunk
+                    self.stats['retries'] += 1
+                    logger.warning("Error flushing write-behind buffer (%s writes, attempt %s): %s", len(chunk), self._failures, e)
+                    return
+
+                self._failures = 0
+                self.stats['failed'] += len(chunk)
+                logger.error("Dropping %s writes after %s failed flushes: %s", len(chunk), self.max_attempts, e)
+                if self.on_drop:
+                    self.on_drop(chunk)
+
+    async def stop(self) -> None:
+        """定期フラッシュを止め、残りを書き込む（失敗した場合はmax_attempts回まで再試行）"""
+        if self._task is not None:
+            # コミット中の書き込みを中断しないよう、キャンセルせずにループの終了を待つ
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        await self.flush()
+        while self._pending and self._failures:
+            await asyncio.sleep(self._retry_delay())
+            await self.flush()
+
+    def get_stats(self) -> Dict[str, int]:
+        return {**self.stats, 'pending': len(self._pending)}
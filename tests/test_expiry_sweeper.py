@@ -0,0 +1,110 @@
+import asyncio
+import time
+from datetime import datetime, timedelta, timezone
+
+from benchmarks.fake_firestore import InMemoryFirestore
+from models.user import User
+from services.checkout_links import CheckoutLinkProvider
+from services.expiry_sweeper import EXPIRED_MESSAGE, EXPIRING_SOON_MESSAGE, ExpirySweeper
+from services.firestore_client import AsyncFirestore
+
+
+class RecordingLineClient:
+    def __init__(self):
+        self.pushes = []
+        self.multicasts = []
+
+    async def push_message(self, to, message):
+        self.pushes.append((to, message.text))
+
+    async def multicast(self, to, message):
+        self.multicasts.append((list(to), message.text))
+
+
+class FakeStripeService:
+    """U_failで始まるユーザーのURL作成だけ失敗させる"""
+
+    def create_checkout_session_with_expiry(self, user_id, plan_type, ttl):
+        if user_id.startswith("U_fail"):
+            raise RuntimeError("stripe unavailable")
+        return f"https://checkout.example/{user_id}", time.time() + ttl
+
+
+def seed(db, user_id: str, end: datetime, **fields) -> None:
+    data = User(user_id, is_paid=True, subscription_type="monthly", subscription_end=end).to_dict()
+    db.collection('users').document(user_id).set({**data, **fields})
+
+
+def run_sweep(db):
+    line_client = RecordingLineClient()
+
+    async def scenario():
+        firestore = AsyncFirestore(max_workers=2)
+        checkout_links = CheckoutLinkProvider(FakeStripeService(), max_workers=2)
+        try:
+            return await ExpirySweeper(db, firestore, line_client, checkout_links=checkout_links).sweep()
+        finally:
+            await checkout_links.aclose()
+            firestore.shutdown()
+
+    return asyncio.run(scenario()), line_client
+
+
+def test_expired_users_get_a_personal_link():
+    db = InMemoryFirestore()
+    now = datetime.now(timezone.utc)
+    seed(db, "U1", now - timedelta(hours=1))
+    seed(db, "U_fail", now - timedelta(hours=1))
+
+    stats, line_client = run_sweep(db)
+
+    assert stats['deactivated'] == 2 and stats['expired_notified'] == 2
+    assert line_client.pushes == [("U1", line_client.pushes[0][1])]
+    assert "https://checkout.example/U1" in line_client.pushes[0][1]
+    assert line_client.multicasts == [(["U_fail"], EXPIRED_MESSAGE)]
+    assert db.collection('users').document("U1").get().to_dict()['is_paid'] is False
+
+
+def test_expiring_notice_skips_auto_renewing_users():
+    db = InMemoryFirestore()
+    soon = datetime.now(timezone.utc) + timedelta(days=1)
+    seed(db, "U_renew", soon, auto_renew=True)
+    seed(db, "U_legacy", soon)
+    seed(db, "U_cancel", soon, auto_renew=False)
+
+    stats, line_client = run_sweep(db)
+
+    assert line_client.multicasts == [(["U_cancel"], EXPIRING_SOON_MESSAGE)]
+    assert stats['expiring_notified'] == 1
+
+
+def test_user_renewed_after_the_read_is_not_deactivated(monkeypatch):
+    db = InMemoryFirestore()
+    now = datetime.now(timezone.utc)
+    seed(db, "U1", now - timedelta(hours=1))
+    seed(db, "U2", now - timedelta(hours=1))
+    renewed_end = now + timedelta(days=30)
+    make_batch = db.batch
+
+    def batch_renewing_u2():
+        # ページを読んだ後、コミットの前にWebhookで更新されたことにする
+        batch = make_batch()
+        commit = batch.commit
+
+        def renew_then_commit():
+            db.collection('users').document("U2").update({'subscription_end': renewed_end})
+            monkeypatch.setattr(db, "batch", make_batch)
+            commit()
+
+        batch.commit = renew_then_commit
+        return batch
+
+    monkeypatch.setattr(db, "batch", batch_renewing_u2)
+
+    stats, line_client = run_sweep(db)
+
+    assert stats['deactivated'] == 1 and stats['skipped'] == 1 and stats['failed_writes'] == 0
+    assert [user_id for user_id, _ in line_client.pushes] == ["U1"]
+    assert db.collection('users').document("U1").get().to_dict()['is_paid'] is False
+    renewed = db.collection('users').document("U2").get().to_dict()
+    assert renewed['is_paid'] is True and renewed['subscription_end'] == renewed_end
@@ -0,0 +1,140 @@
+import asyncio
+import time
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+
+from benchmarks.fake_firestore import InMemoryFirestore
+from handlers.line_webhook import LineWebhookHandler
+from models.user import User
+from services.checkout_links import CheckoutLinkProvider
+from services.firestore_client import AsyncFirestore
+from services.user_service import UserService
+
+
+class RecordingLineClient:
+    def __init__(self, reply_delay: float = 0):
+        self.sent = []
+        self.reply_delay = reply_delay
+
+    async def reply_message(self, reply_token, message):
+        await asyncio.sleep(self.reply_delay)
+        self.sent.append(('reply', message.text))
+
+    async def push_message(self, to, message):
+        self.sent.append(('push', message.text))
+
+
+class FakeStripeService:
+    def create_checkout_session_with_expiry(self, user_id, plan_type, ttl):
+        time.sleep(0.05)
+        return f"https://checkout.example/{user_id}", time.time() + ttl
+
+
+class FakeAIService:
+    DEFAULT_CHARACTER = "ojou"
+    streaming_enabled = False
+
+    async def prefetch_context(self, user_id, conversation_id, character):
+        return None
+
+
+def text_event(text: str):
+    return SimpleNamespace(
+        message=SimpleNamespace(type="text", text=text),
+        source=SimpleNamespace(user_id="U1"),
+        reply_token="token"
+    )
+
+
+@pytest.fixture
+def make_handler(monkeypatch):
+    firestores = []
+
+    def make(reply_delay: float = 0, payment_link: str = None):
+        if payment_link:
+            monkeypatch.setenv("STRIPE_PAYMENT_LINK_month", payment_link)
+        else:
+            monkeypatch.delenv("STRIPE_PAYMENT_LINK_month", raising=False)
+        firestore = AsyncFirestore(max_workers=2)
+        firestores.append(firestore)
+        checkout_links = CheckoutLinkProvider(FakeStripeService(), max_workers=1)
+        user_service = UserService(InMemoryFirestore(), None, firestore, checkout_links=checkout_links)
+        return LineWebhookHandler(RecordingLineClient(reply_delay), user_service, FakeAIService())
+
+    yield make
+    for firestore in firestores:
+        firestore.shutdown()
+
+
+@pytest.fixture
+def handler(make_handler):
+    return make_handler()
+
+
+def seed(handler, **fields) -> None:
+    user = User("U1", **fields)
+    handler.user_service.db.collection('users').document("U1").set(user.to_dict())
+
+
+def test_expired_user_gets_the_link_after_the_reply(handler):
+    seed(handler, is_paid=True, subscription_type="monthly",
+         subscription_end=datetime.now(timezone.utc) - timedelta(minutes=1))
+
+    async def scenario():
+        await handler.handle_message(text_event("こんにちは"))
+        await handler.user_service.checkout_links.aclose()
+
+    asyncio.run(scenario())
+    (kind, reply), (push_kind, push) = handler.line_client.sent
+    assert kind == 'reply' and "このあとお送りします" in reply
+    assert push_kind == 'push' and "https://checkout.example/U1" in push
+
+
+def test_link_is_pushed_when_it_is_ready_before_a_slow_reply(make_handler):
+    handler = make_handler(reply_delay=0.2)
+    seed(handler, is_paid=True, subscription_type="monthly",
+         subscription_end=datetime.now(timezone.utc) - timedelta(minutes=1))
+
+    async def scenario():
+        await handler.handle_message(text_event("こんにちは"))
+        await handler.user_service.checkout_links.aclose()
+
+    asyncio.run(scenario())
+    (kind, reply), (push_kind, push) = handler.line_client.sent
+    assert kind == 'reply' and "このあとお送りします" in reply
+    assert push_kind == 'push' and "https://checkout.example/U1" in push
+
+
+def test_payment_link_in_the_reply_is_not_followed_by_a_push(make_handler):
+    handler = make_handler(payment_link="https://buy.stripe.com/test_month")
+    seed(handler, is_paid=True, subscription_type="monthly",
+         subscription_end=datetime.now(timezone.utc) - timedelta(minutes=1))
+
+    async def scenario():
+        await handler.handle_message(text_event("こんにちは"))
+        await handler.user_service.checkout_links.aclose()
+
+    asyncio.run(scenario())
+    [(kind, reply)] = handler.line_client.sent
+    assert kind == 'reply' and "https://buy.stripe.com/test_month?client_reference_id=U1" in reply
+
+
+def test_subscribe_keyword_replies_with_link(handler):
+    seed(handler)
+
+    async def scenario():
+        await handler.handle_message(text_event("サブスク"))
+        await handler.user_service.checkout_links.aclose()
+
+    asyncio.run(scenario())
+    assert handler.line_client.sent == [('reply', handler.CHECKOUT_LINK_MESSAGE.format(url="https://checkout.example/U1"))]
+
+
+def test_subscribe_keyword_for_active_subscriber(handler):
+    seed(handler, is_paid=True, subscription_type="monthly",
+         subscription_end=datetime.now(timezone.utc) + timedelta(days=3))
+
+    asyncio.run(handler.handle_message(text_event("サブスク")))
+    assert handler.line_client.sent == [('reply', handler.ALREADY_SUBSCRIBED_MESSAGE)]
@@ -0,0 +1,39 @@
+import json
+import logging
+import queue
+from logging.handlers import QueueListener
+
+from services.logging_config import JsonFormatter, RecordQueueHandler
+
+
+class _ListHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.lines = []
+
+    def emit(self, record: logging.LogRecord) -> None:
+        self.lines.append(self.format(record))
+
+
+def test_exception_is_a_separate_json_field_after_the_queue():
+    output = _ListHandler()
+    output.setFormatter(JsonFormatter())
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, output)
+    logger = logging.getLogger("test_logging_config")
+    logger.propagate = False
+    logger.addHandler(RecordQueueHandler(log_queue))
+    listener.start()
+    try:
+        try:
+            raise ValueError("boom")
+        except ValueError:
+            logger.exception("failed for %s", "U1", extra={"stage": "llm"})
+    finally:
+        listener.stop()
+
+    entry = json.loads(output.lines[0])
+    assert entry["message"] == "failed for U1"
+    assert entry["stage"] == "llm"
+    assert "ValueError: boom" in entry["exception"]
+    assert "Traceback" not in entry["message"]
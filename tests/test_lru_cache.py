@@ -0,0 +1,51 @@
+from services.lru_cache import TTLCache
+
+
+def test_evicts_least_recently_used_entry():
+    cache = TTLCache(max_entries=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+
+    assert cache.peek("b") is None
+    assert (cache.peek("a"), cache.peek("c")) == (1, 3)
+    assert cache.stats['evictions'] == 1
+
+
+def test_evicts_until_under_byte_limit():
+    cache = TTLCache(max_entries=10, max_bytes=10, size_of=len)
+    cache.set("a", "xxxx")
+    cache.set("b", "yyyy")
+    cache.set("c", "zzzz")
+
+    assert cache.peek("a") is None
+    assert cache.total_bytes == 8
+
+
+def test_expired_entries_are_misses(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr("services.lru_cache.time.monotonic", lambda: now[0])
+    cache = TTLCache(max_entries=10, ttl=5)
+    cache.set("a", 1)
+    cache.set("b", 2, ttl=60)
+    cache.set("c", 3, ttl=0)
+    now[0] += 10
+
+    assert cache.get("a") is None and cache.get("b") == 2 and cache.get("c") is None
+    stats = cache.get_stats()
+    assert (stats['hits'], stats['misses'], stats['expirations'], stats['entries']) == (1, 2, 1, 1)
+
+
+def test_update_keeps_deadline_and_unusable_values_miss(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr("services.lru_cache.time.monotonic", lambda: now[0])
+    cache = TTLCache(max_entries=10, ttl=5)
+    cache.set("a", [1])
+    now[0] += 3
+    assert cache.update("a", [1, 2])
+    assert cache.get("a", usable=lambda value: len(value) >= 3) is None
+    now[0] += 3
+
+    assert cache.peek("a") is None
+    assert not cache.update("a", [1, 2, 3])
@@ -0,0 +1,110 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from benchmarks.fake_firestore import InMemoryFirestore
+from handlers.stripe_webhook_handler import StripeWebhookHandler
+from services.dedup_store import InMemoryDedupStore
+from services.firestore_client import AsyncFirestore
+from services.user_service import UserService
+
+
+class RecordingLineHandler:
+    def __init__(self):
+        self.sent = []
+
+    async def send_subscription_success_message(self, user_id: str) -> None:
+        self.sent.append(('success', user_id))
+
+
+def checkout_event(event_id: str = "evt_1") -> dict:
+    return {
+        'id': event_id,
+        'type': 'checkout.session.completed',
+        'data': {'object': {'client_reference_id': 'U1', 'subscription': 'sub_1', 'customer': 'cus_1'}}
+    }
+
+
+@pytest.fixture
+def handler(monkeypatch):
+    monkeypatch.setenv("STRIPE_SECRET_KEY", "sk_test_dummy")
+    firestore = AsyncFirestore(max_workers=2)
+    db = InMemoryFirestore()
+    user_service = UserService(db, conversation_service=None, firestore=firestore)
+    handler = StripeWebhookHandler(user_service, RecordingLineHandler(), InMemoryDedupStore(), retry_backoff=0)
+    yield handler
+    firestore.shutdown()
+
+
+def test_subscription_is_written_before_the_webhook_returns(handler, monkeypatch):
+    monkeypatch.setattr("stripe.Webhook.construct_event", lambda payload, sig, secret: checkout_event())
+
+    asyncio.run(handler.handle_webhook(b"{}", "sig"))
+
+    user = handler.user_service.db.collection('users').document('U1').get().to_dict()
+    assert user['is_paid'] is True and user['subscription_id'] == 'sub_1'
+    assert handler.line_handler.sent == [('success', 'U1')]
+
+
+def test_failed_write_lets_stripe_redeliver(handler, monkeypatch):
+    monkeypatch.setattr("stripe.Webhook.construct_event", lambda payload, sig, secret: checkout_event())
+    calls = []
+
+    async def failing_update(*args, **kwargs):
+        calls.append(args)
+        raise RuntimeError("firestore unavailable")
+
+    monkeypatch.setattr(handler.user_service, "update_subscription", failing_update)
+    with pytest.raises(RuntimeError):
+        asyncio.run(handler.handle_webhook(b"{}", "sig"))
+    assert len(calls) == handler.max_attempts
+
+    # 再送されたイベントは重複として捨てられずに処理される
+    monkeypatch.undo()
+    monkeypatch.setenv("STRIPE_SECRET_KEY", "sk_test_dummy")
+    monkeypatch.setattr("stripe.Webhook.construct_event", lambda payload, sig, secret: checkout_event())
+    asyncio.run(handler.handle_webhook(b"{}", "sig"))
+    assert handler.user_service.db.collection('users').document('U1').get().to_dict()['is_paid'] is True
+
+
+def test_renewal_uses_stripe_period_end_plus_grace(handler, monkeypatch):
+    period_end = datetime(2030, 1, 31, tzinfo=timezone.utc)
+    event = {
+        'id': 'evt_2',
+        'type': 'customer.subscription.updated',
+        'data': {'object': {
+            'id': 'sub_1', 'customer': 'cus_1', 'status': 'active', 'metadata': {'user_id': 'U1'},
+            'current_period_end': int(period_end.timestamp()), 'cancel_at_period_end': False
+        }}
+    }
+    monkeypatch.setattr("stripe.Webhook.construct_event", lambda payload, sig, secret: event)
+
+    asyncio.run(handler.handle_webhook(b"{}", "sig"))
+
+    user = handler.user_service.db.collection('users').document('U1').get().to_dict()
+    grace = timedelta(seconds=handler.user_service.EXPIRY_GRACE_PERIOD)
+    assert user['subscription_end'] == period_end + grace and user['auto_renew'] is True
+
+
+def subscription_event(event_id: str, status: str, created: int) -> dict:
+    return {
+        'id': event_id,
+        'type': 'customer.subscription.updated',
+        'created': created,
+        'data': {'object': {
+            'id': 'sub_1', 'customer': 'cus_1', 'status': status, 'metadata': {'user_id': 'U1'},
+            'current_period_end': 1900000000, 'cancel_at_period_end': False
+        }}
+    }
+
+
+def test_older_event_arriving_late_does_not_overwrite_newer_state(handler):
+    async def scenario():
+        await handler.process_event(subscription_event('evt_new', 'active', created=2000))
+        await handler.process_event(subscription_event('evt_old', 'canceled', created=1000))
+
+    asyncio.run(scenario())
+
+    user = handler.user_service.db.collection('users').document('U1').get().to_dict()
+    assert user['is_paid'] is True and user['stripe_event_created'] == 2000
@@ -0,0 +1,59 @@
+import asyncio
+
+from benchmarks.fake_firestore import InMemoryFirestore
+from models.conversation import Message
+from services.conversation_service import ConversationService
+from services.firestore_client import AsyncFirestore
+from services.summary_service import SummaryService
+
+
+class RecordingQueue:
+    """submitされたジョブを保持し、テストから順に実行する"""
+
+    def __init__(self):
+        self.jobs = []
+
+    def submit(self, func, *args, key=None) -> bool:
+        self.jobs.append((func, args))
+        return True
+
+    async def run_all(self) -> None:
+        while self.jobs:
+            func, args = self.jobs.pop(0)
+            await func(*args)
+
+
+class FakeSummarizer:
+    async def generate_summary(self, messages):
+        return f"summary of {len(messages)}"
+
+    async def combine_summaries(self, summaries):
+        return " / ".join(summaries)
+
+
+def test_unsummarized_messages_stay_within_recent_window(monkeypatch):
+    """要約以降のメッセージが常にプロンプトに含める直近の件数に収まる"""
+    monkeypatch.setenv("CONVERSATION_RECENT_WINDOW", "20")
+    monkeypatch.delenv("MAX_MESSAGES_PER_SUMMARY", raising=False)
+
+    async def scenario():
+        firestore = AsyncFirestore(max_workers=2)
+        conversations = ConversationService(InMemoryFirestore(), firestore)
+        queue = RecordingQueue()
+        summaries = SummaryService(conversations, FakeSummarizer(), queue, check_interval=10)
+        try:
+            for turn in range(60):
+                await conversations.add_messages("U1", "default", [
+                    Message(role="user", content=f"q{turn}"),
+                    Message(role="assistant", content=f"a{turn}")
+                ])
+                summaries.schedule("U1", "default")
+                await queue.run_all()
+
+                latest = (await conversations.get_summaries("U1", "default", limit=1) or [None])[0]
+                unsummarized = await conversations.count_messages_after("U1", "default", latest)
+                assert unsummarized <= conversations.RECENT_WINDOW, f"turn {turn}: {unsummarized} messages not in prompt"
+        finally:
+            firestore.shutdown()
+
+    asyncio.run(scenario())
@@ -0,0 +1,67 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from benchmarks.fake_firestore import InMemoryFirestore
+from models.user import User
+from services.firestore_client import AsyncFirestore
+from services.user_service import UserService
+
+
+@pytest.fixture
+def db():
+    return InMemoryFirestore()
+
+
+@pytest.fixture
+def user_service(db):
+    firestore = AsyncFirestore(max_workers=2)
+    yield UserService(db, conversation_service=None, firestore=firestore)
+    firestore.shutdown()
+
+
+def ops(db) -> dict:
+    """0回の項目を除いたFirestoreの操作回数"""
+    return {kind: count for kind, count in db.get_ops().items() if count}
+
+
+def seed(db, user: User) -> None:
+    db.collection('users').document(user.user_id).set(user.to_dict())
+    db.reset_ops()
+
+
+def test_new_user_is_created_with_first_consultation_in_one_write(db, user_service):
+    assert asyncio.run(user_service.handle_message("Unew", "こんにちは", "default")) is None
+
+    assert ops(db) == {'get': 1, 'set': 1, 'rpcs': 2, 'doc_reads': 1, 'doc_writes': 1}
+    stored = db.collection('users').document("Unew").get().to_dict()
+    assert stored['consultation_count'] == 1
+
+
+def test_free_user_reads_once_and_increments_atomically(db, user_service):
+    yesterday = datetime.now(timezone.utc) - timedelta(days=1)
+    seed(db, User("Ufree", consultation_count=3, last_consultation_date=yesterday))
+
+    assert asyncio.run(user_service.handle_message("Ufree", "相談です", "default")) is None
+
+    assert ops(db) == {'get': 1, 'update': 1, 'rpcs': 2, 'doc_reads': 1, 'doc_writes': 1}
+    assert db.collection('users').document("Ufree").get().to_dict()['consultation_count'] == 4
+
+
+def test_free_user_over_limit_reads_once_and_writes_nothing(db, user_service):
+    seed(db, User("Ulimit", consultation_count=1, last_consultation_date=user_service.get_today_utc()))
+
+    message = asyncio.run(user_service.handle_message("Ulimit", "相談です", "default"))
+
+    assert message == user_service.get_limit_exceeded_message("Ulimit")
+    assert ops(db) == {'get': 1, 'rpcs': 1, 'doc_reads': 1}
+
+
+def test_paid_user_reads_once(db, user_service):
+    end = datetime.now(timezone.utc) + timedelta(days=10)
+    seed(db, User("Upaid", is_paid=True, subscription_type="monthly", subscription_end=end))
+
+    assert asyncio.run(user_service.handle_message("Upaid", "相談です", "default")) is None
+
+    assert ops(db) == {'get': 1, 'rpcs': 1, 'doc_reads': 1}
@@ -0,0 +1,66 @@
+import asyncio
+import random
+from collections import defaultdict
+
+from services.work_queue import WorkQueue
+
+
+def test_per_key_ordering_and_concurrency_under_contention():
+    """同じkeyは投入順に1つずつ、全体の同時実行数はワーカー数以下で処理される"""
+    workers = 4
+    keys = [f"U{i}" for i in range(10)]
+    jobs_per_key = 20
+    started = defaultdict(list)
+    running_keys = set()
+    running = 0
+    max_running = 0
+    overlaps = []
+
+    async def job(key: str, seq: int) -> None:
+        nonlocal running, max_running
+        if key in running_keys:
+            overlaps.append((key, seq))
+        running_keys.add(key)
+        running += 1
+        max_running = max(max_running, running)
+        started[key].append(seq)
+        try:
+            await asyncio.sleep(random.uniform(0, 0.003))
+        finally:
+            running -= 1
+            running_keys.discard(key)
+
+    async def run() -> dict:
+        queue = WorkQueue("test", maxsize=10000, workers=workers)
+        await queue.start()
+        # keyを混ぜて投入し、同じkeyのジョブが処理中に後続が積まれる状況を作る
+        submissions = [(key, seq) for seq in range(jobs_per_key) for key in keys]
+        random.shuffle(submissions)
+        expected = defaultdict(list)
+        for key, seq in submissions:
+            expected[key].append(seq)
+            assert queue.submit(job, key, seq, key=key)
+            if random.random() < 0.2:
+                await asyncio.sleep(0)
+        await queue.stop()
+        return expected
+
+    random.seed(14)
+    expected = asyncio.run(run())
+
+    assert overlaps == []
+    assert max_running <= workers
+    assert max_running > 1
+    for key in keys:
+        assert started[key] == expected[key]
+
+
+def test_rejects_when_full():
+    async def run() -> list:
+        queue = WorkQueue("test", maxsize=2, workers=1)
+        await queue.start()
+        results = [queue.submit(asyncio.sleep, 0.01, key="U1") for _ in range(3)]
+        await queue.stop()
+        return results
+
+    assert asyncio.run(run()) == [True, True, False]
@@ -0,0 +1,45 @@
+import asyncio
+
+from benchmarks.fake_firestore import InMemoryFirestore
+from services.write_buffer import WriteBehindBuffer
+
+
+class FlakyFirestore:
+    """最初のfailures回のコミットを失敗させる"""
+
+    def __init__(self, failures: int):
+        self.failures = failures
+        self.commits = 0
+
+    async def commit(self, batch) -> None:
+        self.commits += 1
+        if self.commits <= self.failures:
+            raise RuntimeError("unavailable")
+        batch.commit()
+
+
+def test_failed_chunk_is_retried_in_order():
+    db = InMemoryFirestore()
+    buffer = WriteBehindBuffer(db, FlakyFirestore(failures=2), max_batch=2, retry_backoff=0.01)
+    messages = db.collection('messages')
+
+    async def scenario():
+        for i in range(3):
+            buffer.add(messages.document(f"m{i}"), {'n': i})
+        await buffer.stop()
+
+    asyncio.run(scenario())
+    assert [doc.to_dict()['n'] for doc in messages.order_by('n').get()] == [0, 1, 2]
+    assert buffer.get_stats()['pending'] == 0
+    assert buffer.stats['retries'] == 2 and buffer.stats['failed'] == 0
+
+
+def test_chunk_is_dropped_after_max_attempts():
+    db = InMemoryFirestore()
+    dropped = []
+    buffer = WriteBehindBuffer(db, FlakyFirestore(failures=3), max_attempts=3, retry_backoff=0.01, on_drop=dropped.extend)
+    buffer.add(db.collection('messages').document("m0"), {'n': 0})
+
+    asyncio.run(buffer.stop())
+    assert [data for _, data in dropped] == [{'n': 0}]
+    assert buffer.stats['failed'] == 1 and buffer.get_stats()['pending'] == 0